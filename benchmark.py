@@ -0,0 +1,537 @@
+"""
+Offline load test: drive ReferralBot handlers with synthetic updates
+No network - a fake in-process Bot answers every API call.
+Usage: python benchmark.py [--users 100000] [--updates 2000] [--backend json|sqlite] [--output result.json]
+       python benchmark.py --memory-report --users 1000000   (also times snapshot formats)
+"""
+
+import argparse
+import asyncio
+import atexit
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+# Dummy credentials - the fake Bot never talks to Telegram
+os.environ.setdefault('BOT_TOKEN', '123456:BENCHMARK')
+os.environ.setdefault('CHANNEL_ID', '-1000000000001')
+os.environ.setdefault('ADMIN_USER_ID', '1')
+os.environ.setdefault('OUTBOUND_DRAIN_SECONDS', '0')
+os.environ.setdefault('METRICS_ENABLED', 'false')
+# Phases replay far more updates/s than a real bot gets - keep the per-bot ingress
+# budgets out of the way (per-user budgets stay on, the flood phase needs them)
+for _kind in ('COMMAND', 'CALLBACK', 'JOIN'):
+    os.environ.setdefault(f'INGRESS_{_kind}_GLOBAL_RATE', '0')
+
+from telegram import Bot, Update
+from telegram.ext import Application
+from telegram.request import BaseRequest
+
+PHASES = ['start_new', 'start_existing', 'status', 'home', 'join_request', 'flood']
+FIRST_USER_ID = 10_000_000
+FLOOD_USERS = 20        # accounts hammering /start <ref> and the status button
+FLOOD_LEGIT_RATIO = 0.1  # share of flood-phase updates that are ordinary /status
+
+
+class FakeRequest(BaseRequest):
+    """Answers Bot API calls in-process and counts them per method"""
+
+    def __init__(self, member_ratio=0.0):
+        self.member_ratio = member_ratio
+        self.calls = {}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        endpoint = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+
+        bot_user = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        if endpoint == 'getMe':
+            result = bot_user
+        elif endpoint in ('sendMessage', 'editMessageText', 'sendDocument'):
+            result = {
+                'message_id': 1,
+                'date': int(time.time()),
+                'chat': {'id': int(params.get('chat_id', 1)), 'type': 'private'},
+                'from': bot_user,
+                'text': str(params.get('text', ''))
+            }
+        elif endpoint == 'getChatMember':
+            status = 'member' if random.random() < self.member_ratio else 'left'
+            result = {'status': status, 'user': {'id': int(params['user_id']), 'is_bot': False, 'first_name': 'U'}}
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode('utf-8')
+
+
+class UpdateFactory:
+    """Synthetic Update payloads, shaped like the real ones"""
+
+    def __init__(self, channel_id):
+        self.channel_id = int(channel_id)
+        self.next_id = 0
+
+    def _user(self, user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}",
+                'username': f"user{user_id}", 'language_code': 'en'}
+
+    def command(self, user_id, text):
+        self.next_id += 1
+        command = text.split()[0]
+        return {'update_id': self.next_id, 'message': {
+            'message_id': self.next_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self._user(user_id),
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+        }}
+
+    def callback(self, user_id, data):
+        self.next_id += 1
+        return {'update_id': self.next_id, 'callback_query': {
+            'id': str(self.next_id),
+            'chat_instance': 'bench',
+            'data': data,
+            'from': self._user(user_id),
+            'message': {'message_id': 1, 'date': int(time.time()), 'text': 'menu',
+                        'chat': {'id': user_id, 'type': 'private'},
+                        'from': {'id': 1, 'is_bot': True, 'first_name': 'Bench'}}
+        }}
+
+    def join_request(self, user_id):
+        self.next_id += 1
+        return {'update_id': self.next_id, 'chat_join_request': {
+            'chat': {'id': self.channel_id, 'type': 'channel', 'title': 'Bench'},
+            'from': self._user(user_id),
+            'user_chat_id': user_id,
+            'date': int(time.time())
+        }}
+
+
+class ReferralGraph:
+    """Preferential attachment - popular referrers keep attracting referrals"""
+
+    def __init__(self, organic_ratio, rng):
+        self.organic_ratio = organic_ratio
+        self.rng = rng
+        self.users = []
+        self.weighted = []  # user appears once + once per referral received
+
+    def add(self, user_id):
+        """Add a user, return the referrer (or None for organic signups)"""
+        referrer = None
+        if self.weighted and self.rng.random() >= self.organic_ratio:
+            referrer = self.rng.choice(self.weighted)
+            self.weighted.append(referrer)
+        self.users.append(user_id)
+        self.weighted.append(user_id)
+        return referrer
+
+    def pick_user(self):
+        return self.rng.choice(self.users)
+
+
+def written_bytes():
+    """Bytes this process handed to write() so far (Linux), else None"""
+    try:
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile"""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[rank]
+
+
+def seed_users(store, graph, count, points, chunk=10000):
+    """Pre-populate the store with a referral graph, bypassing handlers"""
+    started = time.perf_counter()
+    referrals = 0
+
+    for i in range(count):
+        user_id = FIRST_USER_ID + i
+        referrer = graph.add(user_id)
+        store.create_user(str(user_id), f"user{user_id}", f"User{user_id}")
+        if referrer is not None:
+            store.add_referral(str(referrer), str(user_id), points)
+            referrals += 1
+        if (i + 1) % chunk == 0:
+            store.flush()
+
+    store.flush()
+    return {'users': count, 'referrals': referrals, 'seconds': round(time.perf_counter() - started, 3)}
+
+
+async def run_phase(application, store, request, payloads, concurrency, errors, legit=None):
+    """Process payloads, timing each update end-to-end through the Application
+    
+    legit: update_ids whose latency is also reported on its own (flood phase)
+    """
+    latencies = []
+    legit_latencies = []
+    error_count = errors['count']
+    calls_before = dict(request.calls)
+    bytes_before = written_bytes()
+    slots = asyncio.Semaphore(concurrency)
+
+    async def one(raw):
+        async with slots:
+            update = Update.de_json(raw, application.bot)
+            started = time.perf_counter()
+            await application.process_update(update)
+            latencies.append(time.perf_counter() - started)
+            if legit and raw['update_id'] in legit:
+                legit_latencies.append(latencies[-1])
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(raw) for raw in payloads))
+    # Writes count too - flush so the journal/commit cost lands in this phase
+    await store.flush_async()
+    elapsed = time.perf_counter() - started
+
+    bytes_after = written_bytes()
+    latencies.sort()
+    written = bytes_after - bytes_before if bytes_before is not None else None
+    result = {
+        'updates': len(payloads),
+        'seconds': round(elapsed, 3),
+        'throughput': round(len(payloads) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'max_ms': round(latencies[-1] * 1000, 3) if latencies else 0.0,
+        'errors': errors['count'] - error_count,
+        'bytes_written': written,
+        'bytes_per_update': round(written / len(payloads), 1) if written is not None and payloads else None,
+        'api_calls': {k: v - calls_before.get(k, 0) for k, v in request.calls.items() if v != calls_before.get(k, 0)}
+    }
+    if legit is not None:
+        legit_latencies.sort()
+        result['legit'] = {
+            'updates': len(legit_latencies),
+            'p50_ms': round(percentile(legit_latencies, 50) * 1000, 3),
+            'p95_ms': round(percentile(legit_latencies, 95) * 1000, 3),
+            'p99_ms': round(percentile(legit_latencies, 99) * 1000, 3)
+        }
+    return result
+
+
+def build_payloads(phase, factory, graph, count, next_user_id):
+    """Synthetic updates for one phase - new users follow the referral graph"""
+    payloads = []
+    for _ in range(count):
+        if phase == 'start_new':
+            user_id = next_user_id
+            next_user_id += 1
+            referrer = graph.add(user_id)
+            text = f"/start {referrer}" if referrer is not None else "/start"
+            payloads.append(factory.command(user_id, text))
+        elif phase == 'start_existing':
+            payloads.append(factory.command(graph.pick_user(), "/start"))
+        elif phase == 'status':
+            payloads.append(factory.command(graph.pick_user(), "/status"))
+        elif phase == 'home':
+            payloads.append(factory.callback(graph.pick_user(), "home"))
+        elif phase == 'join_request':
+            payloads.append(factory.join_request(graph.pick_user()))
+        elif phase == 'flood':
+            if graph.rng.random() < FLOOD_LEGIT_RATIO:
+                payloads.append(factory.command(graph.pick_user(), "/status"))
+                continue
+            flooder = next_user_id + graph.rng.randrange(FLOOD_USERS)
+            if graph.rng.random() < 0.5:
+                payloads.append(factory.command(flooder, f"/start {graph.pick_user()}"))
+            else:
+                payloads.append(factory.callback(flooder, "status"))
+    if phase == 'flood':
+        next_user_id += FLOOD_USERS
+    return payloads, next_user_id
+
+
+async def benchmark(args):
+    """Seed, boot the Application on a fake Bot, run every phase"""
+    import bot
+    from bot import CONFIG, ReferralBot
+    
+    # Same logging pipeline as the bot - per-update lines would dominate at INFO
+    # (--log-level INFO with/without --log-sample 0 measures their cost)
+    bot.setup_logging(CONFIG)
+    atexit.register(bot.stop_logging)
+    logging.getLogger().setLevel(args.log_level)
+    logging.getLogger('bot').setLevel(args.log_level)
+
+    rng = random.Random(args.seed)
+    random.seed(args.seed)
+
+    bot_instance = ReferralBot()
+    bot_instance.store.load()
+    graph = ReferralGraph(args.organic_ratio, rng)
+    seed = seed_users(bot_instance.store, graph, args.users, CONFIG['REFERRAL_POINTS'])
+    print(f"🌱 Seeded {seed['users']} users / {seed['referrals']} referrals in {seed['seconds']}s", file=sys.stderr)
+
+    request = FakeRequest(member_ratio=args.member_ratio)
+    fake_bot = Bot(CONFIG['BOT_TOKEN'], request=request, get_updates_request=FakeRequest())
+    application = Application.builder().bot(fake_bot).updater(None).build()
+    bot_instance.setup_handlers(application)
+
+    errors = {'count': 0}
+
+    async def count_error(update, context):
+        errors['count'] += 1
+
+    application.add_error_handler(count_error)
+
+    await application.initialize()
+    await bot_instance.post_init(application)
+    await application.start()
+
+    factory = UpdateFactory(CONFIG['CHANNEL_ID'])
+    next_user_id = FIRST_USER_ID + args.users
+    results = {}
+    try:
+        for phase in args.phases:
+            payloads, next_user_id = build_payloads(phase, factory, graph, args.updates, next_user_id)
+            # Flood phase: the ordinary /status traffic is what has to stay fast
+            legit = ({raw['update_id'] for raw in payloads if raw.get('message', {}).get('text') == "/status"}
+                     if phase == 'flood' else None)
+            dropped_before = bot_instance.ingress.total_dropped
+            results[phase] = await run_phase(application, bot_instance.store, request, payloads,
+                                             args.concurrency, errors, legit)
+            r = results[phase]
+            r['ingress_dropped'] = bot_instance.ingress.total_dropped - dropped_before
+            print(f"⚡ {phase:<15} {r['throughput']:>9} upd/s  p50 {r['p50_ms']}ms  "
+                  f"p95 {r['p95_ms']}ms  p99 {r['p99_ms']}ms  {r['bytes_per_update']} B/upd  "
+                  f"{r['ingress_dropped']} dropped", file=sys.stderr)
+            if 'legit' in r:
+                print(f"   {'legit /status':<15} p50 {r['legit']['p50_ms']}ms  p95 {r['legit']['p95_ms']}ms  "
+                      f"p99 {r['legit']['p99_ms']}ms", file=sys.stderr)
+    finally:
+        await application.stop()
+        await bot_instance.post_stop(application)
+        await application.shutdown()
+        await bot_instance.post_shutdown(application)
+
+    return {
+        'meta': {
+            'backend': CONFIG['STORAGE_BACKEND'],
+            'users': args.users,
+            'updates_per_phase': args.updates,
+            'concurrency': args.concurrency,
+            'seed': args.seed,
+            'python': sys.version.split()[0],
+            'timestamp': int(time.time())
+        },
+        'seed': seed,
+        'phases': results,
+        'logging': {
+            'level': args.log_level,
+            'update_sample': CONFIG['LOG_UPDATE_SAMPLE'],
+            'update_lines_written': bot.update_log.written,
+            'update_lines_sampled_out': bot.update_log.sampled_out,
+            'dropped': bot.log_handler.dropped
+        },
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+
+def write_legacy_snapshot(path, graph, count, rng):
+    """user_data.json in the original layout - string ids, ISO timestamps"""
+    referrals = {}
+    for i in range(count):
+        user_id = FIRST_USER_ID + i
+        referrer = graph.add(user_id)
+        if referrer is not None:
+            referrals.setdefault(referrer, []).append(str(user_id))
+    
+    now = time.time()
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("{")
+        for i, user_id in enumerate(graph.users):
+            registered = datetime.fromtimestamp(now - rng.randint(0, 30 * 86400)).isoformat()
+            record = {
+                'points': len(referrals.get(user_id, ())),
+                'referrals': referrals.get(user_id, []),
+                'is_approved': False,
+                'username': f"user{user_id}",
+                'first_name': f"User{user_id}",
+                'registered_at': registered,
+                'last_activity': registered
+            }
+            f.write(("," if i else "") + json.dumps(str(user_id)) + ":" + json.dumps(record))
+        f.write("}")
+
+
+def snapshot_report(users):
+    """Write + load time and file size per snapshot format"""
+    from bot import read_snapshot, snapshot_chunks, write_file_atomic
+    
+    report = {}
+    for fmt, indent in (('json', 2), ('ndjson', None)):
+        path = f"snapshot.{fmt}"
+        started = time.perf_counter()
+        write_file_atomic(path, snapshot_chunks(users, fmt, indent=indent))
+        write_seconds = time.perf_counter() - started
+        
+        started = time.perf_counter()
+        loaded = len(read_snapshot(path))
+        report[fmt] = {
+            'bytes': os.path.getsize(path),
+            'write_seconds': round(write_seconds, 3),
+            'load_seconds': round(time.perf_counter() - started, 3),
+            'users': loaded
+        }
+        os.remove(path)
+    return report
+
+
+def memory_report(args):
+    """Footprint of N synthetic users: json.load dicts vs JsonUserStore records"""
+    from bot import JsonUserStore, read_snapshot
+    
+    rng = random.Random(args.seed)
+    graph = ReferralGraph(args.organic_ratio, rng)
+    write_legacy_snapshot("user_data.json", graph, args.users, rng)
+    print(f"🌱 Wrote {args.users} users ({os.path.getsize('user_data.json')} bytes)", file=sys.stderr)
+    
+    def load_dicts():
+        with open("user_data.json", 'r', encoding='utf-8') as f:
+            return json.load(f)
+    
+    def traced():
+        return tracemalloc.get_traced_memory()[0]
+    
+    tracemalloc.start()
+    base = traced()
+    raw = load_dicts()
+    dict_bytes = traced() - base
+    
+    del raw
+    store = JsonUserStore("user_data.json", ".")
+    store.users = read_snapshot("user_data.json")
+    record_bytes = traced() - base
+    
+    store._build_indexes()
+    index_bytes = traced() - base - record_bytes
+    tracemalloc.stop()
+    
+    users = max(args.users, 1)
+    return {
+        'meta': {'users': args.users, 'seed': args.seed, 'python': sys.version.split()[0]},
+        'dict_of_dicts_bytes': dict_bytes,
+        'records_bytes': record_bytes,
+        'indexes_bytes': index_bytes,
+        'bytes_per_user': {
+            'dict_of_dicts': round(dict_bytes / users, 1),
+            'records': round(record_bytes / users, 1),
+            'records_with_indexes': round((record_bytes + index_bytes) / users, 1)
+        },
+        'snapshots': snapshot_report(store.users),
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+
+def compare(result, baseline_file, tolerance):
+    """Flag phases that got slower or write more than the baseline"""
+    with open(baseline_file, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+
+    regressions = []
+    for phase, current in result['phases'].items():
+        before = baseline.get('phases', {}).get(phase)
+        if not before:
+            continue
+        for metric in ('p95_ms', 'p99_ms', 'bytes_per_update'):
+            old, new = before.get(metric), current.get(metric)
+            if old and new is not None and new > old * (1 + tolerance):
+                regressions.append(f"{phase}.{metric}: {old} -> {new}")
+        if before.get('throughput') and current['throughput'] < before['throughput'] * (1 - tolerance):
+            regressions.append(f"{phase}.throughput: {before['throughput']} -> {current['throughput']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline handler benchmark (fake Bot, no network)")
+    parser.add_argument('--users', type=int, default=10000, help="Users seeded before measuring")
+    parser.add_argument('--updates', type=int, default=2000, help="Updates per phase")
+    parser.add_argument('--phases', nargs='+', choices=PHASES, default=PHASES)
+    parser.add_argument('--backend', choices=['json', 'sqlite'], default=os.getenv('STORAGE_BACKEND', 'json'))
+    parser.add_argument('--concurrency', type=int, default=1, help="Updates in flight at once")
+    parser.add_argument('--organic-ratio', type=float, default=0.3, help="Share of signups without a referrer")
+    parser.add_argument('--member-ratio', type=float, default=0.0, help="Share of getChatMember calls answering 'member'")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help="Write JSON result here (default: stdout)")
+    parser.add_argument('--baseline', help="Previous result JSON - exit 1 on regression")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed regression vs baseline (0.2 = 20%%)")
+    parser.add_argument('--workdir', help="Data directory (default: fresh temp dir, removed afterwards)")
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--log-sample', type=float, help="LOG_UPDATE_SAMPLE - share of per-update log lines kept")
+    parser.add_argument('--memory-report', action='store_true',
+                        help="Only measure in-memory footprint of --users records (no handlers)")
+    args = parser.parse_args()
+
+    os.environ['STORAGE_BACKEND'] = args.backend
+    if args.log_sample is not None:
+        os.environ['LOG_UPDATE_SAMPLE'] = str(args.log_sample)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="referral_bench_")
+    os.makedirs(workdir, exist_ok=True)
+    cwd = os.getcwd()
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+    os.chdir(workdir)
+    try:
+        result = memory_report(args) if args.memory_report else asyncio.run(benchmark(args))
+    finally:
+        os.chdir(cwd)
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(result, indent=2)
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if baseline and not args.memory_report:
+        regressions = compare(result, baseline, args.tolerance)
+        for line in regressions:
+            print(f"❌ Regression {line}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
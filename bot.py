@@ -5,22 +5,46 @@ Author: Your Name
 Version: 2.4 (Silent Mode)
 """
 
+import asyncio
+import atexit
 import logging
+import queue
+import random
 import json
 import os
 # Environment Variables को लोड करने के लिए यह लाइन ज़रूरी है
 from dotenv import load_dotenv 
 
 import time
+import bisect
+import re
+import gzip
+import mmap
 import shutil
+import signal
+import threading
+import multiprocessing
+import sqlite3
 import glob
+import heapq
+import hmac
+import csv
+import io
+from array import array
+from collections import OrderedDict
+from itertools import islice
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+from contextlib import asynccontextmanager, contextmanager
 from datetime import datetime, timedelta
+from urllib.parse import quote
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.helpers import escape_markdown
 from telegram.ext import (
-    Application, CommandHandler, MessageHandler, 
-    CallbackQueryHandler, ContextTypes, ChatJoinRequestHandler, filters
+    Application, ApplicationHandlerStop, CommandHandler, MessageHandler, 
+    CallbackQueryHandler, ContextTypes, ChatJoinRequestHandler, ChatMemberHandler, TypeHandler, filters
 )
-from telegram.error import BadRequest, TelegramError
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError, TimedOut
+from telegram.request import BaseRequest, HTTPXRequest
 
 load_dotenv() 
 
@@ -36,35 +60,3742 @@ CONFIG = {
     'BOT_USERNAME': os.getenv('BOT_USERNAME', "DeshiMediaHub_bot"),
     'REQUIRED_REFERRALS': int(os.getenv('REQUIRED_REFERRALS', 3)),
     'REFERRAL_POINTS': int(os.getenv('REFERRAL_POINTS', 1)),
-    'USER_RETENTION_DAYS': int(os.getenv('USER_RETENTION_DAYS', 7))
+    'USER_RETENTION_DAYS': int(os.getenv('USER_RETENTION_DAYS', 7)),
+    'CLEANUP_INTERVAL_SECONDS': int(os.getenv('CLEANUP_INTERVAL_SECONDS', 300)),
+    'CLEANUP_BATCH_SIZE': int(os.getenv('CLEANUP_BATCH_SIZE', 500)),
+    
+    # 🌐 UPDATES - 'polling' or 'webhook'
+    'UPDATE_MODE': os.getenv('UPDATE_MODE', 'polling').lower(),
+    'WEBHOOK_URL': os.getenv('WEBHOOK_URL', ''),          # public https base URL (empty = local testing, no setWebhook)
+    'WEBHOOK_LISTEN': os.getenv('WEBHOOK_LISTEN', '0.0.0.0'),
+    'WEBHOOK_PORT': int(os.getenv('WEBHOOK_PORT', 8443)),
+    'WEBHOOK_PATH': os.getenv('WEBHOOK_PATH', 'telegram'),
+    'WEBHOOK_SECRET': os.getenv('WEBHOOK_SECRET', ''),
+    'WEBHOOK_MAX_CONNECTIONS': int(os.getenv('WEBHOOK_MAX_CONNECTIONS', 40)),
+    'WEBHOOK_DRAIN_SECONDS': int(os.getenv('WEBHOOK_DRAIN_SECONDS', 15)),
+    'WEBHOOK_HEADER_TIMEOUT_SECONDS': int(os.getenv('WEBHOOK_HEADER_TIMEOUT_SECONDS', 10)),  # full request
+    'WEBHOOK_KEEPALIVE_SECONDS': int(os.getenv('WEBHOOK_KEEPALIVE_SECONDS', 30)),  # idle between requests
+    
+    # 🧩 WORKERS - Processes, each owning user_id % WORKERS (1 = single process)
+    'WORKERS': int(os.getenv('WORKERS', 1)),
+    'WORKER_QUEUE_SIZE': int(os.getenv('WORKER_QUEUE_SIZE', 10000)),
+    'WORKER_HANDOFF_RETRY_SECONDS': int(os.getenv('WORKER_HANDOFF_RETRY_SECONDS', 60)),
+    
+    # ⚡ CONCURRENCY - Max updates processed in parallel (1 = sequential)
+    'CONCURRENT_UPDATES': int(os.getenv('CONCURRENT_UPDATES', 256)),
+    
+    # ⏳ JOIN REQUESTS - Park requests below target, approve once reached
+    'JOIN_REQUEST_DEFERRED': os.getenv('JOIN_REQUEST_DEFERRED', 'true').lower() in ('1', 'true', 'yes'),
+    'JOIN_REQUEST_TTL_SECONDS': int(os.getenv('JOIN_REQUEST_TTL_SECONDS', 7 * 86400)),
+    'JOIN_REQUEST_CHECK_SECONDS': int(os.getenv('JOIN_REQUEST_CHECK_SECONDS', 600)),
+    'JOIN_APPROVAL_CONCURRENCY': int(os.getenv('JOIN_APPROVAL_CONCURRENCY', 5)),
+    
+    # 📺 MEMBERSHIP CACHE - Avoid get_chat_member on every status/refresh
+    'MEMBERSHIP_CACHE_SIZE': int(os.getenv('MEMBERSHIP_CACHE_SIZE', 10000)),
+    'MEMBERSHIP_CACHE_TTL': int(os.getenv('MEMBERSHIP_CACHE_TTL', 600)),
+    'MEMBERSHIP_CACHE_NEGATIVE_TTL': int(os.getenv('MEMBERSHIP_CACHE_NEGATIVE_TTL', 60)),
+    # Repeated status taps: one computation per user in flight, repeats inside
+    # the window only get a toast (no edit)
+    'STATUS_DEBOUNCE_SECONDS': float(os.getenv('STATUS_DEBOUNCE_SECONDS', 3)),
+    'STATUS_VIEWS_CACHE_SIZE': int(os.getenv('STATUS_VIEWS_CACHE_SIZE', 10000)),  # users remembered for the window
+    # last_activity is written at most once per user per window
+    'ACTIVITY_TOUCH_SECONDS': int(os.getenv('ACTIVITY_TOUCH_SECONDS', 300)),
+    
+    # 🛡️ INGRESS LIMITS - Over-budget updates are dropped before any handler runs
+    # Per user: RATE tokens/second, bursts up to BURST. Global: per bot, split across workers
+    # (0 = no limit at that level). The admin is never limited.
+    'INGRESS_LIMITS_ENABLED': os.getenv('INGRESS_LIMITS_ENABLED', 'true').lower() in ('1', 'true', 'yes'),
+    'INGRESS_COMMAND_USER_RATE': float(os.getenv('INGRESS_COMMAND_USER_RATE', 0.5)),
+    'INGRESS_COMMAND_USER_BURST': int(os.getenv('INGRESS_COMMAND_USER_BURST', 5)),
+    'INGRESS_COMMAND_GLOBAL_RATE': float(os.getenv('INGRESS_COMMAND_GLOBAL_RATE', 1000)),
+    'INGRESS_CALLBACK_USER_RATE': float(os.getenv('INGRESS_CALLBACK_USER_RATE', 1)),
+    'INGRESS_CALLBACK_USER_BURST': int(os.getenv('INGRESS_CALLBACK_USER_BURST', 10)),
+    'INGRESS_CALLBACK_GLOBAL_RATE': float(os.getenv('INGRESS_CALLBACK_GLOBAL_RATE', 1000)),
+    'INGRESS_JOIN_USER_RATE': float(os.getenv('INGRESS_JOIN_USER_RATE', 0.1)),
+    'INGRESS_JOIN_USER_BURST': int(os.getenv('INGRESS_JOIN_USER_BURST', 3)),
+    'INGRESS_JOIN_GLOBAL_RATE': float(os.getenv('INGRESS_JOIN_GLOBAL_RATE', 200)),
+    'INGRESS_MAX_TRACKED_USERS': int(os.getenv('INGRESS_MAX_TRACKED_USERS', 100000)),
+    # Admin digest entry when more than THRESHOLD updates were dropped in one report window
+    'INGRESS_REPORT_SECONDS': int(os.getenv('INGRESS_REPORT_SECONDS', 300)),
+    'INGRESS_ALERT_THRESHOLD': int(os.getenv('INGRESS_ALERT_THRESHOLD', 100)),
+    
+    # 📈 METRICS - Prometheus text on http://METRICS_LISTEN:METRICS_PORT/metrics
+    'METRICS_ENABLED': os.getenv('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes'),
+    'METRICS_LISTEN': os.getenv('METRICS_LISTEN', '127.0.0.1'),
+    'METRICS_PORT': int(os.getenv('METRICS_PORT', 9464)),  # + worker index in multi-worker mode
+    
+    # 🌍 TEXTS - Default language + optional translations file
+    'DEFAULT_LANGUAGE': os.getenv('DEFAULT_LANGUAGE', 'en'),
+    'LOCALES_FILE': os.getenv('LOCALES_FILE', 'locales.json'),
+    'LINK_CACHE_SIZE': int(os.getenv('LINK_CACHE_SIZE', 100000)),
+    
+    # 📤 OUTBOUND - Rate-limited notification delivery
+    'OUTBOUND_GLOBAL_RATE': float(os.getenv('OUTBOUND_GLOBAL_RATE', 25)),
+    'OUTBOUND_PER_CHAT_RATE': float(os.getenv('OUTBOUND_PER_CHAT_RATE', 1)),
+    'OUTBOUND_WORKERS': int(os.getenv('OUTBOUND_WORKERS', 8)),
+    'OUTBOUND_MAX_RETRIES': int(os.getenv('OUTBOUND_MAX_RETRIES', 5)),
+    'OUTBOUND_QUEUE_SIZE': int(os.getenv('OUTBOUND_QUEUE_SIZE', 100000)),
+    'OUTBOUND_DRAIN_SECONDS': int(os.getenv('OUTBOUND_DRAIN_SECONDS', 10)),
+    
+    # 📣 BROADCAST - /broadcast to every user, sharing the outbound rate limit
+    'BROADCAST_CONCURRENCY': int(os.getenv('BROADCAST_CONCURRENCY', 8)),
+    'BROADCAST_PAGE_SIZE': int(os.getenv('BROADCAST_PAGE_SIZE', 500)),
+    'BROADCAST_PROGRESS_SECONDS': int(os.getenv('BROADCAST_PROGRESS_SECONDS', 15)),
+    
+    # 🏆 LEADERBOARD + EXPORT - /top [n] and /export [csv|ndjson] (admin)
+    'TOP_DEFAULT_SIZE': int(os.getenv('TOP_DEFAULT_SIZE', 10)),
+    'TOP_MAX_SIZE': int(os.getenv('TOP_MAX_SIZE', 50)),
+    'EXPORT_DIR': os.getenv('EXPORT_DIR', 'exports'),
+    # Bot API upload limit - bigger exports stay in EXPORT_DIR
+    'EXPORT_MAX_UPLOAD_MB': int(os.getenv('EXPORT_MAX_UPLOAD_MB', 50)),
+    
+    # 📬 ADMIN DIGEST - Batch completion notifications
+    'ADMIN_DIGEST_ENABLED': os.getenv('ADMIN_DIGEST_ENABLED', 'true').lower() in ('1', 'true', 'yes'),
+    'ADMIN_DIGEST_INTERVAL_SECONDS': int(os.getenv('ADMIN_DIGEST_INTERVAL_SECONDS', 300)),
+    'ADMIN_DIGEST_MAX_EVENTS': int(os.getenv('ADMIN_DIGEST_MAX_EVENTS', 25)),
+    # Sent right away instead of batched: target_completed, ingress_flood (comma-separated)
+    'ADMIN_URGENT_EVENTS': {e.strip() for e in os.getenv('ADMIN_URGENT_EVENTS', '').split(',') if e.strip()},
+    
+    # 💾 STORAGE - 'json' (snapshot + journal) or 'sqlite'
+    'STORAGE_BACKEND': os.getenv('STORAGE_BACKEND', 'json').lower(),
+    'SQLITE_FILE': os.getenv('SQLITE_FILE', 'user_data.db'),
+    
+    # 💾 STORAGE - Write-behind flush settings
+    'FLUSH_INTERVAL_SECONDS': int(os.getenv('FLUSH_INTERVAL_SECONDS', 5)),
+    'FLUSH_DIRTY_THRESHOLD': int(os.getenv('FLUSH_DIRTY_THRESHOLD', 100)),
+    'COMPACT_INTERVAL_SECONDS': int(os.getenv('COMPACT_INTERVAL_SECONDS', 3600)),
+    'COMPACT_JOURNAL_BYTES': int(os.getenv('COMPACT_JOURNAL_BYTES', 5 * 1024 * 1024)),
+    
+    # 📦 BACKUPS - Scheduled snapshots (interval OR change count)
+    'BACKUP_INTERVAL_SECONDS': int(os.getenv('BACKUP_INTERVAL_SECONDS', 3600)),
+    'BACKUP_CHANGE_THRESHOLD': int(os.getenv('BACKUP_CHANGE_THRESHOLD', 1000)),
+    'BACKUP_CHECK_SECONDS': int(os.getenv('BACKUP_CHECK_SECONDS', 60)),
+    'BACKUP_RETENTION': int(os.getenv('BACKUP_RETENTION', 5)),
+    'BACKUP_COMPRESS': os.getenv('BACKUP_COMPRESS', 'false').lower() in ('1', 'true', 'yes'),
+    # Snapshot + backup file format (JSON store): 'ndjson' (fast, streaming) or 'json' (legacy layout)
+    # Reading always detects the format from the file header
+    'SNAPSHOT_FORMAT': os.getenv('SNAPSHOT_FORMAT', 'ndjson').lower(),
+    
+    # Logging - handlers only enqueue, a background thread formats + writes
+    'LOG_FILE': os.getenv('LOG_FILE', 'referral_bot.log'),
+    'LOG_LEVEL': os.getenv('LOG_LEVEL', 'INFO').upper(),
+    'LOG_FORMAT': os.getenv('LOG_FORMAT', 'text').lower(),  # 'text' or 'json' (one object per line)
+    'LOG_ROTATE': os.getenv('LOG_ROTATE', 'size').lower(),  # 'size', 'time' or 'none'
+    'LOG_MAX_BYTES': int(os.getenv('LOG_MAX_BYTES', 10 * 1024 * 1024)),
+    'LOG_ROTATE_WHEN': os.getenv('LOG_ROTATE_WHEN', 'midnight'),
+    'LOG_BACKUP_COUNT': int(os.getenv('LOG_BACKUP_COUNT', 5)),
+    'LOG_QUEUE_SIZE': int(os.getenv('LOG_QUEUE_SIZE', 10000)),  # full queue drops lines, never blocks
+    # Per-update lines (/start from, referral credited, join parked...):
+    # own level (empty = same as LOG_LEVEL) and share kept (0.0-1.0)
+    'LOG_UPDATE_LEVEL': os.getenv('LOG_UPDATE_LEVEL', '').upper(),
+    'LOG_UPDATE_SAMPLE': float(os.getenv('LOG_UPDATE_SAMPLE', 1.0)),
+    # httpx logs every Bot API call at INFO
+    'LOG_HTTP_LEVEL': os.getenv('LOG_HTTP_LEVEL', 'WARNING').upper()
 }
 # ==================== CONFIG END ====================
 
-# Logging setup
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler('referral_bot.log', encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
-logger = logging.getLogger(__name__)
+# ==================== LOGGING ====================
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per line - UpdateLog fields become top-level keys"""
+    
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage()
+        }
+        fields = getattr(record, 'fields', None)
+        if fields:
+            entry.update(fields)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class LogQueueHandler(QueueHandler):
+    """Caller side of the pipeline - merge args, enqueue, return"""
+    
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+    
+    def prepare(self, record):
+        # Args may change after the call returns - merge them now, format later
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+    
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Disk stalled - losing a log line beats stalling the event loop
+            self.dropped += 1
+
+
+class UpdateLog:
+    """High-volume per-update lines - level gate + sampling before any formatting
+    
+    Call with %-style args, never f-strings: a gated or sampled-out line then
+    costs one level check and one random(). Keyword fields become JSON keys.
+    """
+    
+    def __init__(self, target, sample_rate=1.0):
+        self.target = target
+        self.sample_rate = sample_rate
+        self.written = 0
+        self.sampled_out = 0
+    
+    def log(self, level, msg, *args, **fields):
+        if not self.target.isEnabledFor(level):
+            return
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            self.sampled_out += 1
+            return
+        self.written += 1
+        self.target.log(level, msg, *args, extra={'fields': fields} if fields else None)
+    
+    def info(self, msg, *args, **fields):
+        self.log(logging.INFO, msg, *args, **fields)
+    
+    def warning(self, msg, *args, **fields):
+        self.log(logging.WARNING, msg, *args, **fields)
+
+
+log_handler = None
+log_listener = None
+
+
+def file_log_handler(config, path):
+    """Log file handler with the configured rotation"""
+    if config['LOG_ROTATE'] == 'time':
+        return TimedRotatingFileHandler(path, when=config['LOG_ROTATE_WHEN'],
+                                        backupCount=config['LOG_BACKUP_COUNT'], encoding='utf-8')
+    if config['LOG_ROTATE'] == 'size' and config['LOG_MAX_BYTES'] > 0:
+        return RotatingFileHandler(path, maxBytes=config['LOG_MAX_BYTES'],
+                                   backupCount=config['LOG_BACKUP_COUNT'], encoding='utf-8')
+    return logging.FileHandler(path, encoding='utf-8')
+
+
+def setup_logging(config, path=None):
+    """Root logger -> queue -> listener thread -> file + console (call again to switch files)"""
+    global log_handler, log_listener
+    stop_logging()
+    
+    if config['LOG_FORMAT'] == 'json':
+        formatter = JsonLogFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handlers = [file_log_handler(config, path or config['LOG_FILE']), logging.StreamHandler()]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    log_queue = queue.Queue(config['LOG_QUEUE_SIZE'])
+    log_handler = LogQueueHandler(log_queue)
+    root.addHandler(log_handler)
+    root.setLevel(config['LOG_LEVEL'])
+    logging.getLogger('httpx').setLevel(config['LOG_HTTP_LEVEL'])
+    logging.getLogger(f"{__name__}.updates").setLevel(config['LOG_UPDATE_LEVEL'] or logging.NOTSET)
+    
+    log_listener = QueueListener(log_queue, *handlers)
+    log_listener.start()
+
+
+def stop_logging():
+    """Drain the queue and close files - also runs at exit"""
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        for handler in log_listener.handlers:
+            handler.close()
+        log_listener = None
+
+
+# Handlers are installed by main() / worker_main() - importing bot.py opens no log file
+logger = logging.getLogger(__name__)
+update_log = UpdateLog(logging.getLogger(f"{__name__}.updates"), CONFIG['LOG_UPDATE_SAMPLE'])
+
+# ==================== FILE HELPERS ====================
+def write_file_atomic(path, payload, compress=False):
+    """Write bytes (or an iterable of byte chunks) to temp file, fsync, then rename over path"""
+    tmp_file = path + ".tmp"
+    opener = gzip.open if compress else open
+    with opener(tmp_file, 'wb') as f:
+        if isinstance(payload, bytes):
+            f.write(payload)
+        else:
+            f.writelines(payload)
+    with open(tmp_file, 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_file, path)
+
+
+def read_file(path):
+    """Read bytes - transparently gunzips .gz files"""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, 'rb') as f:
+        return f.read()
+
+
+def read_json_file(path):
+    """Read JSON - transparently gunzips .gz files"""
+    return json.loads(read_file(path).decode('utf-8'))
+
+
+class AppendLog:
+    """NDJSON side file written off the event loop
+    
+    append()/rewrite() only queue the change; one background task writes
+    whatever has accumulated in a worker thread, in order, so a burst of
+    events costs one write (and one fsync if asked for). Without a running
+    loop (startup, scripts) the write happens right away.
+    """
+    
+    def __init__(self, path, fsync=False):
+        self.path = path
+        self.fsync = fsync
+        self.ops = []  # ('a', text) appends / ('w', text) full replacements
+        self.task = None
+    
+    def append(self, entry):
+        self.ops.append(('a', json.dumps(entry, ensure_ascii=False) + "\n"))
+        self._schedule()
+    
+    def rewrite(self, entries):
+        """Replace the file with entries (after everything queued before)"""
+        self.ops.append(('w', "".join(json.dumps(e, ensure_ascii=False) + "\n" for e in entries)))
+        self._schedule()
+    
+    def _schedule(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            ops, self.ops = self.ops, []
+            self._write(ops)
+            return
+        if self.task is None or self.task.done():
+            self.task = loop.create_task(self._drain())
+    
+    async def _drain(self):
+        while self.ops:
+            ops, self.ops = self.ops, []
+            await asyncio.to_thread(self._write, ops)
+    
+    async def flush(self):
+        """Wait until everything queued so far is on disk"""
+        while self.ops or (self.task is not None and not self.task.done()):
+            if self.task is None or self.task.done():
+                self.task = asyncio.get_running_loop().create_task(self._drain())
+            await asyncio.shield(self.task)
+    
+    def _write(self, ops):
+        try:
+            appended = []
+            for kind, text in ops:
+                if kind == 'w':
+                    self._append_text("".join(appended))
+                    appended = []
+                    write_file_atomic(self.path, text.encode('utf-8'))
+                else:
+                    appended.append(text)
+            self._append_text("".join(appended))
+        except Exception as e:
+            logger.error(f"❌ {os.path.basename(self.path)} persist error: {e}")
+    
+    def _append_text(self, text):
+        if not text:
+            return
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(text)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+
+
+def to_epoch(value):
+    """Epoch seconds from epoch number or legacy ISO string (None if invalid)"""
+    if value is None or isinstance(value, (int, float)):
+        return value
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return int(datetime.fromisoformat(value).timestamp())
+    except (TypeError, ValueError):
+        return None
+
+# ==================== STATISTICS ====================
+class TimeBuckets:
+    """Ring of fixed-width time buckets holding per-kind event counts"""
+    
+    def __init__(self, width, size):
+        self.width = width
+        self.size = size
+        self.slots = [None] * size
+    
+    def add(self, kind, now, count=1):
+        index = int(now // self.width)
+        slot = self.slots[index % self.size]
+        if slot is None or slot[0] != index:
+            slot = self.slots[index % self.size] = [index, {}]
+        slot[1][kind] = slot[1].get(kind, 0) + count
+    
+    def total(self, kind, window, now):
+        """Events of `kind` in the last `window` seconds (bucket resolution)"""
+        current = int(now // self.width)
+        oldest = current - min(int(window // self.width), self.size) + 1
+        return sum(slot[1].get(kind, 0) for slot in self.slots
+                   if slot is not None and oldest <= slot[0] <= current)
+
+
+class StatsTracker:
+    """Counters maintained at mutation time - /admin never scans users
+    
+    Totals describe the current data set and are rebuilt on load; trend
+    buckets only count live events since start.
+    """
+    
+    TRENDS = (("Last hour", 3600), ("Last day", 86400), ("Last week", 7 * 86400))
+    
+    def __init__(self, required_referrals):
+        self.required = required_referrals
+        self.minutes = TimeBuckets(60, 60)
+        self.hours = TimeBuckets(3600, 24 * 7)
+        # 15-minute slot -> local date string (DST/timezone offsets are multiples of 15 min)
+        self.day_of_slot = {}
+        self.reset()
+    
+    def reset(self):
+        self.total_users = 0
+        self.completed = 0
+        self.total_referrals = 0
+        self.approved = 0
+        self.registrations_per_day = {}
+    
+    def _event(self, kind):
+        now = time.time()
+        self.minutes.add(kind, now)
+        self.hours.add(kind, now)
+    
+    def count_user(self, referral_count, is_approved, registered_at):
+        """Add an existing user while (re)building totals"""
+        self.total_users += 1
+        self.total_referrals += referral_count
+        if referral_count >= self.required:
+            self.completed += 1
+        if is_approved:
+            self.approved += 1
+        if registered_at:
+            slot = int(registered_at // 900)
+            day = self.day_of_slot.get(slot)
+            if day is None:
+                day = self.day_of_slot[slot] = datetime.fromtimestamp(registered_at).strftime('%Y-%m-%d')
+            self.registrations_per_day[day] = self.registrations_per_day.get(day, 0) + 1
+    
+    def user_created(self):
+        self.total_users += 1
+        day = datetime.now().strftime('%Y-%m-%d')
+        self.registrations_per_day[day] = self.registrations_per_day.get(day, 0) + 1
+        self._event('registrations')
+    
+    def referral_added(self, new_count):
+        self.total_referrals += 1
+        self._event('referrals')
+        if new_count == self.required:
+            self.completed += 1
+            self._event('completions')
+    
+    def user_approved(self):
+        self.approved += 1
+        self._event('approvals')
+    
+    def users_removed(self, count, referrals, completed, approved):
+        self.total_users -= count
+        self.total_referrals -= referrals
+        self.completed -= completed
+        self.approved -= approved
+    
+    @property
+    def pending(self):
+        return self.total_users - self.completed
+    
+    def trend(self, kind, window):
+        now = time.time()
+        if window <= 3600:
+            return self.minutes.total(kind, window, now)
+        return self.hours.total(kind, window, now)
+    
+    def recent_days(self, days=7):
+        """[(YYYY-MM-DD, registrations)] for the last `days` days"""
+        today = datetime.now().date()
+        return [(str(d), self.registrations_per_day.get(str(d), 0))
+                for d in (today - timedelta(days=i) for i in range(days))]
+
+class Leaderboard:
+    """Top referrers, updated on every referral - top(k) in O(k)
+    
+    Users are bucketed by referral count and `levels` holds the distinct
+    counts in ascending order, so a referral only moves one user up one
+    bucket - nothing is ever re-sorted. Buckets are insertion-ordered dicts
+    (ids -> None): reading the first k is O(k), unlike a sparse set, and
+    on a tie whoever reached the count first ranks higher. Users without
+    referrals aren't tracked.
+    """
+    
+    def __init__(self):
+        self.buckets = {}
+        self.levels = []
+    
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.buckets.values())
+    
+    def clear(self):
+        self.buckets = {}
+        self.levels = []
+    
+    def update(self, user_id, old_count, new_count):
+        """Move user_id from the old_count bucket to the new_count one"""
+        if old_count > 0:
+            bucket = self.buckets.get(old_count)
+            if bucket is not None:
+                bucket.pop(user_id, None)
+                if not bucket:
+                    del self.buckets[old_count]
+                    del self.levels[bisect.bisect_left(self.levels, old_count)]
+        if new_count > 0:
+            bucket = self.buckets.get(new_count)
+            if bucket is None:
+                bucket = self.buckets[new_count] = {}
+                bisect.insort(self.levels, new_count)
+            bucket[user_id] = None
+    
+    def top(self, k):
+        """[(user_id, count)] - highest counts first"""
+        result = []
+        for count in reversed(self.levels):
+            result.extend((user_id, count) for user_id in islice(self.buckets[count], k - len(result)))
+            if len(result) >= k:
+                break
+        return result
+
+# ==================== USER STORE ====================
+class UserStore:
+    """Storage backend interface used by ReferralBot
+    
+    Records are dicts with the user_data.json fields (timestamps as epoch
+    seconds; legacy ISO strings are converted on load) plus a maintained
+    'referral_count'. Each user can be referred once, by one referrer
+    (global referred_by index). self.stats is kept up to date by every
+    mutation. Writes are buffered
+    and made durable by flush(); on_threshold is called once the number of
+    buffered writes reaches flush_threshold.
+    """
+    
+    def __init__(self, flush_threshold=100, stats=None, touch_interval=0):
+        self.flush_threshold = flush_threshold
+        # touch() writes at most once per user per touch_interval seconds
+        self.touch_interval = touch_interval
+        self.flush_requested = False
+        self.on_threshold = None
+        self.changes = 0
+        self.stats = stats or StatsTracker(0)
+        # ready: everything loaded, indexes + stats built
+        # online_event: single records can be served (may come before ready)
+        self.ready = False
+        self.ready_event = asyncio.Event()
+        self.online_event = asyncio.Event()
+        self.load_timings = {}
+    
+    def _mark_ready(self):
+        self.ready = True
+        self.online_event.set()
+        self.ready_event.set()
+    
+    async def wait_for(self, user_id):
+        """Wait until user_id's record can be served"""
+        if not self.online_event.is_set():
+            await self.online_event.wait()
+    
+    async def wait_ready(self):
+        """Wait until all data is loaded - referral checks, stats, expiry"""
+        if not self.ready:
+            await self.ready_event.wait()
+    
+    def _note_writes(self, count):
+        self.changes += 1
+        if (count >= self.flush_threshold and
+                self.on_threshold and not self.flush_requested):
+            self.flush_requested = True
+            self.on_threshold()
+    
+    def __contains__(self, user_id):
+        raise NotImplementedError
+    
+    def __len__(self):
+        raise NotImplementedError
+    
+    def get(self, user_id):
+        """Get user record (or None)"""
+        raise NotImplementedError
+    
+    def items(self):
+        """Iterate over (user_id, record) pairs"""
+        raise NotImplementedError
+    
+    def referred_by(self, user_id):
+        """Referrer who got credit for user_id (or None)"""
+        raise NotImplementedError
+    
+    def create_user(self, user_id, username, first_name):
+        """Register a new user - returns the record"""
+        raise NotImplementedError
+    
+    def add_referral(self, referrer_id, user_id, points):
+        """Credit referral to referrer - returns False if user_id was
+        already referred (by this or any other referrer)"""
+        raise NotImplementedError
+    
+    def add_points(self, user_id, points):
+        """Change user's points"""
+        raise NotImplementedError
+    
+    def mark_referred(self, user_id, referrer_id):
+        """Record on user_id's own record that a referrer on another worker
+        credited it (referred_by answers from it) - False if no record yet"""
+        raise NotImplementedError
+    
+    def touch(self, user_id):
+        """Update last activity (throttled to once per touch_interval)"""
+        raise NotImplementedError
+    
+    def mark_approved(self, user_id):
+        """Mark user as approved for channel"""
+        raise NotImplementedError
+    
+    def mark_blocked(self, user_id, blocked=True):
+        """Flag a user who blocked the bot (blocked=False clears it)"""
+        raise NotImplementedError
+    
+    def recipients(self, after, limit, pass_id=None):
+        """Up to `limit` user ids > after, ascending, users who blocked the bot left out
+        (pass_id identifies the broadcast - a new one sees users registered since)"""
+        raise NotImplementedError
+    
+    def top_referrers(self, k):
+        """[(user_id, referral_count)] for the k users with most referrals"""
+        raise NotImplementedError
+    
+    def export_users(self, batch_size):
+        """Async iterator of user row batches (EXPORT_USER_FIELDS order) -
+        the loop is free between batches"""
+        raise NotImplementedError
+    
+    def export_referrals(self, batch_size):
+        """Async iterator of (referrer_id, referred_id) batches"""
+        raise NotImplementedError
+    
+    def remove(self, user_id):
+        """Delete user record"""
+        raise NotImplementedError
+    
+    def remove_expired(self, cutoff, limit):
+        """Delete up to `limit` users with last_activity < cutoff (epoch),
+        oldest first - returns count"""
+        raise NotImplementedError
+    
+    def load(self):
+        """Open storage - called once at startup"""
+        raise NotImplementedError
+    
+    async def load_async(self):
+        """Open storage from the running loop - big stores override this
+        to come online before everything is loaded"""
+        started = time.perf_counter()
+        self.load()
+        self.load_timings['load'] = time.perf_counter() - started
+    
+    def flush(self):
+        """Make buffered writes durable (blocking)"""
+        raise NotImplementedError
+    
+    async def flush_async(self):
+        """Make buffered writes durable without blocking the loop"""
+        return self.flush()
+    
+    def pending_count(self):
+        """Buffered writes not yet durable"""
+        return 0
+    
+    def should_compact(self, max_bytes):
+        """True if the write log has grown past max_bytes"""
+        return False
+    
+    async def compact(self):
+        """Fold write log into main storage"""
+        return True
+    
+    async def write_backup(self, path, compress=False):
+        """Write a consistent snapshot of all data to path"""
+        raise NotImplementedError
+    
+    async def restore_backup(self, path):
+        """Replace all data with the snapshot at path"""
+        raise NotImplementedError
+    
+    def close(self):
+        """Flush and release storage"""
+        raise NotImplementedError
+
+
+def user_key(user_id):
+    """Store key for a user id ('123' / 123 -> 123, junk -> None)"""
+    try:
+        return int(user_id)
+    except (TypeError, ValueError):
+        return None
+
+
+class UserRecord:
+    """Compact in-memory user record (JsonUserStore)
+    
+    Slots instead of a dict, referrals as an int64 array (None until the
+    first one). Reads like the user_data.json dict - record['points'],
+    record.get('first_name') - so handlers don't care. from_dict/to_dict
+    convert losslessly; unknown JSON keys are kept in `extra`.
+    """
+    
+    __slots__ = ('points', 'referral_count', 'is_approved', 'username', 'first_name',
+                 'registered_at', 'last_activity', 'approved_at', 'referral_ids', 'extra')
+    
+    FIELDS = ('points', 'referral_count', 'is_approved', 'username', 'first_name',
+              'registered_at', 'last_activity', 'approved_at')
+    
+    def __init__(self, username=None, first_name=None, registered_at=None):
+        self.points = 0
+        self.referral_count = 0
+        self.is_approved = False
+        self.username = username
+        self.first_name = first_name
+        self.registered_at = registered_at
+        self.last_activity = registered_at
+        self.approved_at = None
+        self.referral_ids = None
+        self.extra = None
+    
+    def __getitem__(self, key):
+        if key == 'referrals':
+            return [str(r) for r in self.referral_ids or ()]
+        if key in self.FIELDS:
+            value = getattr(self, key)
+            if value is None and key in ('registered_at', 'last_activity', 'approved_at'):
+                # Absent in the JSON record too
+                raise KeyError(key)
+            return value
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+    
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+    
+    def add_referral(self, referred_id):
+        if self.referral_ids is None:
+            self.referral_ids = array('q')
+        self.referral_ids.append(referred_id)
+        self.referral_count += 1
+    
+    @classmethod
+    def from_dict(cls, info):
+        """user_data.json record -> UserRecord (legacy ISO timestamps converted)"""
+        record = cls(info.get('username'), info.get('first_name'), to_epoch(info.get('registered_at')))
+        record.last_activity = to_epoch(info.get('last_activity'))
+        record.approved_at = to_epoch(info.get('approved_at'))
+        record.points = info.get('points', 0)
+        record.is_approved = info.get('is_approved', False)
+        
+        referrals = [user_key(r) for r in info.get('referrals', [])]
+        # Same user listed twice is legacy noise - count it once
+        referrals = list(dict.fromkeys(r for r in referrals if r is not None))
+        if referrals:
+            record.referral_ids = array('q', referrals)
+        record.referral_count = len(referrals)
+        
+        extra = {k: v for k, v in info.items() if k not in cls.FIELDS and k != 'referrals'}
+        record.extra = extra or None
+        return record
+    
+    def to_dict(self):
+        """UserRecord -> user_data.json record"""
+        info = {
+            'points': self.points,
+            'referrals': self['referrals'],
+            'referral_count': self.referral_count,
+            'is_approved': self.is_approved,
+            'username': self.username,
+            'first_name': self.first_name
+        }
+        for field in ('registered_at', 'last_activity', 'approved_at'):
+            value = getattr(self, field)
+            if value is not None:
+                info[field] = value
+        if self.extra:
+            info.update(self.extra)
+        return info
+    
+    # Positional snapshot row - referral_count is len(referrals)
+    ROW = ('id', 'points', 'is_approved', 'username', 'first_name',
+           'registered_at', 'last_activity', 'approved_at', 'referrals', 'extra')
+    
+    @classmethod
+    def from_row(cls, row):
+        """Snapshot row -> (int id, UserRecord)"""
+        record = cls(row[3], row[4], row[5])
+        record.points = row[1]
+        record.is_approved = row[2]
+        record.last_activity = row[6]
+        record.approved_at = row[7]
+        if row[8]:
+            record.referral_ids = array('q', row[8])
+            record.referral_count = len(row[8])
+        record.extra = row[9] or None
+        return row[0], record
+    
+    def to_row(self, user_id):
+        """UserRecord -> snapshot row"""
+        return [user_id, self.points, self.is_approved, self.username, self.first_name,
+                self.registered_at, self.last_activity, self.approved_at,
+                self.referral_ids.tolist() if self.referral_ids else [], self.extra]
+
+class JsonUserStore(UserStore):
+    """In-memory user store - snapshot + append-only journal
+    
+    Every mutation is applied in memory and appended as one compact journal
+    record. Pending records are written in the background (write-behind);
+    compaction folds the journal into a fresh snapshot.
+    
+    In memory users are UserRecords keyed by int id, self.referrers maps
+    referred user -> referrer (ints), rebuilt from the persisted referral
+    lists (plus the 'referred_by' key of users credited by another worker)
+    at load time. self.expiry buckets users by last_activity
+    (expiry_bucket_seconds wide) so expiry never scans. Snapshots are
+    NDJSON rows (see SNAPSHOTS) or the legacy user_data.json layout,
+    per snapshot_format; either one loads.
+    
+    Journal ops (one JSON array per line, replay is idempotent):
+        ["c", user_id, username, first_name, ts]   user created
+        ["r", referrer_id, user_id]                 referral added
+        ["p", user_id, points]                      points set
+        ["a", user_id, ts]                          approved
+        ["t", user_id, ts]                          activity touched
+        ["b", user_id, ts]                          blocked the bot (ts null = unblocked)
+        ["m", user_id, referrer_id]                 referred via another worker
+        ["d", user_id]                              user removed
+    """
+    
+    def __init__(self, data_file, backup_dir, flush_threshold=100, stats=None,
+                 expiry_bucket_seconds=3600, snapshot_format='ndjson', touch_interval=0):
+        super().__init__(flush_threshold, stats, touch_interval)
+        self.data_file = data_file
+        self.snapshot_format = snapshot_format
+        self.expiry_width = expiry_bucket_seconds
+        self.journal_file = data_file + ".journal"
+        self.backup_dir = backup_dir
+        self.users = {}
+        self.referrers = {}
+        self.expiry = {}
+        self.leaderboard = Leaderboard()
+        # Broadcast pass: sorted ids + last cursor (see recipients)
+        self.recipient_ids = None
+        self.recipient_pass = None
+        self.pending = []
+        self.journal = None
+        self.journal_size = 0
+        self.io_lock = asyncio.Lock()
+        # While warming up: user id -> row offset in the mmapped snapshot
+        self.offsets = None
+        self.snapshot_map = None
+    
+    def __contains__(self, user_id):
+        key = user_key(user_id)
+        return key in self.users or (self.offsets is not None and key in self.offsets)
+    
+    def __len__(self):
+        return len(self.users) + len(self.offsets or ())
+    
+    def get(self, user_id):
+        """Get user record (or None)"""
+        return self._record(user_id)
+    
+    def items(self):
+        """Iterate over (user_id, record) pairs - complete once ready"""
+        return ((str(user_id), record) for user_id, record in self.users.items())
+    
+    def _record(self, user_id):
+        """Record by id - while warming up, decoded from the snapshot on first use"""
+        key = user_key(user_id)
+        record = self.users.get(key)
+        if record is None and self.offsets and key in self.offsets:
+            record = self._materialize(key)
+        return record
+    
+    def _materialize(self, key):
+        """Decode one snapshot row via the offset index"""
+        start = self.offsets.pop(key)
+        end = self.snapshot_map.find(b"\n", start)
+        try:
+            _, record = UserRecord.from_row(json.loads(self.snapshot_map[start:end if end >= 0 else None]))
+        except (ValueError, IndexError, TypeError):
+            logger.warning(f"⚠️ Skipping bad snapshot row for {key}")
+            return None
+        self.users[key] = record
+        return record
+    
+    def _commit(self, op):
+        """Apply op in memory and queue it for the journal - False if it changed nothing"""
+        if not self._apply(op):
+            return False
+        self.pending.append(json.dumps(op, separators=(',', ':'), ensure_ascii=False) + "\n")
+        self._note_writes(len(self.pending))
+        return True
+    
+    def _apply(self, op):
+        """Apply a single journal op - also used for replay. False if skipped"""
+        kind, user_id = op[0], int(op[1])
+        
+        if kind == 'c':
+            # Already there = replaying a journal the snapshot already holds
+            # (compaction crashed before removing journal.1) - recreating would
+            # reset the record while referrers still says "credited"
+            if self._record(user_id) is not None:
+                return False
+            created_at = to_epoch(op[4])
+            self.users[user_id] = UserRecord(op[2], op[3], created_at)
+            self._reindex_activity(user_id, None, created_at)
+            return True
+        
+        user_info = self._record(user_id)
+        if user_info is None:
+            return False
+        
+        if kind == 'r':
+            referred_id = int(op[2])
+            if referred_id in (user_info.referral_ids or ()):
+                # Already in this record: a snapshot written during compaction can hold
+                # credits journalled after it started ("d A" then "r B U" - B has U, while
+                # A's stale copy won U in referrers until "d A" dropped it)
+                self.referrers[referred_id] = user_id
+                return False
+            # referrers doubles as the "already credited" check - replay stays idempotent.
+            # While warming up it is incomplete - the record's own list decides
+            if self.offsets is None and referred_id in self.referrers:
+                return False
+            user_info.add_referral(referred_id)
+            self.referrers[referred_id] = user_id
+            self.leaderboard.update(user_id, user_info.referral_count - 1, user_info.referral_count)
+        elif kind == 'p':
+            user_info.points = op[2]
+        elif kind == 'a':
+            user_info.is_approved = True
+            user_info.approved_at = to_epoch(op[2])
+        elif kind == 't':
+            touched_at = to_epoch(op[2])
+            self._reindex_activity(user_id, user_info.last_activity, touched_at)
+            user_info.last_activity = touched_at
+        elif kind == 'b':
+            # Kept with the unknown JSON keys - snapshot layout unchanged
+            extra = user_info.extra or {}
+            if op[2] is None:
+                extra.pop('blocked_at', None)
+            else:
+                extra['blocked_at'] = op[2]
+            user_info.extra = extra or None
+        elif kind == 'm':
+            if user_id in self.referrers:
+                return False
+            # Unknown JSON key like blocked_at - the referrer's record lives on its worker
+            user_info.extra = dict(user_info.extra or {}, referred_by=int(op[2]))
+            self.referrers[user_id] = int(op[2])
+        elif kind == 'd':
+            self._reindex_activity(user_id, user_info.last_activity, None)
+            remote = (user_info.extra or {}).get('referred_by')
+            if remote is not None and self.referrers.get(user_id) == remote:
+                del self.referrers[user_id]
+            self.leaderboard.update(user_id, user_info.referral_count, 0)
+            for referred_id in user_info.referral_ids or ():
+                if self.referrers.get(referred_id) == user_id:
+                    del self.referrers[referred_id]
+            del self.users[user_id]
+        return True
+    
+    def _reindex_activity(self, user_id, old, new):
+        """Move user between expiry buckets"""
+        if old is not None:
+            index = int(old // self.expiry_width)
+            bucket = self.expiry.get(index)
+            if bucket is not None:
+                bucket.discard(user_id)
+                if not bucket:
+                    del self.expiry[index]
+        if new is not None:
+            self.expiry.setdefault(int(new // self.expiry_width), set()).add(user_id)
+    
+    # ---------- Mutations ----------
+    
+    def create_user(self, user_id, username, first_name):
+        """Register a new user"""
+        if self._commit(['c', user_id, username, first_name, int(time.time())]):
+            self.stats.user_created()
+        return self._record(user_id)
+    
+    def referred_by(self, user_id):
+        referrer_id = self.referrers.get(user_key(user_id))
+        return str(referrer_id) if referrer_id is not None else None
+    
+    def add_referral(self, referrer_id, user_id, points):
+        """Credit referral to referrer - O(1) duplicate check"""
+        if int(user_id) in self.referrers:
+            return False
+        # Skipped while warming up when the referrer's record already holds it
+        if not self._commit(['r', referrer_id, user_id]):
+            return False
+        self.stats.referral_added(self.users[int(referrer_id)].referral_count)
+        self.add_points(referrer_id, points)
+        return True
+    
+    def add_points(self, user_id, points):
+        """Change user's points"""
+        user_info = self._record(user_id)
+        if user_info is not None:
+            self._commit(['p', user_id, user_info.points + points])
+    
+    def mark_referred(self, user_id, referrer_id):
+        if self._record(user_id) is None:
+            return False
+        if int(user_id) not in self.referrers:
+            self._commit(['m', user_id, int(referrer_id)])
+        return True
+    
+    def touch(self, user_id):
+        """Update last activity - no journal record if touched recently"""
+        user_info = self._record(user_id)
+        if user_info is None:
+            return
+        now = int(time.time())
+        if user_info.last_activity is not None and now - user_info.last_activity < self.touch_interval:
+            return
+        self._commit(['t', user_id, now])
+    
+    def mark_approved(self, user_id):
+        """Mark user as approved for channel"""
+        user_info = self._record(user_id)
+        if user_info is None:
+            return
+        if not user_info.is_approved:
+            self.stats.user_approved()
+        self._commit(['a', user_id, int(time.time())])
+    
+    def mark_blocked(self, user_id, blocked=True):
+        """Flag a user who blocked the bot - no journal record if unchanged"""
+        user_info = self._record(user_id)
+        if user_info is None or blocked == ('blocked_at' in (user_info.extra or ())):
+            return
+        self._commit(['b', user_id, int(time.time()) if blocked else None])
+    
+    def recipients(self, after, limit, pass_id=None):
+        """Pages from a sorted id array, bisected from the cursor
+        
+        The array is built once per pass_id (one broadcast) - users
+        registering later are left to the next broadcast.
+        """
+        if self.recipient_ids is None or pass_id != self.recipient_pass:
+            self.recipient_ids = array('q', sorted(self.users))
+            self.recipient_pass = pass_id
+        
+        ids = self.recipient_ids
+        page = []
+        position = bisect.bisect_right(ids, after)
+        while position < len(ids) and len(page) < limit:
+            user_id = ids[position]
+            user_info = self.users.get(user_id)
+            if user_info is not None and not (user_info.extra and 'blocked_at' in user_info.extra):
+                page.append(user_id)
+            position += 1
+        return page
+    
+    def top_referrers(self, k):
+        return self.leaderboard.top(k)
+    
+    async def export_users(self, batch_size):
+        """Batches from a frozen id list (8 bytes/user) - users removed meanwhile are skipped"""
+        ids = array('q', self.users)
+        for start in range(0, len(ids), batch_size):
+            rows = []
+            for user_id in ids[start:start + batch_size]:
+                user_info = self.users.get(user_id)
+                if user_info is not None:
+                    rows.append((user_id, user_info.username, user_info.first_name, user_info.points,
+                                 user_info.referral_count, user_info.is_approved, user_info.registered_at,
+                                 user_info.last_activity, user_info.approved_at,
+                                 (user_info.extra or {}).get('blocked_at')))
+            yield rows
+    
+    async def export_referrals(self, batch_size):
+        ids = array('q', self.users)
+        rows = []
+        for user_id in ids:
+            user_info = self.users.get(user_id)
+            if user_info is not None and user_info.referral_ids:
+                rows.extend((user_id, referred_id) for referred_id in user_info.referral_ids)
+            if len(rows) >= batch_size:
+                yield rows
+                rows = []
+        if rows:
+            yield rows
+    
+    def remove(self, user_id):
+        """Delete user record"""
+        user_info = self._record(user_id)
+        if user_info is not None:
+            count = user_info.referral_count
+            self.stats.users_removed(1, count, int(count >= self.stats.required),
+                                     int(bool(user_info.is_approved)))
+            self._commit(['d', str(user_id)])
+    
+    def remove_expired(self, cutoff, limit):
+        """Walk the oldest expiry buckets - no scan, no date parsing"""
+        if not self.ready:
+            # Buckets are built once warm-up is done
+            return 0
+        removed = 0
+        cutoff_index = int(cutoff // self.expiry_width)
+        
+        for index in sorted(i for i in self.expiry if i <= cutoff_index):
+            bucket = self.expiry.get(index)
+            if index < cutoff_index:
+                # Whole bucket is expired
+                while bucket and removed < limit:
+                    self.remove(bucket.pop())
+                    removed += 1
+            elif bucket:
+                # Boundary bucket - check exact timestamps
+                expired = [u for u in bucket if self.users[u].last_activity < cutoff]
+                for user_id in expired[:limit - removed]:
+                    self.remove(user_id)
+                    removed += 1
+            if removed >= limit:
+                break
+        
+        return removed
+    
+    # ---------- Persistence ----------
+    
+    def load(self):
+        """Load snapshot and replay journal on top - called once at startup"""
+        self.users = self._read_snapshot()
+        self._build_indexes()
+        
+        replayed = 0
+        # journal.1 = rotated journal of an interrupted compaction
+        for path in (self.journal_file + ".1", self.journal_file):
+            replayed += self._replay(path)
+        
+        self._build_stats()
+        self.pending = []
+        self._open_journal()
+        self._mark_ready()
+        logger.info(f"📂 Loaded {len(self.users)} users ({replayed} journal records replayed)")
+    
+    async def load_async(self):
+        """Come online fast, load the rest in the background
+        
+        An NDJSON snapshot is mmapped and indexed first (user id -> row
+        offset, ids sliced out of the bytes, no JSON decoding). The journal
+        is replayed on just the users it touches, and from then on get()
+        decodes any other user straight from the mmap on first use - the
+        store is online. Remaining rows are decoded in a worker thread and
+        merged chunk by chunk; referral/expiry indexes and stats are built
+        once all are in (ready). Legacy JSON snapshots can't be indexed and
+        load whole in a worker thread.
+        """
+        timings = self.load_timings
+        phase_started = time.perf_counter()
+        
+        def phase(name):
+            nonlocal phase_started
+            now = time.perf_counter()
+            timings[name] = now - phase_started
+            phase_started = now
+        
+        indexed = (os.path.exists(self.data_file) and os.path.getsize(self.data_file) > 0 and
+                   snapshot_format(self.data_file) == 'ndjson')
+        if indexed:
+            self.snapshot_map, offsets = await asyncio.to_thread(self._index_snapshot)
+            self.users = {}
+            self.offsets = offsets
+            phase('index')
+        else:
+            self.users = await asyncio.to_thread(self._read_snapshot)
+            self._build_indexes()
+            phase('snapshot')
+        
+        replayed = 0
+        for path in (self.journal_file + ".1", self.journal_file):
+            lines = await asyncio.to_thread(self._read_journal, path)
+            replayed += self._apply_lines(lines, path)
+        self.pending = []
+        self._open_journal()
+        self.online_event.set()
+        phase('journal')
+        
+        if indexed:
+            rows = iter_snapshot(self.data_file)
+            while True:
+                chunk = await asyncio.to_thread(list, islice(rows, SNAPSHOT_CHUNK_ROWS))
+                if not chunk:
+                    break
+                for key, record in chunk:
+                    # Already decoded on demand (and maybe changed since) - keep that one
+                    if self.offsets.pop(key, None) is not None:
+                        self.users[key] = record
+            self.offsets = None
+            self.snapshot_map.close()
+            self.snapshot_map = None
+            phase('records')
+            self._build_indexes()
+        
+        self._build_stats()
+        self._mark_ready()
+        phase('indexes')
+        logger.info(f"📂 Loaded {len(self.users)} users ({replayed} journal records replayed) - "
+                    + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items()))
+    
+    def _index_snapshot(self):
+        """mmap the NDJSON snapshot, map user id -> row offset"""
+        with open(self.data_file, 'rb') as f:
+            snapshot_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        
+        offsets = {}
+        size = len(snapshot_map)
+        # Row 0 is the header
+        position = snapshot_map.find(b"\n") + 1
+        while 0 < position < size:
+            end = snapshot_map.find(b"\n", position)
+            if end < 0:
+                end = size
+            # Rows start with "[<id>,"
+            comma = snapshot_map.find(b",", position, end)
+            try:
+                offsets[int(snapshot_map[position + 1:comma])] = position
+            except ValueError:
+                if end > position:
+                    logger.warning(f"⚠️ Skipping bad snapshot row at byte {position}")
+            position = end + 1
+        return snapshot_map, offsets
+    
+    def _open_journal(self):
+        self.journal = open(self.journal_file, 'a', encoding='utf-8')
+        self.journal_size = self.journal.tell()
+    
+    def _build_indexes(self):
+        """referred_by map, expiry buckets and leaderboard"""
+        self.referrers = {}
+        self.expiry = {}
+        self.leaderboard.clear()
+        for user_id, user_info in self.users.items():
+            self._reindex_activity(user_id, None, user_info.last_activity)
+            self.leaderboard.update(user_id, 0, user_info.referral_count)
+            for referred_id in user_info.referral_ids or ():
+                # Legacy data may credit a user twice - first referrer keeps it
+                self.referrers.setdefault(referred_id, user_id)
+            if user_info.extra and 'referred_by' in user_info.extra:
+                self.referrers.setdefault(user_id, user_info.extra['referred_by'])
+    
+    def _build_stats(self):
+        """One pass over all users after load/restore"""
+        self.stats.reset()
+        for user_info in self.users.values():
+            self.stats.count_user(user_info.referral_count,
+                                  user_info.is_approved,
+                                  user_info.registered_at)
+    
+    def serialize(self, indent=2):
+        """Snapshot in the configured format, as lazy byte chunks for a worker thread
+        
+        Only the ids are frozen on the loop (8 bytes/user, no records
+        copied). A record changed while the thread writes may already carry
+        mutations journalled after this point - replaying them on top is
+        idempotent, so the snapshot + journal pair stays correct.
+        """
+        return snapshot_chunks(self.users, self.snapshot_format, indent=indent, ids=array('q', self.users))
+    
+    def _read_snapshot(self):
+        if not os.path.exists(self.data_file) or os.path.getsize(self.data_file) == 0:
+            return {}
+        
+        try:
+            return read_snapshot(self.data_file)
+        except Exception as e:
+            logger.error(f"❌ Load error: {e}")
+            return {}
+    
+    def _replay(self, path):
+        return self._apply_lines(self._read_journal(path), path)
+    
+    def _read_journal(self, path):
+        """Complete journal lines (a torn tail is cut off the file)"""
+        if not os.path.exists(path):
+            return []
+        
+        lines = []
+        valid_bytes = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # Torn last line after a crash - everything before it is intact
+                    logger.warning(f"⚠️ Dropping torn journal record in {path}")
+                    break
+                lines.append(line)
+                valid_bytes += len(line)
+        
+        if valid_bytes < os.path.getsize(path):
+            os.truncate(path, valid_bytes)
+        return lines
+    
+    def _apply_lines(self, lines, path):
+        replayed = 0
+        for line in lines:
+            try:
+                self._apply(json.loads(line))
+                replayed += 1
+            except (ValueError, IndexError):
+                logger.warning(f"⚠️ Skipping bad journal record in {path}")
+        return replayed
+    
+    def _write_journal(self, lines):
+        try:
+            self.journal.write("".join(lines))
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+            self.journal_size = self.journal.tell()
+            return True
+        except Exception as e:
+            logger.error(f"❌ Journal write error: {e}")
+            return False
+    
+    def _take_pending(self):
+        lines = self.pending
+        self.pending = []
+        self.flush_requested = False
+        return lines
+    
+    def flush(self):
+        """Append pending journal records (blocking)"""
+        if not self.pending or self.journal is None:
+            return True
+        lines = self._take_pending()
+        if not self._write_journal(lines):
+            self.pending[:0] = lines
+            return False
+        return True
+    
+    async def flush_async(self):
+        """Append pending journal records in a worker thread"""
+        async with self.io_lock:
+            if not self.pending or self.journal is None:
+                return True
+            lines = self._take_pending()
+            if not await asyncio.to_thread(self._write_journal, lines):
+                # Keep records so next flush retries them
+                self.pending[:0] = lines
+                return False
+            return True
+    
+    def pending_count(self):
+        return len(self.pending)
+    
+    def should_compact(self, max_bytes):
+        return self.journal_size >= max_bytes
+    
+    async def compact(self):
+        """Fold the journal into a new snapshot"""
+        async with self.io_lock:
+            if self.journal is None or not self.ready:
+                return False
+            
+            # Everything up to now goes into this snapshot
+            lines = self._take_pending()
+            if lines and not await asyncio.to_thread(self._write_journal, lines):
+                self.pending[:0] = lines
+                return False
+            if self.journal_size == 0:
+                return True
+            
+            # Records committed meanwhile stay in pending - they belong to the new journal
+            await asyncio.to_thread(self._rotate_journal)
+            
+            payload = self.serialize()
+            return await asyncio.to_thread(self._write_snapshot, payload)
+    
+    def _rotate_journal(self):
+        """Move journal to journal.1 - new mutations go to a fresh file"""
+        self.journal.close()
+        rotated = self.journal_file + ".1"
+        if os.path.exists(rotated):
+            # Previous compaction failed - keep its records too
+            with open(rotated, 'a', encoding='utf-8') as dst, \
+                    open(self.journal_file, 'r', encoding='utf-8') as src:
+                shutil.copyfileobj(src, dst)
+            os.remove(self.journal_file)
+        else:
+            os.replace(self.journal_file, rotated)
+        self.journal = open(self.journal_file, 'a', encoding='utf-8')
+        self.journal_size = 0
+    
+    def _write_snapshot(self, payload):
+        try:
+            write_file_atomic(self.data_file, payload)
+            os.remove(self.journal_file + ".1")
+            
+            logger.info("🗜️ Journal compacted into snapshot")
+            return True
+        except Exception as e:
+            # journal.1 stays on disk and is replayed on next start
+            logger.error(f"❌ Compaction error: {e}")
+            return False
+    
+    async def write_backup(self, path, compress=False):
+        """Serialize + write + rename in a worker thread (see serialize)"""
+        await self.wait_ready()
+        await asyncio.to_thread(write_file_atomic, path, self.serialize(indent=None), compress)
+    
+    async def restore_backup(self, path):
+        """Load backup (either format) as the new snapshot and start an empty journal"""
+        await self.wait_ready()
+        users = await asyncio.to_thread(read_snapshot, path)
+        
+        async with self.io_lock:
+            self.users = users
+            self._build_indexes()
+            self._build_stats()
+            self.pending = []
+            payload = self.serialize()
+            await asyncio.to_thread(write_file_atomic, self.data_file, payload)
+            
+            self.journal.close()
+            self.journal = open(self.journal_file, 'w', encoding='utf-8')
+            self.journal_size = 0
+            if os.path.exists(self.journal_file + ".1"):
+                os.remove(self.journal_file + ".1")
+        
+        self.changes += 1
+        logger.info(f"♻️ Restored {len(self.users)} users from {path}")
+    
+    def close(self):
+        """Flush pending records and close the journal"""
+        self.flush()
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        if self.snapshot_map is not None:
+            # Stopped while warming up - everything is in snapshot + journal anyway
+            self.snapshot_map.close()
+            self.snapshot_map = None
+            self.offsets = None
+
+class SqliteUserStore(UserStore):
+    """SQLite user store (WAL mode) - indexed lookups, no full-file scans
+    
+    Statements run immediately on the connection; flush() commits the open
+    transaction, so the write-behind interval/threshold still applies.
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id       INTEGER PRIMARY KEY,
+            points        INTEGER NOT NULL DEFAULT 0,
+            referral_count INTEGER NOT NULL DEFAULT 0,
+            is_approved   INTEGER NOT NULL DEFAULT 0,
+            username      TEXT,
+            first_name    TEXT,
+            registered_at REAL,
+            last_activity REAL,
+            approved_at   REAL,
+            blocked_at    REAL,
+            referred_by   INTEGER   -- referrer on another worker (WORKERS > 1)
+        );
+        CREATE TABLE IF NOT EXISTS referrals (
+            referrer_id INTEGER NOT NULL,
+            referred_id INTEGER NOT NULL,
+            created_at  REAL,
+            PRIMARY KEY (referrer_id, referred_id)   -- also the referrer_id index
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_referrals_referred ON referrals(referred_id);
+        CREATE INDEX IF NOT EXISTS idx_users_last_activity ON users(last_activity);
+        CREATE INDEX IF NOT EXISTS idx_users_referral_count ON users(referral_count);
+    """
+    
+    USER_COLUMNS = ("user_id, points, is_approved, username, first_name, "
+                    "registered_at, last_activity, approved_at, referral_count")
+    
+    def __init__(self, db_file, backup_dir, flush_threshold=100, stats=None, touch_interval=0):
+        super().__init__(flush_threshold, stats, touch_interval)
+        self.db_file = db_file
+        self.backup_dir = backup_dir
+        self.conn = None
+        self.pending_writes = 0
+    
+    def _execute(self, sql, params=()):
+        cursor = self.conn.execute(sql, params)
+        self.pending_writes += 1
+        self._note_writes(self.pending_writes)
+        return cursor
+    
+    def _row_to_record(self, row):
+        record = {
+            'points': row[1],
+            'referral_count': row[8],
+            'is_approved': bool(row[2]),
+            'username': row[3],
+            'first_name': row[4],
+            'registered_at': row[5],
+            'last_activity': row[6]
+        }
+        if row[7]:
+            record['approved_at'] = row[7]
+        return record
+    
+    def __contains__(self, user_id):
+        return self.conn.execute(
+            "SELECT 1 FROM users WHERE user_id = ?", (int(user_id),)
+        ).fetchone() is not None
+    
+    def __len__(self):
+        return self.stats.total_users
+    
+    def get(self, user_id):
+        row = self.conn.execute(
+            f"SELECT {self.USER_COLUMNS} FROM users WHERE user_id = ?", (int(user_id),)
+        ).fetchone()
+        return self._row_to_record(row) if row else None
+    
+    def items(self):
+        for row in self.conn.execute(f"SELECT {self.USER_COLUMNS} FROM users").fetchall():
+            yield str(row[0]), self._row_to_record(row)
+    
+    # ---------- Mutations ----------
+    
+    def create_user(self, user_id, username, first_name):
+        now = int(time.time())
+        cursor = self._execute(
+            "INSERT INTO users (user_id, points, is_approved, username, first_name, "
+            "registered_at, last_activity) VALUES (?, 0, 0, ?, ?, ?, ?) "
+            "ON CONFLICT(user_id) DO NOTHING",
+            (int(user_id), username, first_name, now, now)
+        )
+        if cursor.rowcount:
+            self.stats.user_created()
+        return self.get(user_id)
+    
+    def referred_by(self, user_id):
+        row = self.conn.execute(
+            "SELECT referrer_id FROM referrals WHERE referred_id = ? "
+            "UNION ALL SELECT referred_by FROM users WHERE user_id = ? AND referred_by IS NOT NULL "
+            "LIMIT 1", (int(user_id), int(user_id))
+        ).fetchone()
+        return str(row[0]) if row else None
+    
+    def add_referral(self, referrer_id, user_id, points):
+        """Indexed duplicate check on referred_id"""
+        if self.referred_by(user_id) is not None:
+            return False
+        self._execute(
+            "INSERT INTO referrals (referrer_id, referred_id, created_at) VALUES (?, ?, ?)",
+            (int(referrer_id), int(user_id), int(time.time()))
+        )
+        self._execute(
+            "UPDATE users SET referral_count = referral_count + 1 WHERE user_id = ?",
+            (int(referrer_id),)
+        )
+        self.stats.referral_added(self.conn.execute(
+            "SELECT referral_count FROM users WHERE user_id = ?", (int(referrer_id),)
+        ).fetchone()[0])
+        self.add_points(referrer_id, points)
+        return True
+    
+    def add_points(self, user_id, points):
+        self._execute(
+            "UPDATE users SET points = points + ? WHERE user_id = ?", (points, int(user_id))
+        )
+    
+    def mark_referred(self, user_id, referrer_id):
+        if user_id not in self:
+            return False
+        if self.referred_by(user_id) is None:
+            self._execute(
+                "UPDATE users SET referred_by = ? WHERE user_id = ?", (int(referrer_id), int(user_id))
+            )
+        return True
+    
+    def touch(self, user_id):
+        now = int(time.time())
+        cursor = self.conn.execute(
+            "UPDATE users SET last_activity = ? WHERE user_id = ? "
+            "AND (last_activity IS NULL OR last_activity <= ?)",
+            (now, int(user_id), now - self.touch_interval)
+        )
+        # Touched recently - nothing written, nothing to flush
+        if cursor.rowcount:
+            self.pending_writes += 1
+            self._note_writes(self.pending_writes)
+    
+    def mark_approved(self, user_id):
+        cursor = self._execute(
+            "UPDATE users SET is_approved = 1, approved_at = ? WHERE user_id = ? AND is_approved = 0",
+            (int(time.time()), int(user_id))
+        )
+        if cursor.rowcount:
+            self.stats.user_approved()
+    
+    def mark_blocked(self, user_id, blocked=True):
+        if blocked:
+            self._execute("UPDATE users SET blocked_at = ? WHERE user_id = ?",
+                          (int(time.time()), int(user_id)))
+            return
+        cursor = self.conn.execute(
+            "UPDATE users SET blocked_at = NULL WHERE user_id = ? AND blocked_at IS NOT NULL",
+            (int(user_id),)
+        )
+        # Usually nobody to unblock - nothing written
+        if cursor.rowcount:
+            self.pending_writes += 1
+            self._note_writes(self.pending_writes)
+    
+    def recipients(self, after, limit, pass_id=None):
+        """Range scan on the primary key"""
+        return [row[0] for row in self.conn.execute(
+            "SELECT user_id FROM users WHERE user_id > ? AND blocked_at IS NULL ORDER BY user_id LIMIT ?",
+            (after, limit)
+        )]
+    
+    def top_referrers(self, k):
+        """Backwards walk of the referral_count index - k rows read"""
+        return self.conn.execute(
+            "SELECT user_id, referral_count FROM users WHERE referral_count > 0 "
+            "ORDER BY referral_count DESC LIMIT ?", (k,)
+        ).fetchall()
+    
+    async def export_users(self, batch_size):
+        """Keyset pages on the primary key - no long-lived cursor across awaits"""
+        after = -1
+        while True:
+            rows = self.conn.execute(
+                "SELECT user_id, username, first_name, points, referral_count, is_approved, "
+                "registered_at, last_activity, approved_at, blocked_at FROM users "
+                "WHERE user_id > ? ORDER BY user_id LIMIT ?", (after, batch_size)
+            ).fetchall()
+            if not rows:
+                return
+            yield [row[:5] + (bool(row[5]),) + row[6:] for row in rows]
+            after = rows[-1][0]
+    
+    async def export_referrals(self, batch_size):
+        after = (-1, -1)
+        while True:
+            rows = self.conn.execute(
+                "SELECT referrer_id, referred_id FROM referrals WHERE (referrer_id, referred_id) > (?, ?) "
+                "ORDER BY referrer_id, referred_id LIMIT ?", (*after, batch_size)
+            ).fetchall()
+            if not rows:
+                return
+            yield rows
+            after = rows[-1]
+    
+    def _count_removed(self, where, params):
+        """Feed stats with the aggregate of rows about to be deleted"""
+        row = self.conn.execute(
+            "SELECT COUNT(*), TOTAL(referral_count), TOTAL(referral_count >= ?), TOTAL(is_approved) "
+            f"FROM users WHERE {where}", (self.stats.required, *params)
+        ).fetchone()
+        self.stats.users_removed(row[0], int(row[1]), int(row[2]), int(row[3]))
+    
+    def remove(self, user_id):
+        self._count_removed("user_id = ?", (int(user_id),))
+        self._execute("DELETE FROM users WHERE user_id = ?", (int(user_id),))
+        self._execute("DELETE FROM referrals WHERE referrer_id = ?", (int(user_id),))
+    
+    def remove_expired(self, cutoff, limit):
+        """Oldest-first batch from the last_activity index"""
+        user_ids = [row[0] for row in self.conn.execute(
+            "SELECT user_id FROM users WHERE last_activity < ? ORDER BY last_activity LIMIT ?",
+            (cutoff, limit)
+        )]
+        if not user_ids:
+            return 0
+        
+        marks = ",".join("?" * len(user_ids))
+        self._count_removed(f"user_id IN ({marks})", user_ids)
+        self._execute(f"DELETE FROM referrals WHERE referrer_id IN ({marks})", user_ids)
+        return self._execute(f"DELETE FROM users WHERE user_id IN ({marks})", user_ids).rowcount
+    
+    # ---------- Persistence ----------
+    
+    def load(self):
+        self.conn = sqlite3.connect(self.db_file, isolation_level="DEFERRED")
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._migrate_schema()
+        self.conn.executescript(self.SCHEMA)
+        self.conn.commit()
+        self._build_stats()
+        self._mark_ready()
+        logger.info(f"📂 SQLite store opened: {self.db_file} ({self.stats.total_users} users)")
+    
+    def _build_stats(self):
+        """Aggregate queries once at open/restore - then maintained live"""
+        self.stats.reset()
+        row = self.conn.execute(
+            "SELECT COUNT(*), TOTAL(referral_count), TOTAL(referral_count >= ?), TOTAL(is_approved) "
+            "FROM users", (self.stats.required,)
+        ).fetchone()
+        self.stats.total_users = row[0]
+        self.stats.total_referrals = int(row[1])
+        self.stats.completed = int(row[2])
+        self.stats.approved = int(row[3])
+        for day, count in self.conn.execute(
+            "SELECT date(registered_at, 'unixepoch', 'localtime'), COUNT(*) FROM users GROUP BY 1"
+        ):
+            if day:
+                self.stats.registrations_per_day[day] = count
+    
+    def _migrate_schema(self):
+        """Upgrade databases created by older versions"""
+        columns = {row[1]: row[2] for row in self.conn.execute("PRAGMA table_info(users)")}
+        if columns and 'blocked_at' not in columns:
+            self.conn.execute("ALTER TABLE users ADD COLUMN blocked_at REAL")
+        if columns and 'referred_by' not in columns:
+            self.conn.execute("ALTER TABLE users ADD COLUMN referred_by INTEGER")
+        if columns and 'referral_count' not in columns:
+            self.conn.execute(
+                "ALTER TABLE users ADD COLUMN referral_count INTEGER NOT NULL DEFAULT 0"
+            )
+            self._recount_referrals()
+        if columns.get('last_activity', '').upper() == 'TEXT':
+            self._migrate_timestamps()
+    
+    def _migrate_timestamps(self):
+        """ISO TEXT timestamp columns -> REAL epoch (table rebuild)"""
+        logger.info("🔧 Converting SQLite timestamps to epoch...")
+        self.conn.execute("ALTER TABLE users RENAME TO users_old")
+        self.conn.execute("ALTER TABLE referrals RENAME TO referrals_old")
+        self.conn.execute("DROP INDEX IF EXISTS idx_users_last_activity")
+        self.conn.execute("DROP INDEX IF EXISTS idx_users_referral_count")
+        self.conn.execute("DROP INDEX IF EXISTS idx_referrals_referred")
+        self.conn.executescript(self.SCHEMA)
+        
+        rows = self.conn.execute(f"SELECT {self.USER_COLUMNS} FROM users_old")
+        self.conn.executemany(
+            f"INSERT INTO users ({self.USER_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            ((r[0], r[1], r[2], r[3], r[4], to_epoch(r[5]), to_epoch(r[6]), to_epoch(r[7]), r[8])
+             for r in rows.fetchall())
+        )
+        rows = self.conn.execute("SELECT referrer_id, referred_id, created_at FROM referrals_old")
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO referrals (referrer_id, referred_id, created_at) VALUES (?, ?, ?)",
+            ((r[0], r[1], to_epoch(r[2])) for r in rows.fetchall())
+        )
+        self.conn.execute("DROP TABLE users_old")
+        self.conn.execute("DROP TABLE referrals_old")
+        self.conn.commit()
+    
+    def _recount_referrals(self):
+        self.conn.execute(
+            "UPDATE users SET referral_count = "
+            "(SELECT COUNT(*) FROM referrals WHERE referrer_id = users.user_id)"
+        )
+    
+    def pending_count(self):
+        return self.pending_writes
+    
+    def flush(self):
+        if not self.pending_writes or self.conn is None:
+            return True
+        try:
+            self.conn.commit()
+            self.pending_writes = 0
+            self.flush_requested = False
+            return True
+        except Exception as e:
+            logger.error(f"❌ Save error: {e}")
+            return False
+    
+    async def compact(self):
+        """Commit and checkpoint the WAL back into the main database"""
+        if self.conn is None:
+            return False
+        self.flush()
+        await asyncio.to_thread(self._checkpoint)
+        return True
+    
+    def _checkpoint(self):
+        # Own connection - the checkpoint is database-wide and self.conn stays on the loop
+        conn = sqlite3.connect(self.db_file)
+        try:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        finally:
+            conn.close()
+    
+    async def write_backup(self, path, compress=False):
+        """Online backup from a separate read connection in a worker thread"""
+        self.flush()
+        await asyncio.to_thread(self._backup_to, path, compress)
+    
+    def _backup_to(self, path, compress):
+        tmp_db = path + ".db.tmp"
+        source = sqlite3.connect(self.db_file)
+        target = sqlite3.connect(tmp_db)
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
+        
+        try:
+            with open(tmp_db, 'rb') as f:
+                write_file_atomic(path, f.read(), compress)
+        finally:
+            os.remove(tmp_db)
+    
+    async def restore_backup(self, path):
+        """Copy backup into the live database via the backup API"""
+        tmp_db = self.db_file + ".restore.tmp"
+        payload = await asyncio.to_thread(read_file, path)
+        await asyncio.to_thread(write_file_atomic, tmp_db, payload)
+        
+        self.flush()
+        try:
+            await asyncio.to_thread(self._restore_from, tmp_db)
+        finally:
+            os.remove(tmp_db)
+        
+        self._build_stats()
+        self.changes += 1
+        logger.info(f"♻️ Restored {len(self)} users from {path}")
+    
+    def _restore_from(self, tmp_db):
+        # Separate connection to the live file - SQLite locking keeps self.conn consistent
+        source = sqlite3.connect(tmp_db)
+        target = sqlite3.connect(self.db_file)
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
+    
+    def close(self):
+        if self.conn is not None:
+            self.flush()
+            self.conn.close()
+            self.conn = None
+    
+    # ---------- Migration ----------
+    
+    def import_records(self, users, overwrite=True, referral_points=0):
+        """Bulk import user_data.json-style records - returns (count, dropped)
+        
+        A user can only be referred once. Legacy data may list a user under
+        several referrers: like JsonUserStore, the first referrer keeps it.
+        The others lose the edge and referral_points per dropped edge;
+        dropped is a list of (referred, kept referrer, dropped referrer).
+        """
+        verb = "INSERT OR REPLACE" if overwrite else "INSERT OR IGNORE"
+        imported = 0
+        dropped = []
+        
+        try:
+            for user_id, info in users.items():
+                if not str(user_id).isdigit():
+                    continue
+                lost = 0
+                for referred in info.get('referrals', []):
+                    if not str(referred).isdigit():
+                        continue
+                    row = self.conn.execute(
+                        "SELECT referrer_id FROM referrals WHERE referred_id = ?", (int(referred),)
+                    ).fetchone()
+                    if row is None:
+                        self.conn.execute(
+                            "INSERT INTO referrals (referrer_id, referred_id) VALUES (?, ?)",
+                            (int(user_id), int(referred))
+                        )
+                    elif row[0] != int(user_id):
+                        dropped.append((str(referred), str(row[0]), str(user_id)))
+                        lost += 1
+                self.conn.execute(
+                    f"{verb} INTO users (user_id, points, is_approved, username, first_name, "
+                    "registered_at, last_activity, approved_at, blocked_at, referred_by) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (int(user_id), max(0, info.get('points', 0) - lost * referral_points),
+                     int(bool(info.get('is_approved'))),
+                     info.get('username'), info.get('first_name'), to_epoch(info.get('registered_at')),
+                     to_epoch(info.get('last_activity')), to_epoch(info.get('approved_at')),
+                     info.get('blocked_at'), info.get('referred_by'))
+                )
+                imported += 1
+        except Exception:
+            self.conn.rollback()
+            raise
+        
+        self._recount_referrals()
+        self.conn.commit()
+        self._build_stats()
+        return imported, dropped
+
+# ==================== SNAPSHOTS ====================
+# NDJSON snapshot: one header line, then one positional JSON array per user
+#   RBSNAP 1 ["id","points",...]
+#   [123,5,false,"alice","Alice",1700000000,1700000500,null,[456,789],null]
+# No outer object - written as a stream of chunks, read line by line through
+# mmap straight into UserRecords. Legacy user_data.json files start with '{',
+# gzip backups with 1f 8b - the header decides, not the file name.
+SNAPSHOT_MAGIC = b"RBSNAP 1"
+SNAPSHOT_CHUNK_ROWS = 10000
+
+
+def snapshot_format(path):
+    """'ndjson' or 'json' from the first bytes of the file (gzip-aware)"""
+    with open(path, 'rb') as f:
+        head = f.read(len(SNAPSHOT_MAGIC))
+    if head.startswith(b"\x1f\x8b"):
+        with gzip.open(path, 'rb') as f:
+            head = f.read(len(SNAPSHOT_MAGIC))
+    return 'ndjson' if head == SNAPSHOT_MAGIC else 'json'
+
+
+def _snapshot_rows(lines, path):
+    """Header check + one UserRecord per row line"""
+    header = next(lines, b"")
+    if not header.startswith(SNAPSHOT_MAGIC):
+        raise ValueError(f"{path}: not a snapshot")
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            yield UserRecord.from_row(json.loads(line))
+        except (ValueError, IndexError, TypeError):
+            logger.warning(f"⚠️ Skipping bad snapshot row in {path}")
+
+
+def iter_snapshot(path):
+    """Stream (int id, UserRecord) pairs from any snapshot/backup file
+    
+    NDJSON is read through mmap (gzip through the decompressor) one line at
+    a time - no full-file string, no intermediate dicts. Legacy JSON has to
+    be parsed whole, then each dict is converted and dropped.
+    """
+    if snapshot_format(path) == 'json':
+        users = read_json_file(path)
+        for user_id in list(users):
+            info = users.pop(user_id)
+            key = user_key(user_id)
+            if key is None:
+                logger.warning(f"⚠️ Skipping non-numeric user id {user_id!r}")
+                continue
+            yield key, UserRecord.from_dict(info)
+        return
+    
+    with open(path, 'rb') as f:
+        if f.read(2) == b"\x1f\x8b":
+            f.seek(0)
+            with gzip.open(f, 'rb') as gz:
+                yield from _snapshot_rows(iter(gz), path)
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield from _snapshot_rows(iter(mm.readline, b""), path)
+
+
+def read_snapshot(path):
+    """{int id: UserRecord} from any snapshot/backup file"""
+    return dict(iter_snapshot(path))
+
+
+def _snapshot_records(users, ids):
+    """(id, record) pairs - from a frozen id list if given, skipping ids removed since"""
+    if ids is None:
+        yield from users.items()
+        return
+    for user_id in ids:
+        record = users.get(user_id)
+        if record is not None:
+            yield user_id, record
+
+
+def snapshot_chunks(users, fmt='ndjson', indent=None, ids=None):
+    """Serialize {int id: UserRecord} -> byte chunks, produced lazily
+    
+    Meant to be consumed by write_file_atomic in a worker thread, so the
+    encoding never blocks the loop and only one chunk (SNAPSHOT_CHUNK_ROWS
+    rows) is held at a time. Pass `ids` (a frozen array of the keys) when
+    the loop keeps mutating users meanwhile.
+    """
+    if fmt == 'json':
+        yield json.dumps(
+            {str(user_id): record.to_dict() for user_id, record in _snapshot_records(users, ids)},
+            indent=indent, ensure_ascii=False
+        ).encode('utf-8')
+        return
+    
+    dumps = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False).encode
+    yield SNAPSHOT_MAGIC + b" " + dumps(list(UserRecord.ROW)).encode('utf-8') + b"\n"
+    rows = []
+    for user_id, record in _snapshot_records(users, ids):
+        rows.append(dumps(record.to_row(user_id)))
+        if len(rows) >= SNAPSHOT_CHUNK_ROWS:
+            rows.append("")
+            yield "\n".join(rows).encode('utf-8')
+            rows = []
+    if rows:
+        rows.append("")
+        yield "\n".join(rows).encode('utf-8')
+
+# ==================== EXPORT ====================
+# Admin /export: two gzipped files per run - users and referral edges - as
+# CSV (header row) or NDJSON (one object per row). Timestamps are epoch seconds.
+EXPORT_USER_FIELDS = ('user_id', 'username', 'first_name', 'points', 'referral_count', 'is_approved',
+                      'registered_at', 'last_activity', 'approved_at', 'blocked_at')
+EXPORT_REFERRAL_FIELDS = ('referrer_id', 'referred_id')
+EXPORT_BATCH_ROWS = 5000
+
+
+def encode_export_rows(rows, fields, fmt):
+    """Row tuples -> CSV lines or NDJSON objects (bytes)"""
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator="\n").writerows(rows)
+        return buffer.getvalue().encode('utf-8')
+    dumps = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False).encode
+    return "".join(dumps(dict(zip(fields, row))) + "\n" for row in rows).encode('utf-8')
+
+
+def _write_export_batch(out, rows, fields, fmt):
+    out.write(encode_export_rows(rows, fields, fmt))
+
+
+async def write_export(batches, path, fields, fmt='csv'):
+    """Stream row batches into a gzipped export file - returns the row count
+    
+    Batches are read from the store on the loop; encoding and compression
+    run in a worker thread one batch at a time, so memory holds a single
+    batch and updates are handled in between. Written to path.tmp and
+    renamed once complete.
+    """
+    tmp = path + ".tmp"
+    count = 0
+    out = await asyncio.to_thread(gzip.open, tmp, 'wb')
+    try:
+        if fmt == 'csv':
+            await asyncio.to_thread(_write_export_batch, out, [fields], fields, fmt)
+        async for rows in batches:
+            await asyncio.to_thread(_write_export_batch, out, rows, fields, fmt)
+            count += len(rows)
+        await asyncio.to_thread(out.close)
+        os.replace(tmp, path)
+    except BaseException:
+        out.close()
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return count
+
+# ==================== CONCURRENCY ====================
+class KeyedLocks:
+    """Per-key asyncio locks (per user / per referrer)
+    
+    Multiple keys are always acquired in sorted order, so two handlers
+    locking the same pair can never deadlock. Locks are dropped as soon
+    as nobody holds or waits for them.
+    """
+    
+    def __init__(self):
+        self.locks = {}
+        self.users = {}
+    
+    @asynccontextmanager
+    async def hold(self, *keys):
+        keys = sorted(set(keys))
+        for key in keys:
+            if key not in self.locks:
+                self.locks[key] = asyncio.Lock()
+                self.users[key] = 0
+            self.users[key] += 1
+        
+        acquired = []
+        try:
+            for key in keys:
+                await self.locks[key].acquire()
+                acquired.append(key)
+            yield
+        finally:
+            for key in reversed(acquired):
+                self.locks[key].release()
+            for key in keys:
+                self.users[key] -= 1
+                if self.users[key] == 0:
+                    del self.locks[key]
+                    del self.users[key]
+    
+    def __len__(self):
+        return len(self.locks)
+
+
+class SingleFlight:
+    """Per-key request coalescing with a short debounce window
+    
+    Concurrent run() calls for one key share a single computation; its
+    result stays fresh for `window` seconds and is handed out again
+    instead of recomputing. None results are never kept.
+    """
+    
+    def __init__(self, window=2.0, max_size=10000):
+        self.window = window
+        self.max_size = max_size
+        self.inflight = {}
+        self.results = OrderedDict()
+        self.computed = 0
+        self.coalesced = 0
+    
+    def fresh(self, key):
+        """Result computed inside the window (or None)"""
+        entry = self.results.get(key)
+        if entry is None:
+            return None
+        if entry[1] > time.monotonic():
+            return entry[0]
+        del self.results[key]
+        return None
+    
+    def debounced(self, key):
+        """True if key was computed inside the window - the caller skips the work"""
+        if self.fresh(key) is None:
+            return False
+        self.coalesced += 1
+        return True
+    
+    async def run(self, key, compute):
+        """(result, shared) - shared: another caller's computation was reused"""
+        result = self.fresh(key)
+        if result is not None:
+            self.coalesced += 1
+            return result, True
+        
+        task = self.inflight.get(key)
+        shared = task is not None
+        if shared:
+            self.coalesced += 1
+        else:
+            self.computed += 1
+            task = asyncio.ensure_future(compute())
+            self.inflight[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+        # A cancelled caller must not cancel the computation others wait on
+        return await asyncio.shield(task), shared
+    
+    def _finish(self, key, task):
+        del self.inflight[key]
+        if task.cancelled() or task.exception() is not None or task.result() is None:
+            return
+        if self.window > 0:
+            self.results[key] = (task.result(), time.monotonic() + self.window)
+            self.results.move_to_end(key)
+            while len(self.results) > self.max_size:
+                self.results.popitem(last=False)
+    
+    def forget(self, key):
+        """Data behind key changed - next run() recomputes"""
+        self.results.pop(key, None)
+
+# ==================== RATE LIMITING ====================
+class TokenBucket:
+    """Token bucket - `rate` tokens/second, bursts up to `capacity`"""
+    
+    # One per active user in IngressLimiter
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+    
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def try_acquire(self, tokens=1):
+        """Take tokens if available right now"""
+        self._refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+    
+    async def acquire(self, tokens=1):
+        """Wait until tokens are available, then take them"""
+        while not self.try_acquire(tokens):
+            await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+
+def ingress_kind(update):
+    """Budget an incoming update is charged to - None = never limited"""
+    if update.callback_query:
+        return 'callback'
+    if update.chat_join_request:
+        return 'join_request'
+    if update.message:
+        return 'command'
+    # chat_member updates come from Telegram itself, not from the user
+    return None
+
+
+class IngressLimiter:
+    """Ingress budgets - token buckets per user and per bot, one set per update kind
+    
+    budgets = {kind: (user_rate, user_burst, global_rate)}, a rate of 0 means
+    no limit at that level. The user bucket is checked first so a single
+    flooder drains only their own budget, not everyone's. Buckets are kept
+    for the most recent max_users users - an evicted user comes back full.
+    """
+    
+    SCOPES = ('user', 'global')
+    
+    def __init__(self, budgets, max_users=100000):
+        self.budgets = budgets
+        self.max_users = max_users
+        self.user_buckets = OrderedDict()
+        self.global_buckets = {
+            kind: TokenBucket(global_rate)
+            for kind, (_, _, global_rate) in budgets.items() if global_rate > 0
+        }
+        self.allowed = dict.fromkeys(budgets, 0)
+        self.dropped = {(kind, scope): 0 for kind in budgets for scope in self.SCOPES}
+        # Drops since the last report - {user_id: count}
+        self.offenders = {}
+        self.window_dropped = 0
+    
+    def reject(self, kind, user_id):
+        """None if the update fits its budgets, else the scope that ran out"""
+        budget = self.budgets.get(kind)
+        if budget is None:
+            return None
+        
+        user_rate, user_burst, _ = budget
+        scope = None
+        if user_rate > 0:
+            key = (kind, user_id)
+            bucket = self.user_buckets.get(key)
+            if bucket is None:
+                bucket = self.user_buckets[key] = TokenBucket(user_rate, user_burst)
+                if len(self.user_buckets) > self.max_users:
+                    self.user_buckets.popitem(last=False)
+            else:
+                self.user_buckets.move_to_end(key)
+            if not bucket.try_acquire():
+                scope = 'user'
+        
+        if scope is None:
+            bucket = self.global_buckets.get(kind)
+            if bucket is None or bucket.try_acquire():
+                self.allowed[kind] += 1
+                return None
+            scope = 'global'
+        
+        self.dropped[(kind, scope)] += 1
+        self.window_dropped += 1
+        if user_id in self.offenders or len(self.offenders) < self.max_users:
+            self.offenders[user_id] = self.offenders.get(user_id, 0) + 1
+        return scope
+    
+    @property
+    def total_dropped(self):
+        return sum(self.dropped.values())
+    
+    def take_window(self, top=5):
+        """(drops since last call, [(user_id, drops)] worst first) - starts a new window"""
+        dropped, offenders = self.window_dropped, self.offenders
+        self.window_dropped, self.offenders = 0, {}
+        return dropped, heapq.nlargest(top, offenders.items(), key=lambda item: item[1])
+
+
+class OutboundQueue:
+    """Background message delivery - global + per-chat rate limits
+    
+    Handlers enqueue and return immediately. A message whose chat isn't
+    due yet (per-chat pacing, network-error backoff) is parked on a timer
+    and requeued when it is, so one busy chat never holds a worker while
+    other chats wait. RetryAfter pauses all sends. Once max_size messages
+    are queued or parked, send() refuses new ones and counts them.
+    """
+    
+    def __init__(self, global_rate=25, per_chat_rate=1, workers=8,
+                 max_retries=5, max_size=100000):
+        # Unbounded - the size limit is checked in send(), so requeues never fail
+        self.queue = asyncio.Queue()
+        self.max_size = max_size
+        self.global_limiter = TokenBucket(global_rate)
+        self.chat_interval = 1 / per_chat_rate
+        self.chat_next = {}
+        self.worker_count = workers
+        self.max_retries = max_retries
+        self.paused_until = 0
+        self.workers = []
+        # timer handle -> parked item
+        self.deferred = {}
+        self.bot = None
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.dropped = 0
+        self.full = False
+    
+    def __len__(self):
+        """Messages waiting - queued or parked"""
+        return self.queue.qsize() + len(self.deferred)
+    
+    def send(self, chat_id, text, **kwargs):
+        """Queue a send_message call - never blocks the caller. False if the queue is full"""
+        return self._put({'chat_id': chat_id, 'text': text, 'kwargs': kwargs, 'attempt': 0, 'slot': None})
+    
+    async def deliver(self, chat_id, text, **kwargs):
+        """Queue a send_message call and wait for the outcome - True once sent"""
+        done = asyncio.get_running_loop().create_future()
+        if not self._put({'chat_id': chat_id, 'text': text, 'kwargs': kwargs, 'attempt': 0, 'slot': None,
+                          'done': done}):
+            return False
+        return await done
+    
+    def _put(self, item):
+        if len(self) >= self.max_size:
+            self.dropped += 1
+            if not self.full:
+                # Once per episode - a flood would otherwise flood the log too
+                self.full = True
+                logger.warning(f"⚠️ Outbound queue full ({self.max_size}) - dropping messages")
+            return False
+        if self.full:
+            self.full = False
+            logger.info(f"📤 Outbound queue accepting again ({self.dropped} dropped so far)")
+        self.queue.put_nowait(item)
+        return True
+    
+    def start(self, bot):
+        self.bot = bot
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.worker_count)]
+    
+    async def stop(self, drain_timeout=10):
+        """Drain queued messages (up to drain_timeout), then stop workers"""
+        if self.workers:
+            try:
+                await asyncio.wait_for(self.queue.join(), drain_timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"⚠️ Outbound drain timed out - {len(self)} messages dropped")
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        
+        # Nobody will send these - don't leave deliver() callers waiting
+        for handle in self.deferred:
+            handle.cancel()
+        items = list(self.deferred.values())
+        self.deferred = {}
+        while not self.queue.empty():
+            items.append(self.queue.get_nowait())
+        for item in items:
+            self._resolve(item, False)
+    
+    def _reserve(self, item):
+        """Seconds until this item's chat slot - reserves the slot on first call"""
+        now = time.monotonic()
+        if item['slot'] is None:
+            chat_id = item['chat_id']
+            item['slot'] = max(now, self.chat_next.get(chat_id, 0))
+            self.chat_next[chat_id] = item['slot'] + self.chat_interval
+            
+            if len(self.chat_next) > 10000:
+                for key in [k for k, t in self.chat_next.items() if t < now]:
+                    del self.chat_next[key]
+        return item['slot'] - now
+    
+    def _defer(self, item, delay):
+        """Park item off the queue - still counted by queue.join() until done"""
+        handle = asyncio.get_running_loop().call_later(delay, self._requeue, item)
+        self.deferred[handle] = item
+        item['handle'] = handle
+    
+    def _requeue(self, item):
+        del self.deferred[item.pop('handle')]
+        self.queue.put_nowait(item)
+        # The put above counted it again
+        self.queue.task_done()
+    
+    def _resolve(self, item, sent):
+        done = item.get('done')
+        if done is not None and not done.done():
+            done.set_result(sent)
+    
+    async def _worker(self):
+        while True:
+            item = await self.queue.get()
+            try:
+                delay = self._reserve(item)
+                if delay > 0:
+                    self._defer(item, delay)
+                    continue
+                sent = await self._deliver(item)
+                if sent is None:
+                    # Network error - back off, then a fresh chat slot
+                    item['slot'] = None
+                    self._defer(item, min(2 ** (item['attempt'] - 1), 30))
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("❌ Outbound worker error: %s", e)
+                sent = False
+            self._resolve(item, sent)
+            self.queue.task_done()
+    
+    async def _deliver(self, item):
+        """One attempt - True sent, False given up, None retry later"""
+        while True:
+            pause = self.paused_until - time.monotonic()
+            if pause > 0:
+                # Flood limit is per bot - nothing can be sent anyway
+                await asyncio.sleep(pause)
+            await self.global_limiter.acquire()
+            
+            try:
+                await self.bot.send_message(chat_id=item['chat_id'], text=item['text'], **item['kwargs'])
+                self.sent += 1
+                return True
+            except RetryAfter as e:
+                # Pause everyone, then retry
+                self.paused_until = time.monotonic() + e.retry_after
+                logger.warning("⏳ Flood limit - pausing sends for %ss", e.retry_after)
+                item['attempt'] += 1
+                self.retried += 1
+            except BadRequest as e:
+                # BadRequest is a NetworkError subclass but retrying won't help
+                self.failed += 1
+                logger.error("❌ Send to %s failed: %s", item['chat_id'], e)
+                return False
+            except (TimedOut, NetworkError) as e:
+                if item['attempt'] >= self.max_retries:
+                    self.failed += 1
+                    logger.error("❌ Send to %s failed after %s retries: %s", item['chat_id'], item['attempt'], e)
+                    return False
+                item['attempt'] += 1
+                self.retried += 1
+                return None
+            except TelegramError as e:
+                # Blocked / chat not found / bad markup - retrying won't help
+                self.failed += 1
+                logger.error("❌ Send to %s failed: %s", item['chat_id'], e)
+                return False
+
+# ==================== ADMIN DIGEST ====================
+class AdminDigest:
+    """Collects admin events and sends them as one digest message
+    
+    Events are appended to an NDJSON file as they arrive and the file is
+    only cleared after the digest was delivered, so a restart loses
+    nothing. Writes go through an AppendLog, off the event loop.
+    on_threshold is called once max_events are pending.
+    """
+    
+    MAX_LINES = 40
+    
+    def __init__(self, events_file, max_events=25):
+        self.events_file = events_file
+        self.log = AppendLog(events_file)
+        self.max_events = max_events
+        self.events = []
+        self.on_threshold = None
+        self.flush_requested = False
+        self.sending = False
+        
+        if os.path.exists(events_file):
+            with open(events_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        self.events.append(json.loads(line))
+                    except ValueError:
+                        continue
+            if self.events:
+                logger.info(f"📬 {len(self.events)} digest events recovered")
+    
+    def add(self, event):
+        """Queue event dict (needs 'text') for the next digest"""
+        self.events.append(event)
+        self.log.append(event)
+        
+        if (len(self.events) >= self.max_events and
+                self.on_threshold and not self.flush_requested):
+            self.flush_requested = True
+            self.on_threshold()
+    
+    def render(self, events):
+        lines = [f"📬 **ADMIN DIGEST** - {len(events)} event{'s' if len(events) > 1 else ''}", ""]
+        for event in events[:self.MAX_LINES]:
+            lines.append(event['text'])
+        if len(events) > self.MAX_LINES:
+            lines.append(f"… and {len(events) - self.MAX_LINES} more")
+        return "\n".join(lines)
+    
+    async def flush(self, outbound, chat_id):
+        """Send pending events as one message via the outbound queue - kept on failure"""
+        if not self.events or self.sending:
+            return False
+        
+        self.sending = True
+        self.flush_requested = False
+        events = list(self.events)
+        try:
+            sent = await outbound.deliver(chat_id, self.render(events), parse_mode='Markdown')
+        except Exception as e:
+            logger.error(f"❌ Admin digest error: {e}")
+            return False
+        finally:
+            self.sending = False
+        if not sent:
+            return False
+        
+        # Events that arrived while sending stay for the next digest
+        self.events = self.events[len(events):]
+        self.log.rewrite(self.events)
+        
+        logger.info(f"📬 Admin digest sent ({len(events)} events)")
+        return True
+
+# ==================== JOIN REQUESTS ====================
+class PendingJoinRequests:
+    """Join requests parked until the user reaches the referral target
+    
+    user_id -> requested_at (epoch). Changes are appended to an NDJSON
+    log (["+", id, ts] / ["-", id], written off the event loop) which is
+    rewritten on load and once it holds mostly stale lines.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.log = AppendLog(path)
+        self.requests = {}
+        self.log_lines = 0
+        
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        op = json.loads(line)
+                    except ValueError:
+                        continue
+                    if op[0] == '+':
+                        self.requests[op[1]] = op[2]
+                    else:
+                        self.requests.pop(op[1], None)
+            self._rewrite()
+            if self.requests:
+                logger.info(f"⏳ {len(self.requests)} pending join requests recovered")
+    
+    def __contains__(self, user_id):
+        return user_id in self.requests
+    
+    def __len__(self):
+        return len(self.requests)
+    
+    def _rewrite(self):
+        self.log.rewrite(['+', user_id, ts] for user_id, ts in self.requests.items())
+        self.log_lines = len(self.requests)
+    
+    def _append(self, op):
+        self.log.append(op)
+        self.log_lines += 1
+        if self.log_lines > max(1000, 2 * len(self.requests)):
+            self._rewrite()
+    
+    def add(self, user_id):
+        """Park a request - a repeated request keeps its original time"""
+        if user_id not in self.requests:
+            self.requests[user_id] = int(time.time())
+            self._append(['+', user_id, self.requests[user_id]])
+    
+    def remove(self, user_id):
+        if self.requests.pop(user_id, None) is not None:
+            self._append(['-', user_id])
+    
+    def older_than(self, cutoff):
+        return [user_id for user_id, ts in self.requests.items() if ts < cutoff]
+
+# ==================== BROADCAST ====================
+class Broadcaster:
+    """Admin broadcast to every registered user - resumable
+    
+    Recipients are read from store.recipients() a page at a time in
+    ascending user id order, nothing else is materialised. Sends share the
+    outbound queue's per-bot token bucket and RetryAfter pause, with up to
+    `concurrency` in flight. The checkpoint file holds the cursor (every
+    id <= cursor is done) plus the ids already sent from the current page,
+    so a restart resumes instead of re-sending. It is written off the event
+    loop every progress_seconds and on stop - a crash re-sends at most that
+    window. Users who blocked the bot are marked in the store and skipped
+    by later broadcasts.
+    """
+    
+    def __init__(self, store, outbound, checkpoint_file, concurrency=8, page_size=500,
+                 max_retries=5, progress_seconds=10):
+        self.store = store
+        self.outbound = outbound
+        self.checkpoint_file = checkpoint_file
+        self.concurrency = concurrency
+        self.page_size = page_size
+        self.max_retries = max_retries
+        self.progress_seconds = progress_seconds
+        self.task = None
+        # async (state, finished) - live progress for the admin
+        self.on_progress = None
+        self.state = None
+        self.save_lock = asyncio.Lock()
+        
+        if os.path.exists(checkpoint_file):
+            try:
+                self.state = read_json_file(checkpoint_file)
+            except Exception as e:
+                logger.error(f"❌ Broadcast checkpoint unreadable: {e}")
+    
+    @property
+    def running(self):
+        return self.task is not None and not self.task.done()
+    
+    @property
+    def resumable(self):
+        return self.state is not None and not self.state.get('finished_at') and not self.running
+    
+    async def save(self):
+        """Checkpoint in a worker thread - serialised, so an older state never lands last"""
+        payload = json.dumps(self.state).encode('utf-8')
+        async with self.save_lock:
+            try:
+                await asyncio.to_thread(write_file_atomic, self.checkpoint_file, payload)
+            except Exception as e:
+                logger.error(f"❌ Broadcast checkpoint error: {e}")
+    
+    def start(self, bot, message, admin_chat_id):
+        """New broadcast - message is {'text': ...} or {'from_chat_id', 'message_id'} to copy"""
+        self.state = {
+            'id': f"{time.time_ns():x}",
+            'message': message,
+            'admin_chat_id': admin_chat_id,
+            'progress_message_id': None,
+            'cursor': 0,
+            'done': [],
+            'total': len(self.store),
+            'sent': 0,
+            'blocked': 0,
+            'failed': 0,
+            'started_at': int(time.time()),
+            'finished_at': None,
+            'cancelled': False
+        }
+        self.resume(bot)
+    
+    def resume(self, bot):
+        if self.state is not None and not self.running:
+            self.task = asyncio.create_task(self._run(bot))
+    
+    async def cancel(self):
+        """Stop for good - the checkpoint is kept as finished"""
+        self.state['cancelled'] = True
+        await self.stop()
+        self.state['finished_at'] = int(time.time())
+        await self.save()
+    
+    async def stop(self):
+        """Shutdown - checkpoint where we are, resume on next start"""
+        if self.running:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+        self.task = None
+    
+    async def _run(self, bot):
+        state = self.state
+        await self.store.wait_ready()
+        logger.info(f"📣 Broadcast running from user {state['cursor']} ({state['sent']} sent so far)")
+        await self.save()
+        reporter = asyncio.create_task(self._report_loop())
+        try:
+            while True:
+                # Checkpoints written before broadcasts had an id - started_at is unique enough
+                page = self.store.recipients(state['cursor'], self.page_size,
+                                             state.get('id', state['started_at']))
+                if not page:
+                    break
+                done = set(state['done'])
+                # Shared iterator - every id is taken by exactly one sender
+                todo = iter([user_id for user_id in page if user_id not in done])
+                
+                async def sender():
+                    for user_id in todo:
+                        await self._send(bot, user_id)
+                        state['done'].append(user_id)
+                
+                await asyncio.gather(*(sender() for _ in range(self.concurrency)))
+                state['cursor'] = page[-1]
+                state['done'] = []
+            
+            state['finished_at'] = int(time.time())
+            logger.info(f"📣 Broadcast finished: {state['sent']} sent, {state['blocked']} blocked, "
+                        f"{state['failed']} failed")
+        except Exception as e:
+            # Checkpoint stays resumable - /broadcast resume or the next start picks it up
+            logger.error(f"❌ Broadcast error: {e}")
+            return
+        finally:
+            reporter.cancel()
+            await self.save()
+        await self._report(True)
+    
+    async def _report_loop(self):
+        while True:
+            await asyncio.sleep(self.progress_seconds)
+            await self.save()
+            await self._report(False)
+    
+    async def _report(self, finished):
+        if self.on_progress:
+            try:
+                await self.on_progress(self.state, finished)
+            except Exception as e:
+                logger.error(f"❌ Broadcast progress error: {e}")
+    
+    async def _send(self, bot, user_id):
+        """One recipient - returns once delivered, blocked or given up"""
+        state = self.state
+        message = state['message']
+        attempt = 0
+        while True:
+            pause = self.outbound.paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            await self.outbound.global_limiter.acquire()
+            
+            try:
+                if 'text' in message:
+                    await bot.send_message(chat_id=user_id, text=message['text'])
+                else:
+                    await bot.copy_message(chat_id=user_id, from_chat_id=message['from_chat_id'],
+                                           message_id=message['message_id'])
+                state['sent'] += 1
+                return
+            except RetryAfter as e:
+                # Same per-bot limit as the outbound queue - pause both
+                self.outbound.paused_until = time.monotonic() + e.retry_after
+                logger.warning("⏳ Flood limit during broadcast - pausing sends for %ss", e.retry_after)
+                continue
+            except Forbidden:
+                # Blocked the bot / deactivated - skipped from now on
+                self.store.mark_blocked(user_id)
+                state['blocked'] += 1
+                return
+            except BadRequest as e:
+                state['failed'] += 1
+                logger.error("❌ Broadcast to %s failed: %s", user_id, e)
+                return
+            except (TimedOut, NetworkError) as e:
+                if attempt >= self.max_retries:
+                    state['failed'] += 1
+                    logger.error("❌ Broadcast to %s failed after %s retries: %s", user_id, attempt, e)
+                    return
+                await asyncio.sleep(min(2 ** attempt, 30))
+            except TelegramError as e:
+                state['failed'] += 1
+                logger.error("❌ Broadcast to %s failed: %s", user_id, e)
+                return
+            attempt += 1
+
+# ==================== MEMBERSHIP CACHE ====================
+class MembershipCache:
+    """Bounded TTL + LRU cache of channel membership
+    
+    "Not joined" answers expire sooner (negative_ttl) since a user may
+    join any moment. Approvals and chat_member updates write through.
+    """
+    
+    def __init__(self, max_size=10000, ttl=600, negative_ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, user_id):
+        """Cached membership (True/False) or None on miss"""
+        entry = self.entries.get(user_id)
+        if entry is not None:
+            in_channel, expires_at = entry
+            if expires_at > time.monotonic():
+                self.entries.move_to_end(user_id)
+                self.hits += 1
+                return in_channel
+            del self.entries[user_id]
+        self.misses += 1
+        return None
+    
+    def set(self, user_id, in_channel):
+        ttl = self.ttl if in_channel else self.negative_ttl
+        self.entries[user_id] = (in_channel, time.monotonic() + ttl)
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+    
+    def invalidate(self, user_id):
+        self.entries.pop(user_id, None)
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return (self.hits / total * 100) if total else 0.0
+
+# ==================== TEMPLATES ====================
+# Built-in English texts. {required}, {points_award}, {channel_link} come
+# from CONFIG and are baked in once; the rest are filled per request.
+# LOCALES_FILE ({"hi": {"welcome": "...", ...}}) adds/overrides languages -
+# missing keys fall back to English.
+DEFAULT_TEXTS = {
+    'welcome': """
+🤖 **Welcome to Referral Bot!** {name}
+
+📊 **Your Status:**
+• Points: {points}
+• Referrals: {referrals}/{required}
+
+📨 **Your Link:**
+`{link}`
+
+**📋 Rules:**
+1. Share link with {required} people
+2. Complete referrals for channel access
+3. Auto-approval system
+
+**🎯 Target: {required} Referrals**
+""",
+    'status': """
+📊 **YOUR STATUS**
+
+👤 **User:** {name}
+🏆 **Points:** {points}
+👥 **Referrals:** {referrals}/{required}
+📺 **Channel:** {channel}
+🔗 **Your Link:** `{link}`
+
+""",
+    'status_joined': "✅ Joined",
+    'status_not_joined': "❌ Not Joined",
+    'status_eligible': "✅ **Eligible for channel access!**\n",
+    'status_in_channel': "🎉 **Already in channel!**\n",
+    'status_need_one': "🎯 **Need {needed} more referral**\n",
+    'status_need_many': "🎯 **Need {needed} more referrals**\n",
+    'home': """
+🏠 **Referral Bot Home**
+
+📊 **Progress:**
+• Points: {points}
+• Referrals: {referrals}/{required}
+
+📨 **Your Link:**
+`{link}`
+
+**Next Steps:**
+1. Share link 👥
+2. Complete {required} referrals ✅
+3. Join channel 📺
+""",
+    'help': """
+❓ **Referral Bot Help**
+
+**🤔 How it works:**
+1. /start - Get referral link
+2. Share with {required} people
+3. Complete referrals
+4. Join channel (auto-approved)
+
+**📋 Commands:**
+/start - Start bot
+/status - Check status
+/help - This message
+/admin - Admin stats
+
+**🎯 Notes:**
+- {required} referrals required
+- Auto-approval for eligible users
+- No notifications after completion
+""",
+    'points_received': """
+🎉 **+{points_award} Point Received!**
+
+📊 **Your Progress:**
+• Referrals: {referrals}/{required}
+• Points: {points}
+
+🎯 **Only {remaining} more needed!**
+""",
+    'completed': """
+🎉 **CONGRATULATIONS!**
+
+✅ You have completed {required} referrals!
+
+📺 **You can now join the channel:**
+{channel_link}
+
+🚀 **Send join request to get auto-approved!**
+""",
+    'not_started': "❌ Use /start first.",
+    'share_text': "Join this bot!",
+    'btn_share': "📱 Share Link",
+    'btn_my_status': "📊 My Status",
+    'btn_status': "📊 Status",
+    'btn_refresh': "🔄 Refresh",
+    'btn_home': "🏠 Home",
+    'btn_help': "❓ Help",
+    'btn_join': "🎬 Join Channel",
+    'btn_start': "🚀 Start",
+    'answer_updated': "✅ Updated!",
+    'answer_home': "✅ On home!",
+    'answer_help': "✅ Help shown!",
+    'answer_use_start': "Use /start in chat!"
+}
+
+
+class _KeepMissing(dict):
+    """format_map helper - unknown placeholders survive for the second pass"""
+    
+    def __missing__(self, key):
+        return "{" + key + "}"
+
+
+class Locale:
+    """One language: texts with CONFIG baked in + keyboards that never change"""
+    
+    def __init__(self, texts, config):
+        static = _KeepMissing(
+            required=config['REQUIRED_REFERRALS'],
+            points_award=config['REFERRAL_POINTS'],
+            # Escape braces so a link can't break the per-request format()
+            channel_link=config['MOVIE_CHANNEL_LINK'].replace("{", "{{").replace("}", "}}")
+        )
+        self.texts = {key: text.format_map(static) for key, text in texts.items()}
+        # Fully static texts - stored ready to send
+        self.help = self.texts['help'].format()
+        self.completed = self.texts['completed'].format()
+        
+        t = self.texts
+        self.status_button = InlineKeyboardButton(t['btn_my_status'], callback_data="status")
+        self.join_button = InlineKeyboardButton(t['btn_join'], url=config['MOVIE_CHANNEL_LINK'])
+        self.refresh_home_rows = [
+            [InlineKeyboardButton(t['btn_refresh'], callback_data="status")],
+            [InlineKeyboardButton(t['btn_home'], callback_data="home")]
+        ]
+        self.help_keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton(t['btn_home'], callback_data="home")],
+            [InlineKeyboardButton(t['btn_status'], callback_data="status")],
+            [InlineKeyboardButton(t['btn_start'], callback_data="start_callback")]
+        ])
+        self.status_eligible_keyboard = InlineKeyboardMarkup([[self.join_button]] + self.refresh_home_rows)
+        self.status_in_channel_keyboard = InlineKeyboardMarkup(self.refresh_home_rows)
+        self.help_button = InlineKeyboardButton(t['btn_help'], callback_data="help")
+    
+    def render(self, key, **fields):
+        return self.texts[key].format(**fields)
+
+
+class MessageTemplates:
+    """All locales compiled at startup + per-user referral link / share button cache"""
+    
+    def __init__(self, config, locales_file=None, cache_size=100000):
+        self.config = config
+        self.cache_size = cache_size
+        
+        username = config['BOT_USERNAME']
+        self.link_prefix = f"https://t.me/{username}?start=" if username else f"t.me/{username}?start="
+        
+        locales = {'en': DEFAULT_TEXTS}
+        if locales_file and os.path.exists(locales_file):
+            try:
+                for lang, texts in read_json_file(locales_file).items():
+                    locales[lang] = {**DEFAULT_TEXTS, **texts}
+                logger.info(f"🌍 Locales loaded: {', '.join(sorted(locales))}")
+            except Exception as e:
+                logger.error(f"❌ Locales file error: {e}")
+        
+        self.locales = {lang: Locale(texts, config) for lang, texts in locales.items()}
+        self.default = self.locales.get(config['DEFAULT_LANGUAGE'], self.locales['en'])
+        # (user_id, lang) -> (referral link, share button)
+        self.links = OrderedDict()
+    
+    def locale(self, language_code=None):
+        """Locale for a Telegram language_code ('pt-br' -> 'pt'), else default"""
+        if language_code:
+            locale = self.locales.get(language_code) or self.locales.get(language_code[:2])
+            if locale is not None:
+                return locale
+        return self.default
+    
+    def referral_link(self, user_id):
+        return self.link_prefix + str(user_id)
+    
+    def share_button(self, user_id, locale):
+        """Share button with the URL-encoded link - built once per user"""
+        key = (user_id, id(locale))
+        button = self.links.get(key)
+        if button is not None:
+            self.links.move_to_end(key)
+            return button
+        
+        share_url = (f"https://t.me/share/url?url={quote(self.referral_link(user_id), safe='')}"
+                     f"&text={quote(locale.texts['share_text'], safe='')}")
+        button = InlineKeyboardButton(locale.texts['btn_share'], url=share_url)
+        self.links[key] = button
+        while len(self.links) > self.cache_size:
+            self.links.popitem(last=False)
+        return button
+    
+    def start_keyboard(self, user_id, locale):
+        return InlineKeyboardMarkup([[self.share_button(user_id, locale)], [locale.status_button]])
+    
+    def status_need_keyboard(self, user_id, locale):
+        return InlineKeyboardMarkup([[self.share_button(user_id, locale)]] + locale.refresh_home_rows)
+    
+    def home_keyboard(self, user_id, completed, locale):
+        rows = [[self.share_button(user_id, locale)], [locale.status_button]]
+        if completed:
+            rows.append([locale.join_button])
+        rows.append([locale.help_button])
+        return InlineKeyboardMarkup(rows)
+    
+    def __len__(self):
+        return len(self.links)
+
+# ==================== PARTITIONING ====================
+def partition_of(user_id, workers):
+    """Worker that owns a user - stable as long as WORKERS doesn't change"""
+    return int(user_id) % workers
+
+
+def shard_path(path, worker_index, workers):
+    """user_data.json -> user_data.w1.json (unchanged for a single worker)"""
+    if workers <= 1:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.w{worker_index}{ext}"
+
+
+def update_owner(raw):
+    """User id an update belongs to, read from the raw JSON (None = any worker)"""
+    for key in ('message', 'edited_message', 'callback_query', 'chat_join_request'):
+        sender = (raw.get(key) or {}).get('from')
+        if sender:
+            return sender['id']
+    member = raw.get('chat_member') or raw.get('my_chat_member')
+    if member:
+        return member['new_chat_member']['user']['id']
+    return None
+
+
+# Admin commands about all users - every worker answers for its own partition
+FAN_OUT_COMMANDS = ('/broadcast', '/export', '/top', '/admin', '/metrics', '/backups')
+
+
+def is_fan_out(raw, owner, config):
+    """Admin command that goes to every worker, not just the admin's"""
+    words = ((raw.get('message') or {}).get('text') or '').split(None, 1)
+    return (str(owner) == config['ADMIN_USER_ID'] and
+            bool(words) and words[0].split('@')[0] in FAN_OUT_COMMANDS)
+
+
+class HandoffLedger:
+    """Users this worker sent to another worker for a referral credit
+    
+    The referred user's worker is the authority on "already referred", so
+    a cross-partition referral is claimed here first (persisted, NDJSON
+    ["+", id, referrer] / ["=", id] / ["-", id]), acknowledged once the
+    referrer's worker credits it and released if it rejects it. Claims
+    still waiting for an answer are re-sent until one arrives. Acknowledged
+    claims are settled - dropped - once the user's own record carries the
+    referrer (store.mark_referred). Entries are fsynced off the event loop -
+    persisted() waits for them; the file is rewritten once mostly stale.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.log = AppendLog(path, fsync=True)
+        self.claims = {}  # user_id -> referrer_id, waiting for an answer
+        self.acknowledged = {}  # user_id -> referrer_id, credited but not settled
+        self.log_lines = 0
+        
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        op, user_id, *referrer = json.loads(line)
+                    except ValueError:
+                        continue
+                    if op == '+':
+                        self.claims[user_id] = referrer[0] if referrer else None
+                    elif op == '=':
+                        if user_id in self.claims:
+                            self.acknowledged[user_id] = self.claims.pop(user_id)
+                    else:
+                        self.claims.pop(user_id, None)
+                        self.acknowledged.pop(user_id, None)
+            for user_id in [u for u, r in self.claims.items() if r is None]:
+                # Old ["+", id] entries carry no referrer - kept as answered, never settled
+                self.acknowledged[user_id] = self.claims.pop(user_id)
+            self._rewrite()
+    
+    def __contains__(self, user_id):
+        return user_id in self.claims or user_id in self.acknowledged
+    
+    def __len__(self):
+        return len(self.claims) + len(self.acknowledged)
+    
+    def pending(self):
+        """(user_id, referrer_id) claims the referrer's worker hasn't answered"""
+        return list(self.claims.items())
+    
+    def unsettled(self):
+        """(user_id, referrer_id) credited claims not yet moved onto the user's record"""
+        return [(u, r) for u, r in self.acknowledged.items() if r is not None]
+    
+    def _rewrite(self):
+        entries = [['+', u, r] for u, r in self.claims.items()]
+        for user_id, referrer_id in self.acknowledged.items():
+            entries.append(['+', user_id, referrer_id] if referrer_id is not None else ['+', user_id])
+            entries.append(['=', user_id])
+        self.log.rewrite(entries)
+        self.log_lines = len(entries)
+    
+    def _append(self, *entry):
+        self.log.append(list(entry))
+        self.log_lines += 1
+        if self.log_lines > max(1000, 4 * len(self)):
+            self._rewrite()
+    
+    async def persisted(self):
+        await self.log.flush()
+    
+    def claim(self, user_id, referrer_id):
+        self.claims[user_id] = referrer_id
+        self._append('+', user_id, referrer_id)
+    
+    def acknowledge(self, user_id, referrer_id):
+        """Credited - the entry stays as the "already referred" marker until settled"""
+        if user_id in self.claims and self.claims[user_id] == referrer_id:
+            self.acknowledged[user_id] = self.claims.pop(user_id)
+            self._append('=', user_id)
+    
+    def release(self, user_id, referrer_id=None):
+        """Rejected - only drops the claim made for that referrer"""
+        if user_id in self.claims and (referrer_id is None or self.claims[user_id] == referrer_id):
+            del self.claims[user_id]
+            self._append('-', user_id)
+    
+    def settle(self, user_id):
+        """The user's record holds the referrer now - forget the claim"""
+        if self.acknowledged.pop(user_id, None) is not None:
+            self._append('-', user_id)
+
+# ==================== METRICS ====================
+class Histogram:
+    """Fixed-bucket latency histogram (seconds), Prometheus style"""
+    
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)  # last = +Inf
+        self.sum = 0.0
+        self.count = 0
+    
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+    
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th observation"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+    
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+
+class Metrics:
+    """In-process registry - histograms, counters and sampled gauges
+    
+    Names get the 'referral_' prefix on export. Labels are keyword args.
+    """
+    
+    PREFIX = "referral_"
+    HELP = {
+        'handler_seconds': "Handler latency",
+        'handler_errors_total': "Exceptions escaping a handler",
+        'api_seconds': "Telegram Bot API call duration",
+        'api_errors_total': "Bot API calls that failed or returned an error status",
+        'storage_seconds': "Storage load/flush/compact/backup duration",
+        'queue_depth': "Items waiting in a queue",
+        'status_views_total': "Status views computed vs. coalesced into one in flight",
+        'outbound_messages_total': "Outbound messages by result - dropped = refused by a full queue",
+        'users': "Registered users"
+    }
+    
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+    
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+    
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+    
+    def inc(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + amount
+    
+    def gauge(self, name, sample, **labels):
+        """Register a callable sampled at export time"""
+        self.gauges[self._key(name, labels)] = sample
+    
+    def counter_sample(self, name, sample, **labels):
+        """Register a callable sampled at export time - for totals counted elsewhere"""
+        self.counters[self._key(name, labels)] = sample
+    
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+    
+    def instrument(self, handler, callback):
+        """Wrap a PTB callback with latency + error accounting"""
+        async def timed(update, context):
+            started = time.perf_counter()
+            try:
+                return await callback(update, context)
+            except Exception:
+                self.inc('handler_errors_total', handler=handler)
+                raise
+            finally:
+                self.observe('handler_seconds', time.perf_counter() - started, handler=handler)
+        return timed
+    
+    def select(self, name):
+        """{label dict: Histogram} for one histogram name"""
+        return {labels: h for (n, labels), h in self.histograms.items() if n == name}
+    
+    def counter(self, name, **labels):
+        value = self.counters.get(self._key(name, labels), 0)
+        return value() if callable(value) else value
+    
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+    
+    def render(self):
+        """Prometheus text exposition format"""
+        lines = []
+        
+        def header(name, kind):
+            lines.append(f"# HELP {self.PREFIX}{name} {self.HELP.get(name, name)}")
+            lines.append(f"# TYPE {self.PREFIX}{name} {kind}")
+        
+        for name in sorted({n for n, _ in self.histograms}):
+            header(name, "histogram")
+            for labels, h in sorted(self.select(name).items()):
+                cumulative = 0
+                for bound, count in zip(Histogram.BUCKETS + ('+Inf',), h.counts):
+                    cumulative += count
+                    lines.append(f"{self.PREFIX}{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{self.PREFIX}{name}_sum{self._labels(labels)} {h.sum:.6f}")
+                lines.append(f"{self.PREFIX}{name}_count{self._labels(labels)} {h.count}")
+        
+        for name in sorted({n for n, _ in self.counters}):
+            header(name, "counter")
+            for (n, labels), value in sorted(self.counters.items(), key=lambda item: item[0]):
+                if n != name:
+                    continue
+                try:
+                    lines.append(f"{self.PREFIX}{name}{self._labels(labels)} {value() if callable(value) else value}")
+                except Exception as e:
+                    logger.error(f"❌ Counter {name} error: {e}")
+        
+        for name in sorted({n for n, _ in self.gauges}):
+            header(name, "gauge")
+            for (n, labels), sample in sorted(self.gauges.items(), key=lambda item: item[0]):
+                if n != name:
+                    continue
+                try:
+                    lines.append(f"{self.PREFIX}{name}{self._labels(labels)} {sample()}")
+                except Exception as e:
+                    logger.error(f"❌ Gauge {name} error: {e}")
+        
+        return "\n".join(lines) + "\n"
+
+
+class TimedRequest(BaseRequest):
+    """Request backend wrapper - times every Bot API call by method
+    
+    'sendMessage' is recorded as method="send_message" etc.
+    """
+    
+    def __init__(self, inner, metrics):
+        self.inner = inner
+        self.metrics = metrics
+        self.names = {}
+    
+    @property
+    def read_timeout(self):
+        return self.inner.read_timeout
+    
+    async def initialize(self):
+        await self.inner.initialize()
+    
+    async def shutdown(self):
+        await self.inner.shutdown()
+    
+    def _method(self, url):
+        endpoint = url.rsplit('/', 1)[-1]
+        name = self.names.get(endpoint)
+        if name is None:
+            name = self.names[endpoint] = re.sub(r'(?<!^)(?=[A-Z])', '_', endpoint).lower()
+        return name
+    
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        name = self._method(url)
+        started = time.perf_counter()
+        try:
+            code, payload = await self.inner.do_request(url, method, request_data=request_data, **kwargs)
+        except Exception:
+            self.metrics.inc('api_errors_total', method=name)
+            raise
+        finally:
+            self.metrics.observe('api_seconds', time.perf_counter() - started, method=name)
+        if code >= 400:
+            self.metrics.inc('api_errors_total', method=name)
+        return code, payload
+
+# ==================== HTTP SERVER ====================
+class HttpServer:
+    """Minimal asyncio HTTP/1.1 server (stdlib only) for webhook/metrics
+    
+    routes maps path -> async handler(method, headers, body) returning
+    (status, content_type, body_bytes). Requests beyond max_connections
+    wait; idle keep-alive connections don't hold a slot. A request must
+    arrive within header_timeout, the next one within idle_timeout.
+    stop() closes the listener and lets in-flight requests finish.
+    """
+    
+    REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+               405: "Method Not Allowed", 413: "Payload Too Large", 503: "Service Unavailable"}
+    MAX_BODY = 1024 * 1024
+    
+    def __init__(self, host, port, routes, max_connections=100, header_timeout=10, idle_timeout=30):
+        self.host = host
+        self.port = port
+        self.routes = routes
+        self.slots = asyncio.Semaphore(max_connections)
+        self.header_timeout = header_timeout
+        self.idle_timeout = idle_timeout
+        self.server = None
+        self.in_flight = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+    
+    async def start(self):
+        self.server = await asyncio.start_server(self._serve, self.host, self.port)
+        logger.info(f"🌐 HTTP server listening on {self.host}:{self.port}")
+    
+    async def stop(self, timeout=15):
+        """Stop accepting, then wait for in-flight requests"""
+        if self.server is None:
+            return
+        self.server.close()
+        try:
+            await asyncio.wait_for(self.idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"⚠️ HTTP drain timed out with {self.in_flight} requests in flight")
+        self.server = None
+    
+    async def _serve(self, reader, writer):
+        try:
+            timeout = self.header_timeout
+            while self.server is not None:
+                # Waiting for the next request holds no slot - bounded by the timeout instead
+                request_line = await asyncio.wait_for(reader.readline(), timeout)
+                if not request_line:
+                    break
+                async with self.slots:
+                    request = await asyncio.wait_for(self._read_request(request_line, reader), self.header_timeout)
+                    close = await self._handle(writer, *request)
+                if close:
+                    break
+                timeout = self.idle_timeout
+        except (ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.error("❌ HTTP error: %s", e)
+        finally:
+            writer.close()
+    
+    async def _read_request(self, request_line, reader):
+        """Headers + body after the request line -> (method, path, headers, body)"""
+        method, path, _ = request_line.decode('latin-1').split(' ', 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        
+        length = int(headers.get('content-length', 0))
+        if length > self.MAX_BODY:
+            return method, path, headers, None
+        body = await reader.readexactly(length) if length else b""
+        return method, path, headers, body
+    
+    async def _handle(self, writer, method, path, headers, body):
+        """One request/response - True if the connection should close"""
+        if body is None:
+            await self._respond(writer, 413, "text/plain", b"too large", close=True)
+            return True
+        
+        self.in_flight += 1
+        self.idle.clear()
+        try:
+            handler = self.routes.get(path.split('?', 1)[0])
+            if handler is None:
+                status, content_type, payload = 404, "text/plain", b"not found"
+            else:
+                status, content_type, payload = await handler(method, headers, body)
+        finally:
+            self.in_flight -= 1
+            if self.in_flight == 0:
+                self.idle.set()
+        
+        close = headers.get('connection', '').lower() == 'close' or self.server is None
+        await self._respond(writer, status, content_type, payload, close)
+        return close
+    
+    async def _respond(self, writer, status, content_type, payload, close=False):
+        head = (f"HTTP/1.1 {status} {self.REASONS.get(status, 'OK')}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(payload)}\r\n"
+                f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n")
+        writer.write(head.encode('latin-1') + payload)
+        await writer.drain()
+
+# ==================== WEBHOOK ====================
+def webhook_path(config):
+    return "/" + config['WEBHOOK_PATH'].strip("/")
+
+
+def check_webhook_request(config, method, headers):
+    """Error response for a bad webhook call, None if it may proceed"""
+    if method != 'POST':
+        return 405, "text/plain", b"POST only"
+    
+    secret = config['WEBHOOK_SECRET']
+    token = headers.get('x-telegram-bot-api-secret-token', '')
+    if secret and not hmac.compare_digest(token.encode('utf-8'), secret.encode('utf-8')):
+        return 403, "text/plain", b"bad secret"
+    return None
+
+
+async def register_webhook(bot, config, allowed_updates):
+    """setWebhook - skipped without WEBHOOK_URL (local testing)"""
+    path = webhook_path(config)
+    if config['WEBHOOK_URL']:
+        await bot.set_webhook(
+            url=config['WEBHOOK_URL'].rstrip("/") + path,
+            allowed_updates=allowed_updates,
+            max_connections=config['WEBHOOK_MAX_CONNECTIONS'],
+            secret_token=config['WEBHOOK_SECRET'] or None
+        )
+        logger.info(f"🌐 Webhook set: {config['WEBHOOK_URL']}{path}")
+    else:
+        logger.warning("⚠️ WEBHOOK_URL not set - local mode, POST updates to the endpoint yourself")
+
+
+def stop_on_signals(stop_event):
+    """SIGINT/SIGTERM set stop_event (where the loop supports it)"""
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+
+# ==================== BACKUPS ====================
+class BackupManager:
+    """Scheduled snapshots - cost independent of request rate
+    
+    A snapshot is taken when the store changed at least change_threshold
+    times, or when interval seconds passed and anything changed at all.
+    """
+    
+    def __init__(self, store, backup_dir, extension, interval=3600,
+                 change_threshold=1000, retention=5, compress=False):
+        self.store = store
+        self.backup_dir = backup_dir
+        self.extension = extension + (".gz" if compress else "")
+        self.interval = interval
+        self.change_threshold = change_threshold
+        self.retention = retention
+        self.compress = compress
+        self.last_changes = store.changes
+        self.last_backup_at = time.time()
+        self.running = False
+        
+        snapshots = self.list_snapshots()
+        if snapshots:
+            self.last_backup_at = snapshots[-1][2]
+    
+    def list_snapshots(self):
+        """Snapshots oldest first as (name, size, mtime)"""
+        snapshots = []
+        for path in glob.glob(os.path.join(self.backup_dir, "user_data_*")):
+            if path.endswith(".tmp"):
+                continue
+            stat = os.stat(path)
+            snapshots.append((os.path.basename(path), stat.st_size, stat.st_mtime))
+        return sorted(snapshots)
+    
+    def is_due(self):
+        changed = self.store.changes - self.last_changes
+        if changed <= 0:
+            return False
+        return (changed >= self.change_threshold or
+                time.time() - self.last_backup_at >= self.interval)
+    
+    async def backup_now(self, prune=True):
+        """Take a snapshot right away - returns its name"""
+        if self.running:
+            return None
+        
+        self.running = True
+        try:
+            changes = self.store.changes
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+            name = f"user_data_{timestamp}{self.extension}"
+            await self.store.write_backup(os.path.join(self.backup_dir, name), self.compress)
+            
+            self.last_changes = changes
+            self.last_backup_at = time.time()
+            if prune:
+                await asyncio.to_thread(self.prune)
+            logger.info(f"📦 Backup created: {name}")
+            return name
+        except Exception as e:
+            logger.error(f"❌ Backup error: {e}")
+            return None
+        finally:
+            self.running = False
+    
+    def prune(self):
+        """Keep only the newest `retention` snapshots"""
+        snapshots = self.list_snapshots()
+        for name, _, _ in snapshots[:-self.retention] if self.retention > 0 else []:
+            try:
+                os.remove(os.path.join(self.backup_dir, name))
+            except OSError:
+                pass
+    
+    async def restore(self, name):
+        """Restore a snapshot by file name"""
+        if os.path.basename(name) != name or not name.startswith("user_data_"):
+            raise ValueError(f"Invalid snapshot name: {name}")
+        
+        path = os.path.join(self.backup_dir, name)
+        if not os.path.exists(path):
+            raise FileNotFoundError(name)
+        
+        # Safety net - current state is snapshotted first (pruned on next run)
+        await self.backup_now(prune=False)
+        await self.store.restore_backup(path)
+        self.last_changes = self.store.changes
 
 class ReferralBot:
     """Main Referral Bot Class - Silent After Completion"""
     
-    def __init__(self):
+    # Only what the handlers consume - chat_member must be asked for explicitly
+    ALLOWED_UPDATES = [
+        Update.MESSAGE,
+        Update.CALLBACK_QUERY,
+        Update.CHAT_JOIN_REQUEST,
+        Update.CHAT_MEMBER
+    ]
+    
+    def __init__(self, worker_index=0, workers=1):
+        self.started_at = time.perf_counter()
         self.config = CONFIG
-        self.user_data_file = "user_data.json"
-        self.backup_dir = "backups"
+        # 🧩 Each worker owns user_id % workers and its own files
+        self.worker_index = worker_index
+        self.workers = workers
+        self.user_data_file = shard_path("user_data.json", worker_index, workers)
+        self.backup_dir = "backups" if workers <= 1 else os.path.join("backups", f"w{worker_index}")
+        self.peers = None  # worker control queues, set in worker mode
         
         self.validate_config()
         
         if not os.path.exists(self.backup_dir):
             os.makedirs(self.backup_dir)
+        self.handoffs = HandoffLedger(shard_path("handoffs.json", worker_index, workers)) if workers > 1 else None
+        
+        self.metrics = Metrics()
+        # Loaded in the background once the bot is online - see warm_up()
+        self.store = self.create_store()
+        self.warm_up_task = None
+        self.backups = BackupManager(
+            self.store,
+            self.backup_dir,
+            self.backup_extension(),
+            interval=self.config['BACKUP_INTERVAL_SECONDS'],
+            change_threshold=self.config['BACKUP_CHANGE_THRESHOLD'],
+            retention=self.config['BACKUP_RETENTION'],
+            compress=self.config['BACKUP_COMPRESS']
+        )
+        self.locks = KeyedLocks()
+        self.digest = AdminDigest(shard_path("admin_digest.json", worker_index, workers), max_events=self.config['ADMIN_DIGEST_MAX_EVENTS'])
+        self.outbound = OutboundQueue(
+            # Telegram's limit is per bot - workers split it
+            global_rate=self.config['OUTBOUND_GLOBAL_RATE'] / workers,
+            per_chat_rate=self.config['OUTBOUND_PER_CHAT_RATE'],
+            workers=self.config['OUTBOUND_WORKERS'],
+            max_retries=self.config['OUTBOUND_MAX_RETRIES'],
+            max_size=self.config['OUTBOUND_QUEUE_SIZE']
+        )
+        self.membership = MembershipCache(
+            max_size=self.config['MEMBERSHIP_CACHE_SIZE'],
+            ttl=self.config['MEMBERSHIP_CACHE_TTL'],
+            negative_ttl=self.config['MEMBERSHIP_CACHE_NEGATIVE_TTL']
+        )
+        self.ingress = IngressLimiter(
+            {
+                kind: (
+                    self.config[f'INGRESS_{name}_USER_RATE'],
+                    self.config[f'INGRESS_{name}_USER_BURST'],
+                    # Global budget is per bot - workers split it like the outbound rate
+                    self.config[f'INGRESS_{name}_GLOBAL_RATE'] / workers
+                )
+                for kind, name in (('command', 'COMMAND'), ('callback', 'CALLBACK'), ('join_request', 'JOIN'))
+            },
+            max_users=self.config['INGRESS_MAX_TRACKED_USERS']
+        )
+        self.status_views = SingleFlight(
+            window=self.config['STATUS_DEBOUNCE_SECONDS'],
+            max_size=self.config['STATUS_VIEWS_CACHE_SIZE']
+        )
+        self.templates = MessageTemplates(
+            self.config,
+            self.config['LOCALES_FILE'],
+            cache_size=self.config['LINK_CACHE_SIZE']
+        )
+        self.join_requests = PendingJoinRequests(shard_path("join_requests.json", worker_index, workers))
+        self.broadcaster = Broadcaster(
+            self.store,
+            self.outbound,
+            shard_path("broadcast.json", worker_index, workers),
+            concurrency=self.config['BROADCAST_CONCURRENCY'],
+            page_size=self.config['BROADCAST_PAGE_SIZE'],
+            max_retries=self.config['OUTBOUND_MAX_RETRIES'],
+            progress_seconds=self.config['BROADCAST_PROGRESS_SECONDS']
+        )
+        self.broadcaster.on_progress = self.broadcast_progress
+        self.export_task = None
+        # Bounds parallel approve/decline API calls during bursts
+        self.join_slots = asyncio.Semaphore(self.config['JOIN_APPROVAL_CONCURRENCY'])
+        self.metrics_server = None
+        self.register_gauges()
+        self.application = None
         
-        logger.info(f"✅ Bot initialized: @{self.config['BOT_USERNAME']}")
+        logger.info(f"✅ Bot initialized: @{self.config['BOT_USERNAME']} "
+                    f"({time.perf_counter() - self.started_at:.2f}s)")
+    
+    def create_store(self):
+        """Create the configured storage backend"""
+        backend = self.config['STORAGE_BACKEND']
+        
+        if backend == 'sqlite':
+            return SqliteUserStore(
+                shard_path(self.config['SQLITE_FILE'], self.worker_index, self.workers),
+                self.backup_dir,
+                flush_threshold=self.config['FLUSH_DIRTY_THRESHOLD'],
+                stats=StatsTracker(self.config['REQUIRED_REFERRALS']),
+                touch_interval=self.config['ACTIVITY_TOUCH_SECONDS']
+            )
+        if backend == 'json':
+            if self.config['SNAPSHOT_FORMAT'] not in ('ndjson', 'json'):
+                raise ValueError(f"❌ Unknown SNAPSHOT_FORMAT: {self.config['SNAPSHOT_FORMAT']}")
+            return JsonUserStore(
+                self.user_data_file,
+                self.backup_dir,
+                flush_threshold=self.config['FLUSH_DIRTY_THRESHOLD'],
+                stats=StatsTracker(self.config['REQUIRED_REFERRALS']),
+                snapshot_format=self.config['SNAPSHOT_FORMAT'],
+                touch_interval=self.config['ACTIVITY_TOUCH_SECONDS']
+            )
+        raise ValueError(f"❌ Unknown STORAGE_BACKEND: {backend}")
+    
+    def backup_extension(self):
+        """Backup file suffix for the active store/format"""
+        if isinstance(self.store, SqliteUserStore):
+            return ".db"
+        return ".ndjson" if self.store.snapshot_format == 'ndjson' else ".json"
     
     def validate_config(self):
         """Check if required config is set"""
@@ -83,98 +3814,21 @@ class ReferralBot:
             print("="*60 + "\n")
             raise ValueError(error_msg)
     
-    def create_backup(self):
-        """Create backup of user data"""
-        try:
-            if os.path.exists(self.user_data_file):
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                backup_path = os.path.join(self.backup_dir, f"user_data_{timestamp}.json")
-                shutil.copy2(self.user_data_file, backup_path)
-                
-                backups = sorted(glob.glob(os.path.join(self.backup_dir, "user_data_*.json")))
-                if len(backups) > 5:
-                    for old_backup in backups[:-5]:
-                        try:
-                            os.remove(old_backup)
-                        except:
-                            pass
-                
-                return True
-        except Exception as e:
-            logger.error(f"❌ Backup error: {e}")
-        return False
-    
-    def restore_from_backup(self):
-        """Restore user data from latest backup"""
-        try:
-            backups = sorted(glob.glob(os.path.join(self.backup_dir, "user_data_*.json")))
-            if backups:
-                latest_backup = backups[-1]
-                shutil.copy2(latest_backup, self.user_data_file)
-                return True
-        except Exception as e:
-            logger.error(f"❌ Restore error: {e}")
-        return False
-    
-    def load_user_data(self):
-        """Load user data from JSON file"""
-        if not os.path.exists(self.user_data_file):
-            return {}
-        
-        try:
-            with open(self.user_data_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            return data
-        except json.JSONDecodeError:
-            if self.restore_from_backup():
-                try:
-                    with open(self.user_data_file, 'r', encoding='utf-8') as f:
-                        return json.load(f)
-                except:
-                    return {}
-            return {}
-        except Exception as e:
-            logger.error(f"❌ Load error: {e}")
-            return {}
-    
-    def save_user_data(self, data):
-        """Save user data to JSON file"""
-        try:
-            self.create_backup()
-            
-            with open(self.user_data_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
-            
-            return True
-        except Exception as e:
-            logger.error(f"❌ Save error: {e}")
-            return False
-    
-    def cleanup_old_users(self):
-        """Remove inactive users"""
+    async def cleanup_old_users(self):
+        """Remove inactive users - small batches, handlers run in between"""
         try:
-            user_data = self.load_user_data()
-            if not user_data:
-                return
-            
-            cutoff_date = datetime.now() - timedelta(days=self.config['USER_RETENTION_DAYS'])
+            cutoff = time.time() - self.config['USER_RETENTION_DAYS'] * 86400
+            batch_size = self.config['CLEANUP_BATCH_SIZE']
             users_removed = 0
             
-            for user_id, user_info in list(user_data.items()):
-                last_activity_str = user_info.get('last_activity')
-                if not last_activity_str:
-                    continue
-                
-                try:
-                    last_activity = datetime.fromisoformat(last_activity_str)
-                    if last_activity < cutoff_date:
-                        del user_data[user_id]
-                        users_removed += 1
-                except:
-                    continue
+            while True:
+                removed = self.store.remove_expired(cutoff, batch_size)
+                users_removed += removed
+                if removed < batch_size:
+                    break
+                await asyncio.sleep(0)
             
             if users_removed > 0:
-                self.save_user_data(user_data)
                 logger.info(f"✅ {users_removed} inactive users removed")
                 
         except Exception as e:
@@ -182,206 +3836,363 @@ class ReferralBot:
     
     def get_referral_link(self, user_id):
         """Generate referral link for user"""
-        username = self.config['BOT_USERNAME']
-        if username:
-            return f"https://t.me/{username}?start={user_id}"
-        return f"t.me/{username}?start={user_id}"
+        return self.templates.referral_link(user_id)
+    
+    def admin_event(self, kind, summary, message=None):
+        """Admin notification - batched into the digest unless kind is urgent"""
+        if self.config['ADMIN_DIGEST_ENABLED'] and kind not in self.config['ADMIN_URGENT_EVENTS']:
+            self.digest.add({'kind': kind, 'text': summary})
+            return
+        self.outbound.send(
+            chat_id=self.config['ADMIN_USER_ID'],
+            text=message or summary,
+            parse_mode='Markdown'
+        )
     
-    async def notify_admin(self, context: ContextTypes.DEFAULT_TYPE, user_info, user_id):
+    def notify_admin(self, user_info, user_id):
         """Notify admin when referrals complete"""
         try:
+            completed_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            name = escape_markdown(str(user_info.get('first_name') or 'N/A'))
+            username = escape_markdown(str(user_info.get('username') or 'N/A'))
+            
             admin_message = f"""
 🎯 **REFERRAL TARGET COMPLETED!**
 
 👤 **User:**
-• Name: {user_info.get('first_name', 'N/A')}
-• Username: @{user_info.get('username', 'N/A')}
+• Name: {name}
+• Username: @{username}
 • User ID: `{user_id}`
-• Total Referrals: {len(user_info.get('referrals', []))}
-• Completed at: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+• Total Referrals: {user_info.get('referral_count', 0)}
+• Completed at: {completed_at}
 
 ✅ **User eligible for channel access!**
 """
             
-            await context.bot.send_message(
-                chat_id=self.config['ADMIN_USER_ID'],
-                text=admin_message,
-                parse_mode='Markdown'
+            self.admin_event(
+                'target_completed',
+                f"🎯 {name} (@{username}, `{user_id}`) - "
+                f"{user_info.get('referral_count', 0)} refs at {completed_at}",
+                admin_message
             )
         except Exception as e:
-            logger.error(f"❌ Admin notify error: {e}")
+            logger.error("❌ Admin notify error: %s", e)
     
     async def is_user_in_channel(self, user_id, context: ContextTypes.DEFAULT_TYPE):
-        """Check if user is already in channel"""
+        """Check if user is already in channel (cached)"""
+        cached = self.membership.get(user_id)
+        if cached is not None:
+            return cached
+        
         try:
             member = await context.bot.get_chat_member(self.config['CHANNEL_ID'], user_id)
-            return member.status in ['member', 'administrator', 'creator']
+            in_channel = member.status in ['member', 'administrator', 'creator']
+            self.membership.set(user_id, in_channel)
+            return in_channel
         except:
             return False
     
-    async def approve_channel_request(self, user_id, context: ContextTypes.DEFAULT_TYPE):
+    def is_channel(self, chat):
+        """True if chat is the configured CHANNEL_ID (numeric id or @username)"""
+        channel_id = str(self.config['CHANNEL_ID'])
+        if channel_id.startswith('@'):
+            return bool(chat.username) and chat.username.lower() == channel_id[1:].lower()
+        return str(chat.id) == channel_id
+    
+    async def handle_channel_member(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Keep membership cache in sync with channel joins/leaves"""
+        member_update = update.chat_member
+        if not self.is_channel(member_update.chat):
+            return
+        
+        new_member = member_update.new_chat_member
+        in_channel = new_member.status in ['member', 'administrator', 'creator']
+        self.membership.set(new_member.user.id, in_channel)
+        self.status_views.forget(str(new_member.user.id))
+    
+    async def approve_channel_request(self, user_id, context: ContextTypes.DEFAULT_TYPE = None):
         """Approve user's channel join request"""
         try:
-            await context.bot.approve_chat_join_request(self.config['CHANNEL_ID'], user_id)
-            logger.info(f"✅ Approved user {user_id}")
+            bot = context.bot if context else self.application.bot
+            async with self.join_slots:
+                await bot.approve_chat_join_request(self.config['CHANNEL_ID'], user_id)
+            self.membership.set(user_id, True)
+            self.status_views.forget(str(user_id))
+            update_log.info("✅ Approved user %s", user_id, event="join_approved", user_id=user_id)
             return True
         except Exception as e:
-            logger.error(f"❌ Approve error: {e}")
+            logger.error("❌ Approve error: %s", e)
             return False
     
-    async def decline_channel_request(self, user_id, context: ContextTypes.DEFAULT_TYPE):
+    async def decline_channel_request(self, user_id, context: ContextTypes.DEFAULT_TYPE = None):
         """Decline user's channel join request"""
         try:
-            await context.bot.decline_chat_join_request(self.config['CHANNEL_ID'], user_id)
-            logger.info(f"❌ Declined user {user_id}")
+            bot = context.bot if context else self.application.bot
+            async with self.join_slots:
+                await bot.decline_chat_join_request(self.config['CHANNEL_ID'], user_id)
+            update_log.info("❌ Declined user %s", user_id, event="join_declined", user_id=user_id)
             return True
         except Exception as e:
-            logger.error(f"❌ Decline error: {e}")
+            logger.error("❌ Decline error: %s", e)
             return False
     
-    async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Handle /start command - SILENT AFTER 3 REFERRALS"""
-        user = update.effective_user
-        user_id = str(user.id)
-        user_data = self.load_user_data()
+    async def approve_pending(self, user_id):
+        """User reached the target - approve their parked join request"""
+        async with self.locks.hold(user_id):
+            if user_id not in self.join_requests:
+                return
+            if await self.approve_channel_request(int(user_id)):
+                self.join_requests.remove(user_id)
+                self.store.mark_approved(user_id)
+    
+    async def expire_join_requests(self):
+        """Bulk-decline requests past JOIN_REQUEST_TTL_SECONDS, retry approvals that failed"""
+        try:
+            cutoff = time.time() - self.config['JOIN_REQUEST_TTL_SECONDS']
+            expired = self.join_requests.older_than(cutoff)
+            
+            async def decline(user_id):
+                async with self.locks.hold(user_id):
+                    if user_id in self.join_requests:
+                        await self.decline_channel_request(int(user_id))
+                        # Telegram may have dropped it already - never retry forever
+                        self.join_requests.remove(user_id)
+            
+            await asyncio.gather(*(decline(user_id) for user_id in expired))
+            
+            eligible = [
+                user_id for user_id in list(self.join_requests.requests)
+                if (self.store.get(user_id) or {}).get('referral_count', 0) >= self.config['REQUIRED_REFERRALS']
+            ]
+            await asyncio.gather(*(self.approve_pending(user_id) for user_id in eligible))
+            
+            if expired or eligible:
+                logger.info(f"⏳ Join queue: {len(expired)} expired, {len(eligible)} approval retries, "
+                            f"{len(self.join_requests)} waiting")
+        except Exception as e:
+            logger.error(f"❌ Join queue error: {e}")
+    
+    def owns(self, user_id):
+        """Is this worker's partition the home of user_id"""
+        return self.workers <= 1 or partition_of(user_id, self.workers) == self.worker_index
+    
+    def already_claimed(self, user_id):
+        """Referral for user_id already handed to another worker"""
+        return self.handoffs is not None and user_id in self.handoffs
+    
+    async def hand_off_referral(self, referrer_id, user_id):
+        """Cross-partition referral: claim the referred user here, let the
+        referrer's worker credit it (and release the claim if it can't)"""
+        await self.store.wait_ready()
+        async with self.locks.hold(user_id):
+            if self.already_claimed(user_id) or self.store.referred_by(user_id) is not None:
+                update_log.info("⚠️ Already referred: %s", user_id, event="already_referred", user_id=user_id)
+                return
+            self.handoffs.claim(user_id, referrer_id)
         
-        logger.info(f"📥 /start from: {user_id}")
+        # Claim on disk before the referrer's worker can act on it
+        await self.handoffs.persisted()
+        if not self.send_handoff(referrer_id, user_id):
+            # Never left this worker - don't block the user from being referred
+            self.handoffs.release(user_id, referrer_id)
+            return
+        update_log.info("🧩 Referral %s <- %s handed to worker %s", referrer_id, user_id,
+                        partition_of(referrer_id, self.workers), event="referral_handoff",
+                        referrer_id=referrer_id, user_id=user_id)
+    
+    async def handle_handoff(self, message):
+        """Messages from other workers"""
+        try:
+            kind = message['handoff']
+            if kind == 'referral':
+                referrer_id, user_id = message['referrer_id'], message['user_id']
+                credited = False
+                if referrer_id in self.store:
+                    # Re-sent claims: an earlier copy may have credited it already
+                    credited = (await self.credit_referral(referrer_id, user_id) or
+                                self.store.referred_by(user_id) == referrer_id)
+                else:
+                    update_log.info("⚠️ Invalid referrer: %s", referrer_id, event="invalid_referrer",
+                                    referrer_id=referrer_id)
+                self.send_to_worker(message['reply_to'], {
+                    'handoff': 'referral_result',
+                    'referrer_id': referrer_id,
+                    'user_id': user_id,
+                    'credited': credited
+                })
+            elif kind == 'referral_result':
+                if message['credited']:
+                    self.handoffs.acknowledge(message['user_id'], message['referrer_id'])
+                else:
+                    # Referrer rejected it - user may still be referred by someone else
+                    self.handoffs.release(message['user_id'], message['referrer_id'])
+        except Exception as e:
+            logger.error("❌ Handoff error: %s", e)
+    
+    def send_handoff(self, referrer_id, user_id):
+        return self.send_to_worker(partition_of(referrer_id, self.workers), {
+            'handoff': 'referral',
+            'referrer_id': referrer_id,
+            'user_id': user_id,
+            'reply_to': self.worker_index
+        })
+    
+    def send_to_worker(self, worker_index, message):
+        """Control queues are unbounded - only fails if the queue is gone"""
+        try:
+            self.peers[worker_index].put_nowait(message)
+            return True
+        except Exception as e:
+            logger.error("❌ Worker %s queue error: %s", worker_index, e)
+            return False
+    
+    async def handoff_retry_job(self, context: ContextTypes.DEFAULT_TYPE):
+        """Re-send claims that never got an answer (lost to a stop or a crashed worker),
+        settle credited ones onto the user's record"""
+        try:
+            pending = self.handoffs.pending()
+            for user_id, referrer_id in pending:
+                self.send_handoff(referrer_id, user_id)
+            if pending:
+                logger.info(f"🧩 Re-sent {len(pending)} unanswered referral hand-offs")
+            await self.settle_handoffs()
+        except Exception as e:
+            logger.error(f"❌ Handoff retry error: {e}")
+    
+    async def settle_handoffs(self):
+        """Credited claims -> referred_by on the user's record, then out of the ledger"""
+        await self.store.wait_ready()
+        # No record yet (hand-off answered before /start created it) - next run
+        settled = [user_id for user_id, referrer_id in self.handoffs.unsettled()
+                   if self.store.mark_referred(user_id, referrer_id)]
+        # Marker durable before the ledger forgets the claim
+        if settled and await self.store.flush_async():
+            for user_id in settled:
+                self.handoffs.settle(user_id)
+    
+    async def credit_referral(self, referrer_id, user_id):
+        """Credit a referral to a referrer this worker owns - True if credited"""
+        # Duplicate check needs the full referred_by index
+        await self.store.wait_ready()
+        # 🔒 Referrer + new user locked - parallel referrals never lose updates
+        async with self.locks.hold(referrer_id, user_id):
+            referrer_info = self.store.get(referrer_id)
+            
+            # Get current referrals count BEFORE adding
+            current_referrals = referrer_info['referral_count'] if referrer_info else 0
+            
+            update_log.info("🔗 Referral for %s, Current: %s refs", referrer_id, current_referrals,
+                            event="referral", referrer_id=referrer_id, user_id=user_id)
+            
+            # ✅ ADD REFERRAL + points (for tracking only, not notifying)
+            credited = (referrer_info is not None and
+                        not self.already_claimed(user_id) and
+                        self.store.add_referral(referrer_id, user_id, self.config['REFERRAL_POINTS']))
+            if credited:
+                # Get NEW referrals count
+                referrer_info = self.store.get(referrer_id)
+                new_referrals_count = referrer_info['referral_count']
+                self.status_views.forget(referrer_id)
         
-        # ✅ REFERRAL PROCESSING - MODIFIED
-        if context.args and len(context.args) > 0:
-            referrer_id = context.args[0]
+        # 📤 Network I/O outside the lock
+        if credited:
+            update_log.info("✅ %s now has %s refs", referrer_id, new_referrals_count,
+                            event="referral_credited", referrer_id=referrer_id, referrals=new_referrals_count)
             
-            # Validate referrer
-            if (referrer_id.isdigit() and 
-                referrer_id != user_id and 
-                referrer_id in user_data):
-                
-                # Get current referrals count BEFORE adding
-                current_referrals = len(user_data[referrer_id].get('referrals', []))
-                
-                logger.info(f"🔗 Referral for {referrer_id}, Current: {current_referrals} refs")
-                
-                # Initialize if needed
-                if 'referrals' not in user_data[referrer_id]:
-                    user_data[referrer_id]['referrals'] = []
-                
-                # Check if already referred
-                if user_id not in user_data[referrer_id]['referrals']:
-                    # ✅ ADD REFERRAL
-                    user_data[referrer_id]['referrals'].append(user_id)
+            # ✅ NOTIFICATION LOGIC - MODIFIED
+            try:
+                # 🚨 ONLY SEND NOTIFICATIONS IF LESS THAN 3 REFERRALS
+                if current_referrals < self.config['REQUIRED_REFERRALS']:
+                    # Referrer's language isn't stored - default locale
+                    texts = self.templates.default
                     
-                    # ✅ Update points (for tracking only, not notifying)
-                    user_data[referrer_id]['points'] = user_data[referrer_id].get('points', 0) + self.config['REFERRAL_POINTS']
+                    # Current user has less than 3 referrals
+                    if new_referrals_count < self.config['REQUIRED_REFERRALS']:
+                        # Still less than 3 - Send normal notification
+                        points_msg = texts.render(
+                            'points_received',
+                            referrals=new_referrals_count,
+                            points=referrer_info.get('points', 0),
+                            remaining=self.config['REQUIRED_REFERRALS'] - new_referrals_count
+                        )
+                        self.outbound.send(
+                            chat_id=int(referrer_id),
+                            text=points_msg,
+                            parse_mode='Markdown'
+                        )
                     
-                    # Save data
-                    self.save_user_data(user_data)
-                    
-                    # Get NEW referrals count
-                    new_referrals_count = len(user_data[referrer_id]['referrals'])
-                    
-                    logger.info(f"✅ {referrer_id} now has {new_referrals_count} refs")
-                    
-                    # ✅ NOTIFICATION LOGIC - MODIFIED
-                    try:
-                        # 🚨 ONLY SEND NOTIFICATIONS IF LESS THAN 3 REFERRALS
-                        if current_referrals < self.config['REQUIRED_REFERRALS']:
-                            # Current user has less than 3 referrals
-                            if new_referrals_count < self.config['REQUIRED_REFERRALS']:
-                                # Still less than 3 - Send normal notification
-                                points_msg = f"""
-🎉 **+{self.config['REFERRAL_POINTS']} Point Received!**
-
-📊 **Your Progress:**
-• Referrals: {new_referrals_count}/{self.config['REQUIRED_REFERRALS']}
-• Points: {user_data[referrer_id].get('points', 0)}
-
-🎯 **Only {self.config['REQUIRED_REFERRALS'] - new_referrals_count} more needed!**
-"""
-                                await context.bot.send_message(
-                                    chat_id=int(referrer_id),
-                                    text=points_msg,
-                                    parse_mode='Markdown'
-                                )
-                            
-                            # ✅ Check if user JUST REACHED 3 referrals
-                            elif new_referrals_count == self.config['REQUIRED_REFERRALS']:
-                                # User JUST completed 3 referrals - Send FINAL message
-                                channel_msg = f"""
-🎉 **CONGRATULATIONS!**
-
-✅ You have completed {self.config['REQUIRED_REFERRALS']} referrals!
-
-📺 **You can now join the channel:**
-{self.config['MOVIE_CHANNEL_LINK']}
-
-🚀 **Send join request to get auto-approved!**
-"""
-                                await context.bot.send_message(
-                                    chat_id=int(referrer_id),
-                                    text=channel_msg,
-                                    parse_mode='Markdown'
-                                )
-                                
-                                # Notify admin
-                                await self.notify_admin(context, user_data[referrer_id], referrer_id)
-                                logger.info(f"🎯 {referrer_id} completed {self.config['REQUIRED_REFERRALS']} refs - FINAL MSG SENT")
+                    # ✅ Check if user JUST REACHED 3 referrals
+                    elif new_referrals_count == self.config['REQUIRED_REFERRALS']:
+                        # User JUST completed 3 referrals - Send FINAL message
+                        self.outbound.send(
+                            chat_id=int(referrer_id),
+                            text=texts.completed,
+                            parse_mode='Markdown'
+                        )
                         
-                        # 🚨 If user already had 3+ referrals - COMPLETELY SILENT
-                        # No notification sent for 4th, 5th, etc referrals
+                        # Parked join request? approve it now (own task, bounded)
+                        if referrer_id in self.join_requests:
+                            self.application.create_task(self.approve_pending(referrer_id))
                         
-                    except Exception as e:
-                        logger.error(f"❌ Notification error: {e}")
-                else:
-                    logger.info(f"⚠️ Already referred: {user_id}")
-            else:
-                logger.info(f"⚠️ Invalid referrer: {referrer_id}")
-        
-        # Initialize/update user
-        if user_id not in user_data:
-            user_data[user_id] = {
-                'points': 0,
-                'referrals': [],
-                'is_approved': False,
-                'username': user.username,
-                'first_name': user.first_name,
-                'registered_at': datetime.now().isoformat(),
-                'last_activity': datetime.now().isoformat()
-            }
+                        # Notify admin
+                        self.notify_admin(referrer_info, referrer_id)
+                        logger.info("🎯 %s completed %s refs - FINAL MSG SENT", referrer_id, self.config['REQUIRED_REFERRALS'])
+                
+                # 🚨 If user already had 3+ referrals - COMPLETELY SILENT
+                # No notification sent for 4th, 5th, etc referrals
+                
+            except Exception as e:
+                logger.error("❌ Notification error: %s", e)
         else:
-            user_data[user_id]['last_activity'] = datetime.now().isoformat()
-        
-        self.save_user_data(user_data)
-        
-        user_info = user_data[user_id]
-        referral_link = self.get_referral_link(user_id)
-        
-        # Welcome message
-        welcome_text = f"""
-🤖 **Welcome to Referral Bot!** {user.first_name}
-
-📊 **Your Status:**
-• Points: {user_info['points']}
-• Referrals: {len(user_info['referrals'])}/{self.config['REQUIRED_REFERRALS']}
-
-📨 **Your Link:**
-`{referral_link}`
-
-**📋 Rules:**
-1. Share link with {self.config['REQUIRED_REFERRALS']} people
-2. Complete referrals for channel access
-3. Auto-approval system
-
-**🎯 Target: {self.config['REQUIRED_REFERRALS']} Referrals**
-"""
+            update_log.info("⚠️ Already referred: %s (by %s)", user_id, self.store.referred_by(user_id),
+                            event="already_referred", user_id=user_id)
+        return credited
+    
+    async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /start command - SILENT AFTER 3 REFERRALS"""
+        user = update.effective_user
+        user_id = str(user.id)
         
-        share_url = f"https://t.me/share/url?url={referral_link}&text=Join this bot!"
+        update_log.info("📥 /start from: %s", user_id, event="start", user_id=user_id)
         
-        keyboard = [
-            [InlineKeyboardButton("📱 Share Link", url=share_url)],
-            [InlineKeyboardButton("📊 My Status", callback_data="status")]
-        ]
+        # ✅ REFERRAL PROCESSING - MODIFIED
+        if context.args and len(context.args) > 0:
+            referrer_id = context.args[0]
+            
+            # Validate referrer
+            if (referrer_id.isdigit() and 
+                referrer_id != user_id and 
+                not self.owns(referrer_id)):
+                # 🧩 Referrer lives on another worker - hand off
+                await self.hand_off_referral(referrer_id, user_id)
+            elif (referrer_id.isdigit() and 
+                referrer_id != user_id and 
+                referrer_id in self.store):
+                await self.credit_referral(referrer_id, user_id)
+            else:
+                update_log.info("⚠️ Invalid referrer: %s", referrer_id, event="invalid_referrer",
+                                referrer_id=referrer_id)
+        
+        # Initialize/update user
+        async with self.locks.hold(user_id):
+            if user_id not in self.store:
+                user_info = self.store.create_user(user_id, user.username, user.first_name)
+            else:
+                self.store.touch(user_id)
+                # Back after blocking the bot - broadcasts reach them again
+                self.store.mark_blocked(user_id, False)
+                user_info = self.store.get(user_id)
+        texts = self.templates.locale(user.language_code)
         
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        # Welcome message
+        welcome_text = texts.render(
+            'welcome',
+            name=user.first_name,
+            points=user_info['points'],
+            referrals=user_info['referral_count'],
+            link=self.get_referral_link(user_id)
+        )
+        reply_markup = self.templates.start_keyboard(user_id, texts)
         
         await update.message.reply_text(welcome_text, reply_markup=reply_markup, parse_mode='Markdown')
     
@@ -390,98 +4201,118 @@ class ReferralBot:
         join_request = update.chat_join_request
         user_id = str(join_request.from_user.id)
         
-        user_data = self.load_user_data()
-        
-        if user_id in user_data:
-            user_info = user_data[user_id]
-            referrals_count = len(user_info.get('referrals', []))
+        # 🔒 Duplicate join requests for one user are handled one at a time
+        async with self.locks.hold(user_id):
+            user_info = self.store.get(user_id)
             
-            if referrals_count >= self.config['REQUIRED_REFERRALS']:
-                # Auto-approve
-                success = await self.approve_channel_request(int(user_id), context)
-                if success:
-                    user_data[user_id]['is_approved'] = True
-                    user_data[user_id]['approved_at'] = datetime.now().isoformat()
-                    self.save_user_data(user_data)
+            if user_info is not None:
+                referrals_count = user_info.get('referral_count', 0)
+                
+                if referrals_count >= self.config['REQUIRED_REFERRALS']:
+                    # Auto-approve
+                    success = await self.approve_channel_request(int(user_id), context)
+                    if success:
+                        self.join_requests.remove(user_id)
+                        self.store.mark_approved(user_id)
+                elif self.config['JOIN_REQUEST_DEFERRED']:
+                    # ⏳ Not enough referrals yet - park, approved when target is reached
+                    self.join_requests.add(user_id)
+                    update_log.info("⏳ Join request parked: %s (%s refs)", user_id, referrals_count,
+                                    event="join_parked", user_id=user_id)
+                else:
+                    # Decline - not enough referrals
+                    await self.decline_channel_request(int(user_id), context)
+            elif self.config['JOIN_REQUEST_DEFERRED']:
+                # ⏳ Not registered yet - may still /start and collect referrals
+                self.join_requests.add(user_id)
+                update_log.info("⏳ Join request parked: %s (not registered)", user_id,
+                                event="join_parked", user_id=user_id)
             else:
-                # Decline - not enough referrals
+                # Decline - not registered
                 await self.decline_channel_request(int(user_id), context)
-        else:
-            # Decline - not registered
-            await self.decline_channel_request(int(user_id), context)
     
     async def status(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Show user status"""
         query = update.callback_query
         if query:
-            await query.answer()
             user_id = str(query.from_user.id)
             message = query.message
         else:
             user_id = str(update.effective_user.id)
             message = update.message
         
-        user_data = self.load_user_data()
+        texts = self.templates.locale(update.effective_user.language_code)
+        
+        if query and self.status_views.debounced(user_id):
+            # 🔁 Tapped again inside the debounce window - same answer, no edit
+            await query.answer(texts.texts['answer_updated'])
+            return
+        if query:
+            await query.answer()
+        
+        # Taps already in flight for this user share one computation
+        view, shared = await self.status_views.run(
+            user_id, lambda: self.status_view(user_id, texts, context)
+        )
         
-        if user_id not in user_data:
-            text = "❌ Use /start first."
+        if view is None:
+            text = texts.texts['not_started']
             if query:
                 await query.edit_message_text(text)
             else:
                 await message.reply_text(text)
             return
+        if query and shared:
+            # Another tap's edit shows the same status
+            return
         
-        user_info = user_data[user_id]
-        referral_link = self.get_referral_link(user_id)
+        status_text, reply_markup = view
+        try:
+            if query:
+                await query.edit_message_text(status_text, reply_markup=reply_markup, parse_mode='Markdown')
+            else:
+                await message.reply_text(status_text, reply_markup=reply_markup, parse_mode='Markdown')
+        except BadRequest as e:
+            if "Message is not modified" in str(e):
+                if query:
+                    await query.answer(texts.texts['answer_updated'])
+    
+    async def status_view(self, user_id, texts, context):
+        """Status text + keyboard for one user (None if not registered)"""
+        user_info = self.store.get(user_id)
+        if user_info is None:
+            return None
         
-        # Update activity
-        user_info['last_activity'] = datetime.now().isoformat()
-        user_data[user_id] = user_info
-        self.save_user_data(user_data)
+        # Update activity (throttled in the store)
+        async with self.locks.hold(user_id):
+            if user_id in self.store:
+                self.store.touch(user_id)
         
         # Check channel status
         in_channel = await self.is_user_in_channel(int(user_id), context)
         
-        status_text = f"""
-📊 **YOUR STATUS**
-
-👤 **User:** {user_info.get('first_name', 'User')}
-🏆 **Points:** {user_info['points']}
-👥 **Referrals:** {len(user_info['referrals'])}/{self.config['REQUIRED_REFERRALS']}
-📺 **Channel:** {'✅ Joined' if in_channel else '❌ Not Joined'}
-🔗 **Your Link:** `{referral_link}`
-
-"""
-        
-        keyboard = []
+        status_text = texts.render(
+            'status',
+            name=user_info.get('first_name', 'User'),
+            points=user_info['points'],
+            referrals=user_info['referral_count'],
+            channel=texts.texts['status_joined' if in_channel else 'status_not_joined'],
+            link=self.get_referral_link(user_id)
+        )
         
-        if len(user_info['referrals']) >= self.config['REQUIRED_REFERRALS']:
+        if user_info['referral_count'] >= self.config['REQUIRED_REFERRALS']:
             if not in_channel:
-                status_text += "✅ **Eligible for channel access!**\n"
-                keyboard.append([InlineKeyboardButton("🎬 Join Channel", 
-                                                    url=self.config['MOVIE_CHANNEL_LINK'])])
+                status_text += texts.texts['status_eligible']
+                reply_markup = texts.status_eligible_keyboard
             else:
-                status_text += "🎉 **Already in channel!**\n"
+                status_text += texts.texts['status_in_channel']
+                reply_markup = texts.status_in_channel_keyboard
         else:
-            needed = self.config['REQUIRED_REFERRALS'] - len(user_info['referrals'])
-            status_text += f"🎯 **Need {needed} more referral{'s' if needed > 1 else ''}**\n"
-            keyboard.append([InlineKeyboardButton("📱 Share Link", 
-                                                url=f"https://t.me/share/url?url={referral_link}&text=Join!")])
-        
-        keyboard.append([InlineKeyboardButton("🔄 Refresh", callback_data="status")])
-        keyboard.append([InlineKeyboardButton("🏠 Home", callback_data="home")])
+            needed = self.config['REQUIRED_REFERRALS'] - user_info['referral_count']
+            status_text += texts.render('status_need_many' if needed > 1 else 'status_need_one', needed=needed)
+            reply_markup = self.templates.status_need_keyboard(user_id, texts)
         
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        try:
-            if query:
-                await query.edit_message_text(status_text, reply_markup=reply_markup, parse_mode='Markdown')
-            else:
-                await message.reply_text(status_text, reply_markup=reply_markup, parse_mode='Markdown')
-        except BadRequest as e:
-            if "Message is not modified" in str(e):
-                if query:
-                    await query.answer("✅ Updated!")
+        return status_text, reply_markup
     
     async def home(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Return to home screen"""
@@ -489,48 +4320,30 @@ class ReferralBot:
         await query.answer()
         
         user_id = str(query.from_user.id)
-        user_data = self.load_user_data()
+        texts = self.templates.locale(query.from_user.language_code)
+        user_info = self.store.get(user_id)
         
-        if user_id not in user_data:
-            await query.edit_message_text("❌ Use /start first.")
+        if user_info is None:
+            await query.edit_message_text(texts.texts['not_started'])
             return
         
-        user_info = user_data[user_id]
-        referral_link = self.get_referral_link(user_id)
-        
-        home_text = f"""
-🏠 **Referral Bot Home**
-
-📊 **Progress:**
-• Points: {user_info['points']}
-• Referrals: {len(user_info['referrals'])}/{self.config['REQUIRED_REFERRALS']}
-
-📨 **Your Link:**
-`{referral_link}`
-
-**Next Steps:**
-1. Share link 👥
-2. Complete {self.config['REQUIRED_REFERRALS']} referrals ✅
-3. Join channel 📺
-"""
-        
-        keyboard = [
-            [InlineKeyboardButton("📱 Share Link", 
-                                 url=f"https://t.me/share/url?url={referral_link}&text=Join!")],
-            [InlineKeyboardButton("📊 My Status", callback_data="status")],
-            [InlineKeyboardButton("❓ Help", callback_data="help")]
-        ]
-        
-        if len(user_info['referrals']) >= self.config['REQUIRED_REFERRALS']:
-            keyboard.insert(2, [InlineKeyboardButton("🎬 Join Channel", url=self.config['MOVIE_CHANNEL_LINK'])])
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        home_text = texts.render(
+            'home',
+            points=user_info['points'],
+            referrals=user_info['referral_count'],
+            link=self.get_referral_link(user_id)
+        )
+        reply_markup = self.templates.home_keyboard(
+            user_id,
+            user_info['referral_count'] >= self.config['REQUIRED_REFERRALS'],
+            texts
+        )
         
         try:
             await query.edit_message_text(home_text, reply_markup=reply_markup, parse_mode='Markdown')
         except BadRequest as e:
             if "Message is not modified" in str(e):
-                await query.answer("✅ On home!")
+                await query.answer(texts.texts['answer_home'])
     
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Show help information"""
@@ -541,34 +4354,10 @@ class ReferralBot:
         else:
             message = update.message
         
-        help_text = f"""
-❓ **Referral Bot Help**
-
-**🤔 How it works:**
-1. /start - Get referral link
-2. Share with {self.config['REQUIRED_REFERRALS']} people
-3. Complete referrals
-4. Join channel (auto-approved)
-
-**📋 Commands:**
-/start - Start bot
-/status - Check status
-/help - This message
-/admin - Admin stats
-
-**🎯 Notes:**
-- {self.config['REQUIRED_REFERRALS']} referrals required
-- Auto-approval for eligible users
-- No notifications after completion
-"""
-        
-        keyboard = [
-            [InlineKeyboardButton("🏠 Home", callback_data="home")],
-            [InlineKeyboardButton("📊 Status", callback_data="status")],
-            [InlineKeyboardButton("🚀 Start", callback_data="start_callback")]
-        ]
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        # Fully static - text and keyboard compiled at startup
+        texts = self.templates.locale(update.effective_user.language_code)
+        help_text = texts.help
+        reply_markup = texts.help_keyboard
         
         try:
             if query:
@@ -578,12 +4367,13 @@ class ReferralBot:
         except BadRequest as e:
             if "Message is not modified" in str(e):
                 if query:
-                    await query.answer("✅ Help shown!")
+                    await query.answer(texts.texts['answer_help'])
     
     async def start_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle start callback"""
         query = update.callback_query
-        await query.answer("Use /start in chat!")
+        texts = self.templates.locale(query.from_user.language_code)
+        await query.answer(texts.texts['answer_use_start'])
     
     async def admin_stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Show admin statistics"""
@@ -593,31 +4383,51 @@ class ReferralBot:
             await update.message.reply_text("❌ Admin only.")
             return
         
-        self.cleanup_old_users()
-        
-        user_data = self.load_user_data()
-        total_users = len(user_data)
-        
-        completed_users = 0
-        total_referrals = 0
-        
-        for info in user_data.values():
-            referrals_count = len(info.get('referrals', []))
-            total_referrals += referrals_count
-            
-            if referrals_count >= self.config['REQUIRED_REFERRALS']:
-                completed_users += 1
+        # ✅ Maintained counters - no scan, no cleanup here (totals complete once loaded)
+        await self.store.wait_ready()
+        stats = self.store.stats
         
-        pending_users = total_users - completed_users
+        trend_lines = "\n".join(
+            f"• {label}: +{stats.trend('registrations', window)} users, "
+            f"+{stats.trend('referrals', window)} refs, "
+            f"+{stats.trend('completions', window)} completed, "
+            f"+{stats.trend('approvals', window)} approved"
+            for label, window in stats.TRENDS
+        )
+        day_lines = "\n".join(f"• {day}: {count}" for day, count in stats.recent_days())
         
         stats_text = f"""
-📊 **ADMIN STATS**
+📊 **ADMIN STATS**{self.worker_label()}
 
 👥 **Users:**
-• Total: {total_users}
-• Completed: {completed_users}
-• Pending: {pending_users}
-• Total Referrals: {total_referrals}
+• Total: {stats.total_users}
+• Completed: {stats.completed}
+• Pending: {stats.pending}
+• Total Referrals: {stats.total_referrals}
+• Approved: {stats.approved}
+• Join requests waiting: {len(self.join_requests)}
+
+📈 **Trends:**
+{trend_lines}
+
+🗓️ **Registrations per day:**
+{day_lines}
+
+📺 **Membership Cache:**
+• Entries: {len(self.membership)}
+• Hits: {self.membership.hits}
+• Misses: {self.membership.misses}
+• Hit rate: {self.membership.hit_rate:.1f}%
+
+📤 **Outbound:**
+• Queued: {len(self.outbound)}
+• Sent: {self.outbound.sent}
+• Retried: {self.outbound.retried}
+• Failed: {self.outbound.failed}
+• Dropped (queue full): {self.outbound.dropped}
+
+🛡️ **Ingress:**
+{self.ingress_lines()}
 
 💾 **System:**
 • Bot: @{self.config['BOT_USERNAME']}
@@ -625,29 +4435,666 @@ class ReferralBot:
         
         await update.message.reply_text(stats_text, parse_mode='Markdown')
     
+    def ingress_lines(self):
+        """Allowed / dropped per update kind for /admin and /metrics"""
+        if not self.config['INGRESS_LIMITS_ENABLED']:
+            return "• Disabled"
+        ingress = self.ingress
+        return "\n".join(
+            f"• {kind.replace('_', ' ')}: {ingress.allowed[kind]} allowed, "
+            f"{ingress.dropped[(kind, 'user')]} dropped per-user, "
+            f"{ingress.dropped[(kind, 'global')]} dropped global"
+            for kind in ingress.budgets
+        )
+    
+    def register_gauges(self):
+        """Queue depths, sizes + totals kept by other objects, sampled on every scrape"""
+        self.metrics.gauge('queue_depth', lambda: len(self.outbound), queue="outbound")
+        self.metrics.gauge('queue_depth', lambda: len(self.digest.events), queue="admin_digest")
+        self.metrics.gauge('queue_depth', lambda: self.store.pending_count(), queue="store_writes")
+        self.metrics.gauge(
+            'queue_depth',
+            lambda: self.application.update_queue.qsize() if self.application else 0,
+            queue="updates"
+        )
+        self.metrics.gauge('queue_depth', lambda: len(self.join_requests), queue="join_requests")
+        self.metrics.gauge('users', lambda: self.store.stats.total_users)
+        self.metrics.gauge('store_ready', lambda: int(self.store.ready))
+        self.metrics.counter_sample('status_views_total', lambda: self.status_views.computed, result="computed")
+        self.metrics.counter_sample('status_views_total', lambda: self.status_views.coalesced, result="coalesced")
+        for result in ('sent', 'retried', 'failed', 'dropped'):
+            self.metrics.counter_sample('outbound_messages_total',
+                                        lambda result=result: getattr(self.outbound, result), result=result)
+        self.metrics.gauge('log_lines', lambda: update_log.written, result="written")
+        self.metrics.gauge('log_lines', lambda: update_log.sampled_out, result="sampled_out")
+        self.metrics.gauge('log_lines', lambda: log_handler.dropped if log_handler else 0, result="dropped")
+        self.metrics.gauge('queue_depth', lambda: log_handler.queue.qsize() if log_handler else 0, queue="log")
+        for kind in self.ingress.budgets:
+            self.metrics.gauge('ingress_allowed', lambda kind=kind: self.ingress.allowed[kind], kind=kind)
+        self.metrics.gauge('ingress_tracked_users', lambda: len(self.ingress.user_buckets))
+        for result in ('sent', 'blocked', 'failed'):
+            self.metrics.gauge('broadcast_messages',
+                               lambda result=result: (self.broadcaster.state or {}).get(result, 0), result=result)
+    
+    async def start_metrics_server(self):
+        """Local /metrics endpoint - a busy port only costs the endpoint"""
+        if not self.config['METRICS_ENABLED'] or self.metrics_server:
+            return
+        
+        async def scrape(method, headers, body):
+            return 200, "text/plain; version=0.0.4", self.metrics.render().encode('utf-8')
+        
+        server = HttpServer(
+            self.config['METRICS_LISTEN'],
+            self.config['METRICS_PORT'] + (self.worker_index if self.workers > 1 else 0),
+            {"/metrics": scrape},
+            max_connections=4
+        )
+        try:
+            await server.start()
+            self.metrics_server = server
+        except OSError as e:
+            logger.error(f"❌ Metrics endpoint error: {e}")
+    
+    async def metrics_summary(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Admin: latency / error / queue summary"""
+        if str(update.effective_user.id) != self.config['ADMIN_USER_ID']:
+            await update.message.reply_text("❌ Admin only.")
+            return
+        
+        def ms(seconds):
+            return "inf" if seconds == float('inf') else f"{seconds * 1000:.0f}"
+        
+        def rows(name, label, error_name=None):
+            lines = []
+            for labels, h in sorted(self.metrics.select(name).items(), key=lambda item: -item[1].count):
+                key = dict(labels)[label]
+                errors = f", {self.metrics.counter(error_name, **{label: key})} err" if error_name else ""
+                lines.append(f"• {key}: {h.count}x, avg {h.mean * 1000:.1f}ms, "
+                             f"p95 ≤{ms(h.quantile(0.95))}ms, p99 ≤{ms(h.quantile(0.99))}ms{errors}")
+            return "\n".join(lines) or "• -"
+        
+        text = f"""
+📈 **METRICS**{self.worker_label()}
+
+⚙️ **Handlers:**
+{rows('handler_seconds', 'handler', 'handler_errors_total')}
+
+📡 **Telegram API:**
+{rows('api_seconds', 'method', 'api_errors_total')}
+
+💾 **Storage:**
+{rows('storage_seconds', 'op')}
+
+📥 **Queues:**
+• Updates: {self.application.update_queue.qsize() if self.application else 0}
+• Outbound: {len(self.outbound)}
+• Admin digest: {len(self.digest.events)}
+• Unflushed writes: {self.store.pending_count()}
+• Log: {log_handler.queue.qsize() if log_handler else 0} queued, {log_handler.dropped if log_handler else 0} dropped
+
+📝 **Update log lines:** {update_log.written} written, {update_log.sampled_out} sampled out
+
+🛡️ **Ingress:**
+{self.ingress_lines()}
+"""
+        # Label values (handler names, API methods) contain underscores
+        await update.message.reply_text(text.replace("_", "\\_"), parse_mode='Markdown')
+    
+    async def broadcast(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Admin: /broadcast <text> | reply to a message with /broadcast | /broadcast status|stop|resume"""
+        if str(update.effective_user.id) != self.config['ADMIN_USER_ID']:
+            await update.message.reply_text("❌ Admin only.")
+            return
+        
+        message = update.message
+        broadcaster = self.broadcaster
+        action = context.args[0].lower() if len(context.args) == 1 else None
+        
+        if action == 'stop':
+            if broadcaster.state is None or broadcaster.state.get('finished_at'):
+                await message.reply_text("📣 No broadcast running.")
+                return
+            await broadcaster.cancel()
+            await message.reply_text(self.broadcast_text(broadcaster.state))
+            return
+        
+        if action == 'resume':
+            if not broadcaster.resumable:
+                await message.reply_text("📣 Nothing to resume.")
+                return
+            broadcaster.resume(context.bot)
+            await message.reply_text(self.broadcast_text(broadcaster.state))
+            return
+        
+        text = message.text.split(None, 1)[1] if len(message.text.split(None, 1)) > 1 else ""
+        if action == 'status' or (not text and not message.reply_to_message):
+            if broadcaster.state is None:
+                await message.reply_text("📣 No broadcast yet.\n\n"
+                                         "/broadcast <text> - or reply /broadcast to a message to copy it")
+            else:
+                await message.reply_text(self.broadcast_text(broadcaster.state))
+            return
+        
+        if broadcaster.running or broadcaster.resumable:
+            await message.reply_text("⚠️ A broadcast is already in progress - /broadcast stop first.")
+            return
+        
+        if message.reply_to_message:
+            # copy_message keeps media, formatting and buttons
+            payload = {'from_chat_id': message.chat_id, 'message_id': message.reply_to_message.message_id}
+        else:
+            payload = {'text': text}
+        broadcaster.start(context.bot, payload, message.chat_id)
+        progress = await message.reply_text(self.broadcast_text(broadcaster.state))
+        broadcaster.state['progress_message_id'] = progress.message_id
+    
+    def broadcast_text(self, state):
+        """Progress / result of a broadcast for the admin"""
+        processed = state['sent'] + state['blocked'] + state['failed']
+        ended = state.get('finished_at')
+        elapsed = max(1, (ended or int(time.time())) - state['started_at'])
+        rate = processed / elapsed
+        remaining = max(0, state['total'] - processed)
+        
+        if state.get('cancelled'):
+            title = "🛑 Broadcast stopped"
+        elif ended:
+            title = "✅ Broadcast finished"
+        elif self.broadcaster.running:
+            title = "📣 Broadcast running"
+        else:
+            title = "⏸️ Broadcast paused"
+        
+        lines = [
+            title + self.worker_label(),
+            "",
+            f"• Sent: {state['sent']}",
+            f"• Blocked (skipped from now on): {state['blocked']}",
+            f"• Failed: {state['failed']}",
+            f"• Progress: {processed}/{state['total']}",
+            f"• Rate: {rate:.1f} msg/s"
+        ]
+        if not ended and rate > 0:
+            lines.append(f"• ETA: {timedelta(seconds=int(remaining / rate))}")
+        return "\n".join(lines)
+    
+    async def broadcast_progress(self, state, finished):
+        """Live progress: edit the admin's progress message, new message once finished"""
+        bot = self.application.bot
+        text = self.broadcast_text(state)
+        if finished or state.get('progress_message_id') is None:
+            sent = await bot.send_message(chat_id=state['admin_chat_id'], text=text)
+            state['progress_message_id'] = sent.message_id
+            return
+        try:
+            await bot.edit_message_text(chat_id=state['admin_chat_id'],
+                                        message_id=state['progress_message_id'], text=text)
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                raise
+    
+    def worker_label(self):
+        return f" (worker {self.worker_index + 1}/{self.workers})" if self.workers > 1 else ""
+    
+    async def top_referrers(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Admin: /top [n] - n users with the most referrals"""
+        if str(update.effective_user.id) != self.config['ADMIN_USER_ID']:
+            await update.message.reply_text("❌ Admin only.")
+            return
+        
+        size = self.config['TOP_DEFAULT_SIZE']
+        if context.args and context.args[0].isdigit():
+            size = max(1, min(int(context.args[0]), self.config['TOP_MAX_SIZE']))
+        
+        # Leaderboard is complete once everything is loaded
+        await self.store.wait_ready()
+        lines = [f"🏆 **TOP {size} REFERRERS**{self.worker_label()}", ""]
+        for rank, (user_id, count) in enumerate(self.store.top_referrers(size), 1):
+            user_info = self.store.get(user_id) or {}
+            name = escape_markdown(str(user_info.get('first_name') or 'N/A'))
+            username = escape_markdown(str(user_info.get('username') or 'N/A'))
+            lines.append(f"{rank}. {name} (@{username}, `{user_id}`) - {count} refs")
+        if len(lines) == 2:
+            lines.append("No referrals yet.")
+        
+        await update.message.reply_text("\n".join(lines), parse_mode='Markdown')
+    
+    async def export(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Admin: /export [csv|ndjson] - users + referral edges as gzipped documents"""
+        if str(update.effective_user.id) != self.config['ADMIN_USER_ID']:
+            await update.message.reply_text("❌ Admin only.")
+            return
+        
+        fmt = context.args[0].lower() if context.args else 'csv'
+        if fmt not in ('csv', 'ndjson'):
+            await update.message.reply_text("Usage: /export [csv|ndjson]")
+            return
+        if self.export_task and not self.export_task.done():
+            await update.message.reply_text(f"⏳ An export is already running{self.worker_label()}.")
+            return
+        
+        # Runs in the background - the handler (and the update queue) moves on
+        self.export_task = asyncio.create_task(self.run_export(context.bot, update.effective_chat.id, fmt))
+        await update.message.reply_text(f"⏳ Exporting users + referrals as {fmt}{self.worker_label()}...")
+    
+    async def run_export(self, bot, chat_id, fmt):
+        """Write both export files, send them as documents, then delete them"""
+        await self.store.wait_ready()
+        os.makedirs(self.config['EXPORT_DIR'], exist_ok=True)
+        stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        worker = f"_w{self.worker_index}" if self.workers > 1 else ""
+        
+        files = []
+        try:
+            with self.metrics.timer('storage_seconds', op='export'):
+                for name, fields, batches in (
+                    ('users', EXPORT_USER_FIELDS, self.store.export_users(EXPORT_BATCH_ROWS)),
+                    ('referrals', EXPORT_REFERRAL_FIELDS, self.store.export_referrals(EXPORT_BATCH_ROWS))
+                ):
+                    path = os.path.join(self.config['EXPORT_DIR'], f"export_{stamp}{worker}_{name}.{fmt}.gz")
+                    files.append((path, await write_export(batches, path, fields, fmt)))
+        except Exception as e:
+            logger.error(f"❌ Export error: {e}")
+            await bot.send_message(chat_id=chat_id, text=f"❌ Export failed: {e}")
+            return
+        
+        for path, count in files:
+            size_mb = os.path.getsize(path) / (1024 * 1024)
+            if size_mb > self.config['EXPORT_MAX_UPLOAD_MB']:
+                await bot.send_message(chat_id=chat_id,
+                                       text=f"📦 {os.path.basename(path)}: {count} rows, {size_mb:.1f} MB - "
+                                            f"too big to upload, kept at {path}")
+                continue
+            try:
+                with open(path, 'rb') as f:
+                    await bot.send_document(chat_id=chat_id, document=f, filename=os.path.basename(path),
+                                            caption=f"{count} rows")
+                os.remove(path)
+            except Exception as e:
+                logger.error(f"❌ Export upload error: {e}")
+                await bot.send_message(chat_id=chat_id, text=f"❌ Upload failed ({e}) - kept at {path}")
+        logger.info("📦 Export sent: " + ", ".join(f"{os.path.basename(p)} ({c} rows)" for p, c in files))
+    
+    async def list_backups(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Admin: list backup snapshots"""
+        if str(update.effective_user.id) != self.config['ADMIN_USER_ID']:
+            await update.message.reply_text("❌ Admin only.")
+            return
+        
+        snapshots = self.backups.list_snapshots()
+        if not snapshots:
+            await update.message.reply_text(f"📦 No backups yet{self.worker_label()}.")
+            return
+        
+        lines = [f"📦 Backups (newest first){self.worker_label()}:", ""]
+        for name, size, mtime in reversed(snapshots):
+            taken = datetime.fromtimestamp(mtime).strftime('%Y-%m-%d %H:%M:%S')
+            lines.append(f"• {name} - {size / 1024:.1f} KB - {taken}")
+        lines.append("")
+        lines.append("♻️ Restore: /restore <name>")
+        
+        await update.message.reply_text("\n".join(lines))
+    
+    async def restore_backup(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Admin: restore a backup snapshot"""
+        if str(update.effective_user.id) != self.config['ADMIN_USER_ID']:
+            await update.message.reply_text("❌ Admin only.")
+            return
+        
+        if self.workers > 1:
+            # Every worker snapshots its own shard at its own time - one name can't restore them all
+            await update.message.reply_text("❌ /restore needs WORKERS=1 - restore each shard's backup while stopped.")
+            return
+        
+        if not context.args:
+            await update.message.reply_text("Usage: /restore <name> (see /backups)")
+            return
+        
+        name = context.args[0]
+        try:
+            await self.backups.restore(name)
+            await update.message.reply_text(f"✅ Restored {name} ({len(self.store)} users)")
+        except Exception as e:
+            logger.error(f"❌ Restore error: {e}")
+            await update.message.reply_text(f"❌ Restore failed: {e}")
+    
     def setup_handlers(self, application):
-        """Setup all bot handlers"""
-        application.add_handler(CommandHandler("start", self.start))
-        application.add_handler(CommandHandler("status", self.status))
-        application.add_handler(CommandHandler("help", self.help_command))
-        application.add_handler(CommandHandler("admin", self.admin_stats))
+        """Setup all bot handlers - every callback timed under its own name"""
+        timed = self.metrics.instrument
+        
+        # Runs before everything else - floods are dropped before they cost a store or API call
+        if self.config['INGRESS_LIMITS_ENABLED']:
+            application.add_handler(TypeHandler(Update, self.throttle), group=-2)
+        # Holds updates only while the store can't serve them yet
+        application.add_handler(TypeHandler(Update, self.wait_for_store), group=-1)
+        application.add_handler(CommandHandler("start", timed("start", self.start)))
+        application.add_handler(CommandHandler("status", timed("status", self.status)))
+        application.add_handler(CommandHandler("help", timed("help", self.help_command)))
+        application.add_handler(CommandHandler("admin", timed("admin", self.admin_stats)))
+        application.add_handler(CommandHandler("metrics", timed("metrics", self.metrics_summary)))
+        application.add_handler(CommandHandler("backups", timed("backups", self.list_backups)))
+        application.add_handler(CommandHandler("restore", timed("restore", self.restore_backup)))
+        application.add_handler(CommandHandler("broadcast", timed("broadcast", self.broadcast)))
+        application.add_handler(CommandHandler("top", timed("top", self.top_referrers)))
+        application.add_handler(CommandHandler("export", timed("export", self.export)))
         
-        application.add_handler(ChatJoinRequestHandler(self.handle_chat_join_request))
+        application.add_handler(ChatJoinRequestHandler(timed("join_request", self.handle_chat_join_request)))
+        application.add_handler(ChatMemberHandler(timed("chat_member", self.handle_channel_member),
+                                                  ChatMemberHandler.CHAT_MEMBER))
         
-        application.add_handler(CallbackQueryHandler(self.status, pattern="^status"))
-        application.add_handler(CallbackQueryHandler(self.home, pattern="home"))
-        application.add_handler(CallbackQueryHandler(self.help_command, pattern="help"))
-        application.add_handler(CallbackQueryHandler(self.start_callback, pattern="start_callback"))
+        application.add_handler(CallbackQueryHandler(timed("status_callback", self.status), pattern="^status"))
+        application.add_handler(CallbackQueryHandler(timed("home_callback", self.home), pattern="home"))
+        application.add_handler(CallbackQueryHandler(timed("help_callback", self.help_command), pattern="help"))
+        application.add_handler(CallbackQueryHandler(timed("start_callback", self.start_callback),
+                                                     pattern="start_callback"))
     
-    def run(self):
-        """Start the bot"""
-        self.validate_config()
+    async def flush_job(self, context: ContextTypes.DEFAULT_TYPE):
+        """Background write-behind flush of journal records"""
+        if self.store.pending_count():
+            with self.metrics.timer('storage_seconds', op='flush'):
+                await self.store.flush_async()
+        
+        if self.store.should_compact(self.config['COMPACT_JOURNAL_BYTES']):
+            await self.compact_job(context)
+    
+    async def compact_job(self, context: ContextTypes.DEFAULT_TYPE):
+        """Periodic journal compaction"""
+        if not self.store.ready:
+            return
+        with self.metrics.timer('storage_seconds', op='compact'):
+            await self.store.compact()
+    
+    async def cleanup_job(self, context: ContextTypes.DEFAULT_TYPE):
+        """Periodic inactive-user cleanup"""
+        await self.store.wait_ready()
+        await self.cleanup_old_users()
+    
+    async def join_request_job(self, context: ContextTypes.DEFAULT_TYPE):
+        """Expire / retry parked join requests"""
+        await self.expire_join_requests()
+    
+    async def digest_job(self, context: ContextTypes.DEFAULT_TYPE):
+        """Send pending admin digest"""
+        await self.digest.flush(self.outbound, self.config['ADMIN_USER_ID'])
+    
+    def request_digest(self):
+        """Digest size threshold reached - send right away"""
+        if self.application and self.application.job_queue:
+            self.application.job_queue.run_once(self.digest_job, 0)
+    
+    async def backup_job(self, context: ContextTypes.DEFAULT_TYPE):
+        """Scheduled backup - only when interval/change count is due"""
+        if self.backups.is_due():
+            with self.metrics.timer('storage_seconds', op='backup'):
+                await self.backups.backup_now()
+    
+    def request_flush(self):
+        """Dirty threshold reached - schedule an immediate flush"""
+        if self.application and self.application.job_queue:
+            self.application.job_queue.run_once(self.flush_job, 0)
+    
+    async def throttle(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Group -2 gate: drop updates over the sender's or the bot's ingress budget"""
+        user = update.effective_user
+        if user is None:
+            return
+        kind = ingress_kind(update)
+        if kind is None or str(user.id) == self.config['ADMIN_USER_ID']:
+            return
+        scope = self.ingress.reject(kind, user.id)
+        if scope:
+            # No answer either - a reply per dropped update would be the flood's amplifier
+            self.metrics.inc('ingress_dropped_total', kind=kind, scope=scope)
+            raise ApplicationHandlerStop
+    
+    async def ingress_report_job(self, context: ContextTypes.DEFAULT_TYPE):
+        """Tell the admin when a window dropped more than the threshold"""
+        dropped, offenders = self.ingress.take_window()
+        if dropped <= self.config['INGRESS_ALERT_THRESHOLD']:
+            return
+        
+        top = ", ".join(f"{user_id} ({count})" for user_id, count in offenders)
+        logger.warning(f"🛡️ {dropped} updates dropped by ingress limits - top senders: {top}")
+        self.admin_event(
+            'ingress_flood',
+            f"🛡️ {dropped} updates dropped in {self.config['INGRESS_REPORT_SECONDS']}s - "
+            + ", ".join(f"`{user_id}` ({count})" for user_id, count in offenders)
+        )
+    
+    async def wait_for_store(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Group -1 gate: during warm-up, wait until this update's user can be served"""
+        if self.store.ready:
+            return
+        user = update.effective_user
+        await self.store.wait_for(user.id if user else None)
+    
+    async def warm_up(self):
+        """Load the store in the background, record startup phase timings"""
+        try:
+            with self.metrics.timer('storage_seconds', op='load'):
+                await self.store.load_async()
+            for phase, seconds in self.store.load_timings.items():
+                self.metrics.observe('startup_seconds', seconds, phase=phase)
+            logger.info(f"⏱️ Store ready {time.perf_counter() - self.started_at:.2f}s after start")
+        except Exception as e:
+            # Serving without data would register everyone as new - stop gracefully instead
+            logger.error(f"❌ Store load error: {e}")
+            signal.raise_signal(signal.SIGTERM)
+    
+    async def post_init(self, application):
+        """Start background jobs once the application is ready"""
+        self.application = application
+        if not self.store.ready and self.warm_up_task is None:
+            self.warm_up_task = asyncio.create_task(self.warm_up())
+        self.outbound.start(application.bot)
+        await self.start_metrics_server()
+        if self.broadcaster.resumable:
+            # Interrupted by a restart - carry on from the checkpoint
+            logger.info("📣 Resuming interrupted broadcast")
+            self.broadcaster.resume(application.bot)
+        
+        if application.job_queue:
+            application.job_queue.run_repeating(
+                self.flush_job,
+                interval=self.config['FLUSH_INTERVAL_SECONDS'],
+                first=self.config['FLUSH_INTERVAL_SECONDS']
+            )
+            application.job_queue.run_repeating(
+                self.compact_job,
+                interval=self.config['COMPACT_INTERVAL_SECONDS'],
+                first=self.config['COMPACT_INTERVAL_SECONDS']
+            )
+            application.job_queue.run_repeating(
+                self.cleanup_job,
+                interval=self.config['CLEANUP_INTERVAL_SECONDS'],
+                first=10
+            )
+            application.job_queue.run_repeating(
+                self.digest_job,
+                interval=self.config['ADMIN_DIGEST_INTERVAL_SECONDS'],
+                first=self.config['ADMIN_DIGEST_INTERVAL_SECONDS']
+            )
+            self.digest.on_threshold = self.request_digest
+            application.job_queue.run_repeating(
+                self.join_request_job,
+                interval=self.config['JOIN_REQUEST_CHECK_SECONDS'],
+                first=30
+            )
+            application.job_queue.run_repeating(
+                self.backup_job,
+                interval=self.config['BACKUP_CHECK_SECONDS'],
+                first=self.config['BACKUP_CHECK_SECONDS']
+            )
+            if self.handoffs is not None:
+                # First run replays claims left unanswered by the last shutdown
+                application.job_queue.run_repeating(
+                    self.handoff_retry_job,
+                    interval=self.config['WORKER_HANDOFF_RETRY_SECONDS'],
+                    first=5
+                )
+            if self.config['INGRESS_LIMITS_ENABLED']:
+                application.job_queue.run_repeating(
+                    self.ingress_report_job,
+                    interval=self.config['INGRESS_REPORT_SECONDS'],
+                    first=self.config['INGRESS_REPORT_SECONDS']
+                )
+            self.store.on_threshold = self.request_flush
+        else:
+            logger.warning("⚠️ JobQueue not available - data flushed only on shutdown")
+            self.store.on_threshold = self.store.flush
+        
+        online = time.perf_counter() - self.started_at
+        self.metrics.observe('startup_seconds', online, phase='online')
+        logger.info(f"🚀 Online {online:.2f}s after start"
+                    + ("" if self.store.ready else " - store warming up in the background"))
+    
+    async def post_stop(self, application):
+        """Drain outbound messages while the bot can still send"""
+        if self.warm_up_task and not self.warm_up_task.done():
+            # Snapshot + journal already hold everything - no need to finish
+            self.warm_up_task.cancel()
+        # Checkpointed - resumes on the next start
+        await self.broadcaster.stop()
+        if self.export_task and not self.export_task.done():
+            # Partial files are removed - /export again after the restart
+            self.export_task.cancel()
+        await self.digest.flush(self.outbound, self.config['ADMIN_USER_ID'])
+        await self.outbound.stop(self.config['OUTBOUND_DRAIN_SECONDS'])
+        if self.metrics_server:
+            await self.metrics_server.stop(1)
+    
+    async def post_shutdown(self, application):
+        """Clean flush on shutdown"""
+        with self.metrics.timer('storage_seconds', op='close'):
+            self.store.close()
+        await self.digest.log.flush()
+        await self.join_requests.log.flush()
+        if self.handoffs is not None:
+            await self.handoffs.persisted()
+        logger.info("💾 Final flush done")
+    
+    async def handle_webhook(self, method, headers, body):
+        """Webhook endpoint - verify secret, queue update, answer fast"""
+        error = check_webhook_request(self.config, method, headers)
+        if error:
+            return error
         
-        application = Application.builder().token(self.config['BOT_TOKEN']).build()
+        if not self.application.running:
+            return 503, "text/plain", b"stopping"
         
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except Exception as e:
+            logger.error("❌ Bad webhook payload: %s", e)
+            return 400, "text/plain", b"bad update"
+        
+        await self.application.update_queue.put(update)
+        return 200, "text/plain", b"ok"
+    
+    async def run_webhook(self, application):
+        """Serve updates via webhook until SIGINT/SIGTERM, then drain"""
+        server = HttpServer(
+            self.config['WEBHOOK_LISTEN'],
+            self.config['WEBHOOK_PORT'],
+            {webhook_path(self.config): self.handle_webhook},
+            max_connections=self.config['WEBHOOK_MAX_CONNECTIONS'],
+            header_timeout=self.config['WEBHOOK_HEADER_TIMEOUT_SECONDS'],
+            idle_timeout=self.config['WEBHOOK_KEEPALIVE_SECONDS']
+        )
+        
+        stop_event = asyncio.Event()
+        stop_on_signals(stop_event)
+        
+        await application.initialize()
+        await self.post_init(application)
+        await application.start()
+        try:
+            await register_webhook(application.bot, self.config, self.ALLOWED_UPDATES)
+            await server.start()
+            await stop_event.wait()
+        finally:
+            # 🛑 Graceful drain: stop accepting, finish queued updates, flush
+            logger.info("🛑 Shutting down - draining updates...")
+            await server.stop(self.config['WEBHOOK_DRAIN_SECONDS'])
+            await application.stop()
+            await self.post_stop(application)
+            await application.shutdown()
+            await self.post_shutdown(application)
+    
+    def build_application(self, updater=True):
+        """Application with this bot's hooks and handlers"""
+        builder = (
+            Application.builder()
+            .token(self.config['BOT_TOKEN'])
+            .post_init(self.post_init)
+            .post_stop(self.post_stop)
+            .post_shutdown(self.post_shutdown)
+            .concurrent_updates(self.config['CONCURRENT_UPDATES'])
+            # Same pool size PTB picks by default, wrapped for API timings
+            .request(TimedRequest(HTTPXRequest(connection_pool_size=256), self.metrics))
+        )
+        if not updater:
+            # Updates are put on application.update_queue by us
+            builder = builder.updater(None)
+        application = builder.build()
         self.setup_handlers(application)
+        return application
+    
+    async def run_worker(self, application, inbound, control, peers):
+        """Worker mode: updates arrive on `inbound` from the dispatcher,
+        hand-offs from other workers on `control`"""
+        self.peers = peers
+        for queue in peers:
+            # Exit must not hang on a stopped peer - unanswered claims are re-sent
+            queue.cancel_join_thread()
+        loop = asyncio.get_running_loop()
+        stop_event = asyncio.Event()
+        # Ctrl+C goes to the whole process group - only the dispatcher reacts,
+        # workers stop on its sentinel after draining
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        try:
+            loop.add_signal_handler(signal.SIGTERM, stop_event.set)
+        except NotImplementedError:
+            pass
+        
+        def pump():
+            """Blocking reader thread: inbound queue -> event loop"""
+            while True:
+                item = inbound.get()
+                if item is None:
+                    loop.call_soon_threadsafe(stop_event.set)
+                    return
+                update = Update.de_json(item, application.bot)
+                asyncio.run_coroutine_threadsafe(application.update_queue.put(update), loop)
+        
+        def pump_control():
+            """Hand-offs - own queue so they never wait behind (or drop with) updates"""
+            while True:
+                item = control.get()
+                if loop.is_closed():
+                    # Unanswered claims are re-sent by the sender after restart
+                    return
+                asyncio.run_coroutine_threadsafe(self.handle_handoff(item), loop)
         
-        self.cleanup_old_users()
+        await application.initialize()
+        await self.post_init(application)
+        await application.start()
+        threading.Thread(target=pump, name=f"worker-{self.worker_index}-inbound", daemon=True).start()
+        threading.Thread(target=pump_control, name=f"worker-{self.worker_index}-control", daemon=True).start()
+        logger.info(f"🧩 Worker {self.worker_index + 1}/{self.workers} ready")
+        try:
+            await stop_event.wait()
+        finally:
+            await application.stop()
+            await self.post_stop(application)
+            await application.shutdown()
+            await self.post_shutdown(application)
+    
+    def run(self):
+        """Start the bot"""
+        webhook = self.config['UPDATE_MODE'] == 'webhook'
+        application = self.build_application(updater=not webhook)
         
         print("\n" + "="*60)
         print("🤖 REFERRAL BOT - SILENT MODE")
@@ -655,6 +5102,7 @@ class ReferralBot:
         print(f"📱 Bot: @{self.config['BOT_USERNAME']}")
         print(f"🎯 Required: {self.config['REQUIRED_REFERRALS']} referrals")
         print(f"🔕 Mode: SILENT after completion")
+        print(f"🌐 Updates: {'webhook' if webhook else 'polling'}")
         print("="*60)
         print("✅ No notifications after 3 referrals")
         print("✅ Only final channel link sent")
@@ -663,10 +5111,160 @@ class ReferralBot:
         print("🚀 Bot starting...")
         print("="*60 + "\n")
         
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        if webhook:
+            asyncio.run(self.run_webhook(application))
+        else:
+            application.run_polling(allowed_updates=self.ALLOWED_UPDATES)
+
+# ==================== DISPATCHER ====================
+def worker_main(worker_index, workers, inbound, control, peers):
+    """Worker process entry point"""
+    # One log file per worker - rotation can't be shared between processes
+    setup_logging(CONFIG, shard_path(CONFIG['LOG_FILE'], worker_index, workers))
+    atexit.register(stop_logging)
+    bot = ReferralBot(worker_index, workers)
+    application = bot.build_application(updater=False)
+    asyncio.run(bot.run_worker(application, inbound, control, peers))
+
+
+class UpdateDispatcher:
+    """Front process for WORKERS > 1 - receives updates (polling or webhook)
+    and routes raw JSON to the worker owning the user. Holds no user data."""
+    
+    def __init__(self, config):
+        self.config = config
+        self.workers = config['WORKERS']
+        self.routed = [0] * self.workers
+        self.processes = []
+        self.queues = []
+        self.control = []
+    
+    def start_workers(self):
+        context = multiprocessing.get_context('spawn')
+        self.queues = [context.Queue(self.config['WORKER_QUEUE_SIZE']) for _ in range(self.workers)]
+        # Worker <-> worker hand-offs: unbounded, separate from the update backlog
+        self.control = [context.Queue() for _ in range(self.workers)]
+        for index in range(self.workers):
+            process = context.Process(
+                target=worker_main,
+                args=(index, self.workers, self.queues[index], self.control[index], self.control),
+                name=f"referral-worker-{index}"
+            )
+            process.start()
+            self.processes.append(process)
+        logger.info(f"🧩 {self.workers} workers started")
+    
+    def stop_workers(self, timeout=30):
+        """Sentinel to every worker, then wait for their drain + flush"""
+        for queue in self.queues:
+            queue.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning(f"⚠️ {process.name} did not stop in time - terminating")
+                process.terminate()
+        logger.info(f"✅ Workers stopped - routed per worker: {self.routed}")
+    
+    async def route(self, raw):
+        """Send one raw update to its owner (blocks briefly if that worker is behind)"""
+        owner = update_owner(raw)
+        if owner is not None and is_fan_out(raw, owner, self.config):
+            # Every worker handles its own partition of the recipients
+            for index, worker_queue in enumerate(self.queues):
+                self.routed[index] += 1
+                await asyncio.to_thread(worker_queue.put, raw)
+            return
+        index = partition_of(owner, self.workers) if owner is not None else 0
+        self.routed[index] += 1
+        await asyncio.to_thread(self.queues[index].put, raw)
+    
+    async def handle_webhook(self, method, headers, body):
+        error = check_webhook_request(self.config, method, headers)
+        if error:
+            return error
+        try:
+            raw = json.loads(body)
+        except ValueError:
+            return 400, "text/plain", b"bad update"
+        await self.route(raw)
+        return 200, "text/plain", b"ok"
+    
+    async def poll(self, bot, stop_event):
+        """getUpdates loop - offset only advances after routing"""
+        await bot.delete_webhook()
+        offset = None
+        while not stop_event.is_set():
+            try:
+                updates = await bot.get_updates(
+                    offset=offset,
+                    timeout=10,
+                    allowed_updates=ReferralBot.ALLOWED_UPDATES
+                )
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+                continue
+            except TelegramError as e:
+                logger.error(f"❌ Polling error: {e}")
+                await asyncio.sleep(1)
+                continue
+            
+            for update in updates:
+                await self.route(update.to_dict())
+                offset = update.update_id + 1
+        
+        if offset is not None:
+            # Confirm what was routed - otherwise the next start gets it again
+            try:
+                await bot.get_updates(offset=offset, timeout=0, limit=1,
+                                      allowed_updates=ReferralBot.ALLOWED_UPDATES)
+            except TelegramError as e:
+                logger.error(f"❌ Polling offset confirm error: {e}")
+    
+    async def serve(self):
+        from telegram import Bot
+        
+        stop_event = asyncio.Event()
+        stop_on_signals(stop_event)
+        bot = Bot(self.config['BOT_TOKEN'])
+        
+        self.start_workers()
+        try:
+            async with bot:
+                if self.config['UPDATE_MODE'] == 'webhook':
+                    server = HttpServer(
+                        self.config['WEBHOOK_LISTEN'],
+                        self.config['WEBHOOK_PORT'],
+                        {webhook_path(self.config): self.handle_webhook},
+                        max_connections=self.config['WEBHOOK_MAX_CONNECTIONS'],
+                        header_timeout=self.config['WEBHOOK_HEADER_TIMEOUT_SECONDS'],
+                        idle_timeout=self.config['WEBHOOK_KEEPALIVE_SECONDS']
+                    )
+                    await register_webhook(bot, self.config, ReferralBot.ALLOWED_UPDATES)
+                    await server.start()
+                    await stop_event.wait()
+                    await server.stop(self.config['WEBHOOK_DRAIN_SECONDS'])
+                else:
+                    poller = asyncio.create_task(self.poll(bot, stop_event))
+                    await stop_event.wait()
+                    poller.cancel()
+        finally:
+            logger.info("🛑 Shutting down - draining workers...")
+            await asyncio.to_thread(self.stop_workers)
+    
+    def run(self):
+        print("\n" + "="*60)
+        print(f"🧩 REFERRAL BOT - {self.workers} WORKERS")
+        print(f"🌐 Updates: {self.config['UPDATE_MODE']}")
+        print("="*60 + "\n")
+        asyncio.run(self.serve())
 
 def main():
     """Main function"""
+    setup_logging(CONFIG)
+    atexit.register(stop_logging)
+    if CONFIG['WORKERS'] > 1:
+        UpdateDispatcher(CONFIG).run()
+        return
     bot = ReferralBot()
     bot.run()
 
@@ -0,0 +1,86 @@
+"""
+One-shot migration: user_data.json (+ journal) or one backup snapshot -> SQLite
+Usage: python migrate_to_sqlite.py [--json user_data.json] [--backups backups] [--from-backup NAME] [--db user_data.db]
+"""
+
+import argparse
+import atexit
+import os
+import sys
+
+from bot import CONFIG, JsonUserStore, SqliteUserStore, read_snapshot, setup_logging, stop_logging
+
+
+def remove_files(*paths):
+    """Delete whatever exists of paths"""
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def migrate(json_file, backup_dir, db_file, from_backup=None):
+    """Import one source - the live data file, or a single backup snapshot
+    
+    Sources are never merged: users removed by cleanup would come back and
+    a referred user could end up with two referrers. A user listed under
+    several referrers goes to the first one; the rest are reported.
+    A failed import leaves no database behind.
+    """
+    db_existed = os.path.exists(db_file)
+    journal = json_file + ".journal"
+    journal_existed = os.path.exists(journal)
+    store = SqliteUserStore(db_file, backup_dir)
+    store.load()
+    
+    try:
+        if from_backup:
+            path = from_backup if os.path.exists(from_backup) else os.path.join(backup_dir, from_backup)
+            count, dropped = store.import_records(read_snapshot(path), overwrite=True,
+                                                  referral_points=CONFIG['REFERRAL_POINTS'])
+            print(f"📦 {path}: {count} users")
+        else:
+            # Live data - snapshot + journal replay, exactly as the bot sees it
+            source = JsonUserStore(json_file, backup_dir)
+            source.load()
+            try:
+                count, dropped = store.import_records(source.users, overwrite=True,
+                                                      referral_points=CONFIG['REFERRAL_POINTS'])
+            finally:
+                source.close()
+                # Loading opens the journal - don't leave an empty one next to the data
+                if not journal_existed and os.path.exists(journal) and not os.path.getsize(journal):
+                    os.remove(journal)
+            print(f"📂 {json_file}: {count} users")
+        
+        for referred, kept, lost in dropped:
+            print(f"⚠️ User {referred} was referred by {kept} and {lost} - kept {kept}, "
+                  f"removed from {lost} (-{CONFIG['REFERRAL_POINTS']} points)")
+        print(f"✅ {db_file}: {len(store)} users total")
+    except Exception:
+        store.close()
+        if not db_existed:
+            remove_files(db_file, db_file + "-wal", db_file + "-shm")
+        raise
+    store.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate user_data.json to SQLite")
+    parser.add_argument('--json', default="user_data.json")
+    parser.add_argument('--backups', default="backups")
+    parser.add_argument('--from-backup', metavar='NAME',
+                        help="Import this backup snapshot (name in --backups or a path) instead of --json")
+    parser.add_argument('--db', default=CONFIG['SQLITE_FILE'])
+    args = parser.parse_args()
+    setup_logging(CONFIG)
+    atexit.register(stop_logging)
+    
+    try:
+        migrate(args.json, args.backups, args.db, from_backup=args.from_backup)
+    except Exception as e:
+        print(f"❌ Migration aborted: {e}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Post recorded Telegram Update JSON to a locally running webhook
+
+Run the bot with UPDATE_MODE=webhook and no WEBHOOK_URL, then:
+    python post_update.py updates.json
+Accepts a single Update object, a JSON list of Updates, or NDJSON.
+"""
+
+import argparse
+import json
+import os
+import sys
+import urllib.error
+import urllib.request
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def load_updates(path):
+    """Read one update, a list, or one update per line"""
+    with open(path, 'r', encoding='utf-8') as f:
+        text = f.read().strip()
+    if not text:
+        return []
+    try:
+        data = json.loads(text)
+        return data if isinstance(data, list) else [data]
+    except json.JSONDecodeError:
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def post(url, update, secret):
+    """POST one update, return HTTP status"""
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(update).encode('utf-8'),
+        headers={'Content-Type': 'application/json'},
+        method='POST'
+    )
+    if secret:
+        request.add_header('X-Telegram-Bot-Api-Secret-Token', secret)
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def main():
+    port = os.getenv('WEBHOOK_PORT', '8443')
+    path = os.getenv('WEBHOOK_PATH', 'telegram').strip('/')
+
+    parser = argparse.ArgumentParser(description="Replay recorded updates against the local webhook")
+    parser.add_argument('files', nargs='+', help="Update JSON / NDJSON files")
+    parser.add_argument('--url', default=f"http://127.0.0.1:{port}/{path}")
+    parser.add_argument('--secret', default=os.getenv('WEBHOOK_SECRET', ''))
+    args = parser.parse_args()
+
+    failed = 0
+    for file in args.files:
+        for update in load_updates(file):
+            status = post(args.url, update, args.secret)
+            print(f"{'✅' if status == 200 else '❌'} update {update.get('update_id')} -> {status}")
+            failed += status != 200
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+# Dummy credentials + quiet side channels - set before bot.py reads its CONFIG
+os.environ.setdefault('BOT_TOKEN', '123456:TEST')
+os.environ.setdefault('CHANNEL_ID', '-1000000000001')
+os.environ.setdefault('ADMIN_USER_ID', '1')
+os.environ.setdefault('BOT_USERNAME', 'test_bot')
+os.environ.setdefault('METRICS_ENABLED', 'false')
+os.environ.setdefault('OUTBOUND_DRAIN_SECONDS', '0')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+from benchmark import FakeRequest, UpdateFactory  # noqa: E402
+from telegram import Bot, Update  # noqa: E402
+from telegram.ext import Application  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    """Every test gets its own data directory (user_data.json, journals, ledgers...)"""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def json_store(fmt='ndjson'):
+    store = bot.JsonUserStore("user_data.json", "backups", snapshot_format=fmt)
+    store.load()
+    return store
+
+
+def seed_referrals(store):
+    """Users 1-3, 1 referred 2 and 3"""
+    for user_id in ('1', '2', '3'):
+        store.create_user(user_id, f"user{user_id}", f"User{user_id}")
+    assert store.add_referral('1', '2', 1)
+    assert store.add_referral('1', '3', 1)
+    store.flush()
+
+
+def assert_seeded(store, users=3):
+    referrer = store.get('1')
+    assert referrer['referral_count'] == 2
+    assert referrer['points'] == 2
+    assert store.referred_by('2') == '1'
+    assert store.referred_by('3') == '1'
+    assert len(store) == users
+
+
+def reopen(store, fmt='ndjson'):
+    """Close (flushes the journal) and load again, as a restart would"""
+    store.close()
+    return json_store(fmt)
+
+
+class Harness:
+    """ReferralBot on a fake in-process Bot - no network"""
+
+    def __init__(self, worker_index=0, workers=1):
+        self.bot = bot.ReferralBot(worker_index, workers)
+        self.request = FakeRequest()
+        fake_bot = Bot(bot.CONFIG['BOT_TOKEN'], request=self.request, get_updates_request=FakeRequest())
+        self.application = Application.builder().bot(fake_bot).updater(None).build()
+        self.bot.setup_handlers(self.application)
+        self.updates = UpdateFactory(bot.CONFIG['CHANNEL_ID'])
+
+    async def start(self):
+        await self.application.initialize()
+        await self.bot.post_init(self.application)
+        await self.bot.store.wait_ready()
+
+    async def stop(self):
+        await self.bot.post_stop(self.application)
+        await self.application.shutdown()
+        await self.bot.post_shutdown(self.application)
+
+    async def command(self, user_id, text):
+        raw = self.updates.command(user_id, text)
+        await self.application.process_update(Update.de_json(raw, self.application.bot))
+
+    def referral_count(self, user_id):
+        return (self.bot.store.get(str(user_id)) or {}).get('referral_count', 0)
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+class RecordingBot:
+    """Stands in for telegram.Bot - records sends, raises queued or per-chat errors"""
+
+    def __init__(self):
+        self.sent = []
+        self.errors = []
+        self.fail_for = {}
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if self.errors:
+            raise self.errors.pop(0)
+        if chat_id in self.fail_for:
+            raise self.fail_for[chat_id]
+        self.sent.append((chat_id, text))
@@ -0,0 +1,76 @@
+"""Scheduled backups - due check, retention, restore"""
+
+import os
+
+import pytest
+
+import bot
+from conftest import assert_seeded, json_store, run, seed_referrals
+
+
+def open_store(backend):
+    if backend == 'json':
+        return json_store()
+    store = bot.SqliteUserStore("user_data.db", "backups")
+    store.load()
+    return store
+
+
+def manager(store, backend, **kwargs):
+    os.makedirs("backups", exist_ok=True)
+    extension = ".ndjson" if backend == 'json' else ".db"
+    return bot.BackupManager(store, "backups", extension, **kwargs)
+
+
+def test_due_after_enough_changes_or_interval():
+    store = json_store()
+    backups = manager(store, 'json', interval=3600, change_threshold=5)
+    assert not backups.is_due()
+
+    seed_referrals(store)
+    assert backups.is_due()
+    assert run(backups.backup_now())
+    assert not backups.is_due()
+
+    store.touch('1')
+    assert not backups.is_due()
+    backups.last_backup_at -= 3600
+    assert backups.is_due()
+    store.close()
+
+
+def test_retention_keeps_newest():
+    store = json_store()
+    backups = manager(store, 'json', retention=2)
+    names = []
+    for user_id in ('1', '2', '3'):
+        store.create_user(user_id, None, None)
+        names.append(run(backups.backup_now()))
+    assert [name for name, _, _ in backups.list_snapshots()] == names[1:]
+    store.close()
+
+
+@pytest.mark.parametrize('backend', ['json', 'sqlite'])
+@pytest.mark.parametrize('compress', [False, True])
+def test_restore_brings_back_snapshot(backend, compress):
+    store = open_store(backend)
+    backups = manager(store, backend, compress=compress)
+    seed_referrals(store)
+    name = run(backups.backup_now())
+    assert name.endswith(".gz") == compress
+
+    store.create_user('4', "user4", "User4")
+    assert store.add_referral('1', '4', 1)
+    store.flush()
+
+    run(backups.restore(name))
+    assert '4' not in store
+    assert_seeded(store)
+    # Pre-restore state kept as a safety net
+    assert len(backups.list_snapshots()) == 2
+
+    with pytest.raises(ValueError):
+        run(backups.restore("../user_data.json"))
+    with pytest.raises(FileNotFoundError):
+        run(backups.restore("user_data_missing"))
+    store.close()
@@ -0,0 +1,86 @@
+"""Broadcast - paging, blocked users, checkpoint and resume"""
+
+from telegram.error import Forbidden
+
+import bot
+from conftest import RecordingBot, json_store, run
+
+
+def make_store(user_ids):
+    store = json_store()
+    for user_id in user_ids:
+        store.create_user(str(user_id), None, None)
+    return store
+
+
+def make_broadcaster(store):
+    return bot.Broadcaster(store, bot.OutboundQueue(global_rate=1000), "broadcast.json",
+                           concurrency=2, page_size=3)
+
+
+def recipients(recorder):
+    return sorted(chat_id for chat_id, _ in recorder.sent)
+
+
+def test_broadcast_reaches_everyone_and_skips_blocked():
+    store = make_store(range(1, 11))
+    recorder = RecordingBot()
+    recorder.fail_for[5] = Forbidden("blocked")
+
+    async def scenario():
+        broadcaster = make_broadcaster(store)
+        broadcaster.start(recorder, {'text': "hi"}, 1)
+        await broadcaster.task
+        first = list(recorder.sent)
+
+        recorder.sent.clear()
+        broadcaster.start(recorder, {'text': "again"}, 1)
+        await broadcaster.task
+        return first, broadcaster.state
+
+    first, state = run(scenario())
+    assert sorted(chat_id for chat_id, _ in first) == [1, 2, 3, 4, 6, 7, 8, 9, 10]
+    assert recipients(recorder) == [1, 2, 3, 4, 6, 7, 8, 9, 10]
+    assert (state['sent'], state['blocked'], state['failed']) == (9, 0, 0)
+    assert state['finished_at']
+    assert bot.read_json_file("broadcast.json")['finished_at']
+
+
+def test_new_broadcast_sees_new_users():
+    store = make_store([])
+    recorder = RecordingBot()
+
+    async def scenario():
+        broadcaster = make_broadcaster(store)
+        broadcaster.start(recorder, {'text': "nobody yet"}, 1)
+        await broadcaster.task
+        for user_id in ('7', '8'):
+            store.create_user(user_id, None, None)
+        broadcaster.start(recorder, {'text': "hi"}, 1)
+        await broadcaster.task
+
+    run(scenario())
+    assert recipients(recorder) == [7, 8]
+
+
+def test_resume_from_checkpoint_skips_done_users():
+    store = make_store(range(1, 11))
+    recorder = RecordingBot()
+    # Interrupted run: 1-4 done, 6 sent from the page 5-7
+    bot.write_file_atomic("broadcast.json", bot.json.dumps({
+        'id': "1", 'message': {'text': "hi"}, 'admin_chat_id': 1, 'progress_message_id': None,
+        'cursor': 4, 'done': [6], 'total': 10, 'sent': 5, 'blocked': 0, 'failed': 0,
+        'started_at': 1, 'finished_at': None, 'cancelled': False
+    }).encode('utf-8'))
+
+    async def scenario():
+        broadcaster = make_broadcaster(store)
+        assert broadcaster.resumable
+        broadcaster.resume(recorder)
+        await broadcaster.task
+        return broadcaster.state
+
+    state = run(scenario())
+    assert recipients(recorder) == [5, 7, 8, 9, 10]
+    assert state['sent'] == 10
+    assert not make_broadcaster(store).resumable
@@ -0,0 +1,43 @@
+"""Per-user locks - concurrent updates for one user never double count"""
+
+import asyncio
+
+import bot
+from conftest import Harness, run
+
+
+def test_parallel_starts_credit_once():
+    async def scenario():
+        h = Harness()
+        await h.start()
+        try:
+            await h.command(100, "/start")
+            await h.command(101, "/start")
+            # Same new user hits two links at once - the per-user lock lets one win
+            await asyncio.gather(*(
+                h.command(500, f"/start {referrer}") for referrer in (100, 101, 100, 101)
+            ))
+            return h.referral_count(100) + h.referral_count(101)
+        finally:
+            await h.stop()
+
+    assert run(scenario()) == 1
+
+
+def test_keyed_locks_serialize_one_key_only():
+    async def scenario():
+        locks = bot.KeyedLocks()
+        order = []
+
+        async def hold(key, tag, delay):
+            async with locks.hold(key):
+                order.append(f"{tag}+")
+                await asyncio.sleep(delay)
+                order.append(f"{tag}-")
+
+        await asyncio.gather(hold('a', 'a1', 0.02), hold('a', 'a2', 0), hold('b', 'b1', 0))
+        return order
+
+    order = run(scenario())
+    assert order.index('a1-') < order.index('a2+')
+    assert order.index('b1+') < order.index('a1-')
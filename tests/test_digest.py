@@ -0,0 +1,60 @@
+"""Admin digest - batching, persistence and urgent events"""
+
+import pytest
+from telegram.error import Forbidden
+
+import bot
+from conftest import Harness, RecordingBot, run
+
+
+def test_events_survive_restart():
+    digest = bot.AdminDigest("admin_digest.json")
+    digest.add({'text': "one"})
+    digest.add({'text': "two"})
+    run(digest.log.flush())
+
+    digest = bot.AdminDigest("admin_digest.json")
+    assert [event['text'] for event in digest.events] == ["one", "two"]
+
+
+def test_flush_sends_one_message_through_outbound_queue():
+    async def scenario():
+        digest = bot.AdminDigest("admin_digest.json")
+        outbound = bot.OutboundQueue(workers=1)
+        recorder = RecordingBot()
+        outbound.start(recorder)
+        for n in range(3):
+            digest.add({'text': f"event {n}"})
+
+        recorder.errors.append(Forbidden("blocked"))
+        assert not await digest.flush(outbound, 1)
+        assert len(digest.events) == 3
+
+        assert await digest.flush(outbound, 1)
+        await outbound.stop()
+        await digest.log.flush()
+        return recorder.sent, outbound.sent
+
+    sent, count = run(scenario())
+    assert count == 1
+    assert len(sent) == 1 and "event 2" in sent[0][1]
+    assert bot.AdminDigest("admin_digest.json").events == []
+
+
+def test_threshold_requests_early_flush():
+    digest = bot.AdminDigest("admin_digest.json", max_events=2)
+    calls = []
+    digest.on_threshold = lambda: calls.append(1)
+    for n in range(4):
+        digest.add({'text': str(n)})
+    assert calls == [1]
+
+
+@pytest.mark.parametrize('urgent', [set(), {'target_completed'}])
+def test_urgent_events_skip_the_digest(urgent, monkeypatch):
+    monkeypatch.setitem(bot.CONFIG, 'ADMIN_URGENT_EVENTS', urgent)
+    h = Harness()
+    h.bot.notify_admin({'first_name': "Ann", 'username': "ann", 'referral_count': 3}, '100')
+
+    assert len(h.bot.digest.events) == (0 if urgent else 1)
+    assert h.bot.outbound.queue.qsize() == (1 if urgent else 0)
@@ -0,0 +1,66 @@
+"""Inactive-user expiry - oldest first, in batches, exact at the cutoff"""
+
+import pytest
+
+import bot
+from conftest import json_store
+
+DAY = 86400
+NOW = 1_700_000_000 - 1_700_000_000 % 3600 + 1800   # mid-bucket
+
+
+def open_store(backend):
+    if backend == 'json':
+        return json_store()
+    store = bot.SqliteUserStore("user_data.db", "backups")
+    store.load()
+    return store
+
+
+def create_at(store, monkeypatch, user_id, ts):
+    with monkeypatch.context() as patched:
+        patched.setattr(bot.time, 'time', lambda: ts)
+        store.create_user(user_id, None, None)
+
+
+@pytest.mark.parametrize('backend', ['json', 'sqlite'])
+def test_expired_users_removed_in_batches(backend, monkeypatch):
+    store = open_store(backend)
+    for user_id in ('1', '2', '3', '4', '5'):
+        create_at(store, monkeypatch, user_id, NOW - 30 * DAY)
+    for user_id in ('6', '7'):
+        create_at(store, monkeypatch, user_id, NOW)
+    assert store.add_referral('1', '6', 1)
+
+    cutoff = NOW - DAY
+    assert store.remove_expired(cutoff, 2) == 2
+    assert store.remove_expired(cutoff, 10) == 3
+    assert store.remove_expired(cutoff, 10) == 0
+
+    assert len(store) == 2 and '6' in store and '7' in store
+    assert store.stats.total_referrals == 0
+    store.close()
+
+
+@pytest.mark.parametrize('backend', ['json', 'sqlite'])
+def test_cutoff_is_exact_inside_a_bucket(backend, monkeypatch):
+    store = open_store(backend)
+    create_at(store, monkeypatch, '1', NOW - 10)
+    create_at(store, monkeypatch, '2', NOW + 10)
+
+    assert store.remove_expired(NOW, 10) == 1
+    assert '1' not in store and '2' in store
+    store.close()
+
+
+def test_removed_referrer_frees_its_referrals(monkeypatch):
+    store = json_store()
+    create_at(store, monkeypatch, '1', NOW - 30 * DAY)
+    create_at(store, monkeypatch, '2', NOW)
+    create_at(store, monkeypatch, '3', NOW)
+    assert store.add_referral('1', '2', 1)
+
+    assert store.remove_expired(NOW - DAY, 10) == 1
+    assert store.referred_by('2') is None
+    assert store.add_referral('3', '2', 1)
+    store.close()
@@ -0,0 +1,60 @@
+"""Ingress limits - per-user and per-bot budgets, drop accounting"""
+
+import bot
+from conftest import Harness, run
+
+
+def limiter(user_rate=0.001, user_burst=2, global_rate=0, max_users=100):
+    return bot.IngressLimiter({'command': (user_rate, user_burst, global_rate)}, max_users=max_users)
+
+
+def test_flooder_drains_only_their_own_budget():
+    ingress = limiter()
+    assert [ingress.reject('command', 1) for _ in range(4)] == [None, None, 'user', 'user']
+    assert ingress.reject('command', 2) is None
+    assert ingress.reject('callback', 1) is None   # no budget for the kind
+
+    assert ingress.allowed == {'command': 3}
+    assert ingress.dropped == {('command', 'user'): 2, ('command', 'global'): 0}
+    assert ingress.take_window() == (2, [(1, 2)])
+    assert ingress.take_window() == (0, [])
+    assert ingress.total_dropped == 2
+
+
+def test_global_budget_is_shared():
+    ingress = limiter(user_rate=0, global_rate=2)
+    assert [ingress.reject('command', user_id) for user_id in (1, 2, 3)] == [None, None, 'global']
+    assert ingress.dropped[('command', 'global')] == 1
+    assert not ingress.user_buckets
+
+
+def test_evicted_user_comes_back_full():
+    ingress = limiter(user_burst=1, max_users=1)
+    assert ingress.reject('command', 1) is None
+    assert ingress.reject('command', 1) == 'user'
+    assert ingress.reject('command', 2) is None
+    assert list(ingress.user_buckets) == [('command', 2)]
+    assert ingress.reject('command', 1) is None
+
+
+def test_throttle_drops_floods_before_handlers():
+    async def scenario():
+        h = Harness()
+        await h.start()
+        try:
+            burst = bot.CONFIG['INGRESS_COMMAND_USER_BURST']
+            for _ in range(burst + 3):
+                await h.command(100, "/help")
+            for _ in range(burst + 3):
+                await h.command(int(bot.CONFIG['ADMIN_USER_ID']), "/help")
+            metrics = h.bot.metrics
+            return (
+                metrics.counter('ingress_dropped_total', kind="command", scope="user"),
+                metrics.select('handler_seconds')[(('handler', 'help'),)].count,
+                h.bot.ingress.take_window()
+            )
+        finally:
+            await h.stop()
+
+    burst = bot.CONFIG['INGRESS_COMMAND_USER_BURST']
+    assert run(scenario()) == (3, 2 * burst + 3, (3, [(100, 3)]))
@@ -0,0 +1,75 @@
+"""Parked join requests - log recovery, approval on target, expiry"""
+
+import asyncio
+
+from telegram import Update
+
+import bot
+from conftest import Harness, run
+
+
+def test_pending_requests_survive_restart(monkeypatch):
+    monkeypatch.setattr(bot.time, 'time', lambda: 1000)
+    pending = bot.PendingJoinRequests("join_requests.json")
+    pending.add('1')
+    pending.add('2')
+    pending.add('3')
+    pending.remove('2')
+
+    monkeypatch.setattr(bot.time, 'time', lambda: 2000)
+    pending.add('1')   # repeated request keeps its original time
+    pending.add('4')
+    assert sorted(pending.older_than(1500)) == ['1', '3']
+
+    pending = bot.PendingJoinRequests("join_requests.json")
+    assert pending.requests == {'1': 1000, '3': 1000, '4': 2000}
+    assert '2' not in pending
+    # Recovery rewrites the log down to the live entries
+    with open("join_requests.json", encoding='utf-8') as f:
+        assert len(f.readlines()) == 3
+
+
+async def join(h, user_id):
+    raw = h.updates.join_request(user_id)
+    await h.application.process_update(Update.de_json(raw, h.application.bot))
+
+
+def test_parked_request_approved_when_target_reached():
+    async def scenario():
+        h = Harness()
+        await h.start()
+        await h.application.start()   # approval runs as an application task
+        try:
+            await h.command(100, "/start")
+            await join(h, 100)
+            await join(h, 100)
+            parked = '100' in h.bot.join_requests
+            for user_id in range(201, 201 + bot.CONFIG['REQUIRED_REFERRALS']):
+                await h.command(user_id, "/start 100")
+            for _ in range(50):
+                if '100' not in h.bot.join_requests:
+                    break
+                await asyncio.sleep(0.01)
+            return parked, '100' in h.bot.join_requests, h.request.calls.get('approveChatJoinRequest', 0)
+        finally:
+            await h.application.stop()
+            await h.stop()
+
+    assert run(scenario()) == (True, False, 1)
+
+
+def test_expired_requests_are_declined():
+    async def scenario():
+        h = Harness()
+        await h.start()
+        try:
+            await join(h, 300)   # never registered
+            await h.command(301, "/start")
+            await join(h, 301)
+            h.bot.join_requests.requests['300'] -= bot.CONFIG['JOIN_REQUEST_TTL_SECONDS'] + 1
+            await h.bot.expire_join_requests()
+            return sorted(h.bot.join_requests.requests), h.request.calls.get('declineChatJoinRequest', 0)
+        finally:
+            await h.stop()
+
+    assert run(scenario()) == (['301'], 1)
@@ -0,0 +1,99 @@
+"""Journal replay and compaction (JSON store)"""
+
+import os
+
+import pytest
+
+import bot
+from conftest import assert_seeded, json_store, reopen, run, seed_referrals
+
+FORMATS = ['ndjson', 'json']
+
+
+@pytest.mark.parametrize('fmt', FORMATS)
+def test_journal_replays_on_restart(fmt):
+    store = json_store(fmt)
+    seed_referrals(store)
+    assert os.path.getsize(store.journal_file) > 0
+
+    store = reopen(store, fmt)
+    assert_seeded(store)
+    store.close()
+
+
+@pytest.mark.parametrize('fmt', FORMATS)
+def test_compaction_folds_journal_into_snapshot(fmt):
+    store = json_store(fmt)
+    seed_referrals(store)
+    assert run(store.compact())
+    assert os.path.getsize(store.journal_file) == 0
+    assert not os.path.exists(store.journal_file + ".1")
+
+    store = reopen(store, fmt)
+    assert_seeded(store)
+    store.close()
+
+
+@pytest.mark.parametrize('fmt', FORMATS)
+def test_crash_before_snapshot_written(fmt, monkeypatch):
+    """Snapshot write fails - old snapshot + journal.1 + new journal rebuild everything"""
+    store = json_store(fmt)
+    seed_referrals(store)
+
+    def fail(path, payload, compress=False):
+        raise OSError("disk full")
+
+    with monkeypatch.context() as patched:
+        patched.setattr(bot, 'write_file_atomic', fail)
+        assert not run(store.compact())
+    assert os.path.exists(store.journal_file + ".1")
+
+    store.create_user('4', "user4", "User4")
+    assert store.add_referral('1', '4', 1)
+    store = reopen(store, fmt)
+    assert store.get('1')['referral_count'] == 3
+    assert store.referred_by('4') == '1'
+    store.close()
+
+
+def torn_compaction(fmt):
+    """Snapshot written while "d 10" and "r 20 30" were journalled: 10's row
+    was serialized before the delete, 20's after the new credit"""
+    users = {user_id: bot.UserRecord.from_dict(info) for user_id, info in {
+        10: {'points': 1, 'referrals': ['30']},
+        20: {'points': 1, 'referrals': ['30']},
+        30: {},
+    }.items()}
+    bot.write_file_atomic("user_data.json", bot.snapshot_chunks(users, fmt))
+    with open("user_data.json.journal.1", 'w') as f:
+        f.write('["d","10"]\n["r","20","30"]\n["p","20",1]\n')
+
+
+def assert_credited_once(store):
+    assert '10' not in store
+    assert store.get('20')['referral_count'] == 1
+    assert store.referred_by('30') == '20'
+    assert not store.add_referral('20', '30', 1)
+
+
+@pytest.mark.parametrize('fmt', FORMATS)
+def test_replay_over_torn_snapshot_credits_once(fmt):
+    torn_compaction(fmt)
+    store = json_store(fmt)
+    assert_credited_once(store)
+    store.close()
+
+
+@pytest.mark.parametrize('fmt', FORMATS)
+def test_replay_over_torn_snapshot_credits_once_async_load(fmt):
+    torn_compaction(fmt)
+
+    async def load():
+        store = bot.JsonUserStore("user_data.json", "backups", snapshot_format=fmt)
+        await store.load_async()
+        await store.wait_ready()
+        return store
+
+    store = run(load())
+    assert_credited_once(store)
+    store.close()
@@ -0,0 +1,66 @@
+"""Leaderboard ordering - incremental buckets, and the stores built on them"""
+
+import pytest
+
+import bot
+from conftest import json_store, reopen
+
+
+def test_highest_count_first_ties_by_arrival():
+    board = bot.Leaderboard()
+    board.update(10, 0, 1)
+    board.update(20, 0, 1)
+    board.update(30, 0, 1)
+    board.update(20, 1, 2)
+    board.update(30, 1, 2)
+
+    # 20 reached 2 before 30
+    assert board.top(3) == [(20, 2), (30, 2), (10, 1)]
+    assert board.top(1) == [(20, 2)]
+    assert board.top(10) == [(20, 2), (30, 2), (10, 1)]
+
+
+def test_moving_down_and_out():
+    board = bot.Leaderboard()
+    board.update(10, 0, 3)
+    board.update(20, 0, 1)
+    board.update(10, 3, 0)
+
+    assert board.top(5) == [(20, 1)]
+    assert board.levels == [1]
+    assert len(board) == 1
+
+
+def test_empty():
+    assert bot.Leaderboard().top(5) == []
+
+
+def referral_graph(store):
+    """5 -> 3 refs, 6 -> 2 refs, 7 -> 1 ref"""
+    for user_id in range(1, 11):
+        store.create_user(str(user_id), None, None)
+    for referrer, referred in ((5, 1), (6, 2), (5, 3), (7, 4), (6, 8), (5, 9)):
+        assert store.add_referral(str(referrer), str(referred), 1)
+    store.flush()
+
+
+@pytest.mark.parametrize('fmt', ['ndjson', 'json'])
+def test_json_store_top_survives_restart(fmt):
+    store = json_store(fmt)
+    referral_graph(store)
+    assert store.top_referrers(2) == [(5, 3), (6, 2)]
+
+    store.remove('6')
+    assert store.top_referrers(5) == [(5, 3), (7, 1)]
+
+    store = reopen(store, fmt)
+    assert store.top_referrers(5) == [(5, 3), (7, 1)]
+    store.close()
+
+
+def test_sqlite_store_top():
+    store = bot.SqliteUserStore("user_data.db", "backups")
+    store.load()
+    referral_graph(store)
+    assert [tuple(row) for row in store.top_referrers(5)] == [(5, 3), (6, 2), (7, 1)]
+    store.close()
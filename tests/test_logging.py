@@ -0,0 +1,36 @@
+"""Logging pipeline - nothing at import, queue + listener once set up"""
+
+import logging
+
+import bot
+
+
+def test_import_installs_no_handlers():
+    assert bot.log_handler is None
+    assert not any(isinstance(h, bot.LogQueueHandler) for h in logging.getLogger().handlers)
+
+
+def test_setup_logging_writes_through_the_queue(monkeypatch):
+    config = dict(bot.CONFIG, LOG_LEVEL='INFO', LOG_FORMAT='json', LOG_ROTATE='none')
+    root = logging.getLogger()
+    level = root.level
+    bot.setup_logging(config, "bot.log")
+    try:
+        bot.logger.info("❌ Send to %s failed: %s", 42, "blocked")
+    finally:
+        bot.stop_logging()
+        root.removeHandler(bot.log_handler)
+        root.setLevel(level)
+        monkeypatch.setattr(bot, 'log_handler', None)
+
+    with open("bot.log", encoding='utf-8') as f:
+        lines = [bot.json.loads(line) for line in f]
+    assert lines[-1]['msg'] == "❌ Send to 42 failed: blocked"
+
+
+def test_update_log_sampling_skips_formatting():
+    target = logging.getLogger("bot.updates.test")
+    target.setLevel(logging.INFO)
+    update_log = bot.UpdateLog(target, sample_rate=0.0)
+    update_log.info("📥 /start from: %s", 1, event="start")
+    assert (update_log.written, update_log.sampled_out) == (0, 1)
@@ -0,0 +1,106 @@
+"""Metrics registry - histograms, exposition, handler and Bot API timing"""
+
+import pytest
+
+import bot
+from benchmark import FakeRequest
+from conftest import Harness, run
+
+
+def test_histogram_quantiles_use_bucket_bounds():
+    histogram = bot.Histogram()
+    assert histogram.quantile(0.5) == 0.0
+    for value in (0.002, 0.002, 0.002, 0.04, 30):
+        histogram.observe(value)
+
+    assert histogram.count == 5
+    assert histogram.mean == pytest.approx(30.046 / 5)
+    assert histogram.quantile(0.5) == 0.0025
+    assert histogram.quantile(0.8) == 0.05
+    assert histogram.quantile(1.0) == float('inf')
+
+
+def test_render_is_cumulative_and_survives_a_broken_gauge():
+    metrics = bot.Metrics()
+    metrics.observe('handler_seconds', 0.003, handler="start")
+    metrics.observe('handler_seconds', 0.3, handler="start")
+    metrics.inc('handler_errors_total', handler="start")
+    metrics.counter_sample('outbound_messages_total', lambda: 7, result="sent")
+    metrics.gauge('queue_depth', lambda: 1 / 0, queue="broken")
+    metrics.gauge('queue_depth', lambda: 4, queue="outbound")
+
+    text = metrics.render()
+    assert '# TYPE referral_handler_seconds histogram' in text
+    assert 'referral_handler_seconds_bucket{handler="start",le="0.005"} 1' in text
+    assert 'referral_handler_seconds_bucket{handler="start",le="0.5"} 2' in text
+    assert 'referral_handler_seconds_bucket{handler="start",le="+Inf"} 2' in text
+    assert 'referral_handler_seconds_count{handler="start"} 2' in text
+    assert 'referral_handler_errors_total{handler="start"} 1' in text
+    assert 'referral_outbound_messages_total{result="sent"} 7' in text
+    assert 'referral_queue_depth{queue="outbound"} 4' in text
+    assert 'queue="broken"' not in text
+    assert metrics.counter('outbound_messages_total', result="sent") == 7
+
+
+def test_instrument_times_and_counts_errors():
+    metrics = bot.Metrics()
+
+    async def ok(update, context):
+        return "done"
+
+    async def broken(update, context):
+        raise ValueError("boom")
+
+    async def scenario():
+        assert await metrics.instrument("ok", ok)(None, None) == "done"
+        with pytest.raises(ValueError):
+            await metrics.instrument("broken", broken)(None, None)
+
+    run(scenario())
+    timed = {dict(labels)['handler']: h.count for labels, h in metrics.select('handler_seconds').items()}
+    assert timed == {'ok': 1, 'broken': 1}
+    assert metrics.counter('handler_errors_total', handler="broken") == 1
+    assert metrics.counter('handler_errors_total', handler="ok") == 0
+
+
+class FailingRequest(FakeRequest):
+    """Answers every call with an error status"""
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        return 429, b'{"ok": false}'
+
+
+def test_timed_request_labels_api_calls_by_method():
+    metrics = bot.Metrics()
+
+    async def scenario():
+        timed = bot.TimedRequest(FakeRequest(), metrics)
+        await timed.do_request("https://api.telegram.org/botX/sendMessage", "POST")
+        await timed.do_request("https://api.telegram.org/botX/getMe", "POST")
+        failing = bot.TimedRequest(FailingRequest(), metrics)
+        code, _ = await failing.do_request("https://api.telegram.org/botX/sendMessage", "POST")
+        return code
+
+    assert run(scenario()) == 429
+    methods = {dict(labels)['method']: h.count for labels, h in metrics.select('api_seconds').items()}
+    assert methods == {'send_message': 2, 'get_me': 1}
+    assert metrics.counter('api_errors_total', method="send_message") == 1
+
+
+def test_bot_exports_handler_timings_and_queue_gauges():
+    async def scenario():
+        h = Harness()
+        await h.start()
+        try:
+            await h.command(100, "/start")
+            await h.command(100, "/help")
+            return h.bot.metrics.render()
+        finally:
+            await h.stop()
+
+    text = run(scenario())
+    assert 'referral_handler_seconds_count{handler="start"} 1' in text
+    assert 'referral_handler_seconds_count{handler="help"} 1' in text
+    assert 'referral_queue_depth{queue="outbound"}' in text
+    assert 'referral_outbound_messages_total{result="sent"}' in text
+    assert 'referral_users 1' in text
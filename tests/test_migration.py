@@ -0,0 +1,55 @@
+"""user_data.json -> SQLite migration"""
+
+import json
+import os
+
+import pytest
+
+import bot
+import migrate_to_sqlite
+
+
+def write_user_data(users):
+    with open("user_data.json", 'w') as f:
+        json.dump(users, f)
+
+
+def test_import_keeps_first_referrer():
+    # Baseline data: 300 is listed under both 100 and 200
+    write_user_data({
+        '100': {'points': 2, 'referrals': ['300', '301'], 'referral_count': 2},
+        '200': {'points': 1, 'referrals': ['300'], 'referral_count': 1},
+        '300': {'points': 0, 'referrals': []},
+        '301': {'points': 0, 'referrals': []},
+    })
+
+    migrate_to_sqlite.migrate("user_data.json", "backups", "user_data.db")
+
+    assert not os.path.exists("user_data.json.journal")
+    store = bot.SqliteUserStore("user_data.db", "backups")
+    store.load()
+    assert store.referred_by('300') == '100'
+    assert store.get('100')['referral_count'] == 2
+    assert store.get('100')['points'] == 2
+    assert store.get('200')['referral_count'] == 0
+    assert store.get('200')['points'] == 0
+    assert store.stats.total_referrals == 2
+    store.close()
+
+
+def test_import_reports_dropped_referrals():
+    store = bot.SqliteUserStore("user_data.db", "backups")
+    store.load()
+    users = {'1': {'points': 5, 'referrals': ['3']}, '2': {'points': 5, 'referrals': ['3']}, '3': {}}
+    count, dropped = store.import_records(users, referral_points=2)
+    assert count == 3
+    assert dropped == [('3', '1', '2')]
+    assert store.get('2')['points'] == 3
+    store.close()
+
+
+def test_failed_migration_leaves_no_database():
+    with pytest.raises(OSError):
+        migrate_to_sqlite.migrate("user_data.json", "backups", "user_data.db", from_backup="missing.json")
+
+    assert not os.path.exists("user_data.db")
@@ -0,0 +1,84 @@
+"""Outbound queue - pacing, flood limits, retries and a full queue"""
+
+import asyncio
+
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+import bot
+from conftest import RecordingBot, run
+
+
+def test_busy_chat_does_not_hold_up_other_chats():
+    async def scenario():
+        outbound = bot.OutboundQueue(global_rate=1000, per_chat_rate=20, workers=1)
+        recorder = RecordingBot()
+        outbound.start(recorder)
+        for n in range(4):
+            outbound.send(1, f"burst {n}")
+        outbound.send(2, "other chat")
+        await asyncio.wait_for(outbound.queue.join(), 5)
+        await outbound.stop()
+        return recorder.sent
+
+    sent = run(scenario())
+    assert sent[1] == (2, "other chat")
+    assert [text for chat_id, text in sent if chat_id == 1] == [f"burst {n}" for n in range(4)]
+
+
+def test_retry_after_pauses_then_sends():
+    async def scenario():
+        outbound = bot.OutboundQueue(global_rate=1000, workers=1)
+        recorder = RecordingBot()
+        recorder.errors.append(RetryAfter(0.05))
+        outbound.start(recorder)
+        sent = await outbound.deliver(1, "hello")
+        await outbound.stop()
+        return sent, outbound, recorder.sent
+
+    sent, outbound, messages = run(scenario())
+    assert sent
+    assert (outbound.sent, outbound.retried, outbound.failed) == (1, 1, 0)
+    assert messages == [(1, "hello")]
+
+
+def test_permanent_errors_are_not_retried():
+    async def scenario():
+        outbound = bot.OutboundQueue(global_rate=1000, workers=1, max_retries=0)
+        recorder = RecordingBot()
+        recorder.errors.extend([BadRequest("bad markup"), NetworkError("gone")])
+        outbound.start(recorder)
+        results = [await outbound.deliver(1, "a"), await outbound.deliver(1, "b")]
+        await outbound.stop()
+        return results, outbound
+
+    results, outbound = run(scenario())
+    assert results == [False, False]
+    assert (outbound.sent, outbound.retried, outbound.failed) == (0, 0, 2)
+
+
+def test_full_queue_refuses_and_counts():
+    async def scenario():
+        outbound = bot.OutboundQueue(max_size=2)
+        accepted = [outbound.send(n, "x") for n in range(3)]
+        delivered = await outbound.deliver(9, "x")
+        await outbound.stop(0)
+        return accepted, delivered, outbound
+
+    accepted, delivered, outbound = run(scenario())
+    assert accepted == [True, True, False]
+    assert not delivered
+    assert outbound.dropped == 2
+    assert len(outbound) == 0
+
+
+def test_stop_answers_waiting_deliveries():
+    async def scenario():
+        outbound = bot.OutboundQueue(global_rate=1000, per_chat_rate=0.1, workers=1)
+        outbound.start(RecordingBot())
+        first = asyncio.ensure_future(outbound.deliver(1, "now"))
+        second = asyncio.ensure_future(outbound.deliver(1, "in ten seconds"))
+        await first
+        await outbound.stop(0)
+        return first.result(), await second
+
+    assert run(scenario()) == (True, False)
@@ -0,0 +1,210 @@
+"""Partitioning + cross-worker referral hand-off (two workers in one process)"""
+
+import asyncio
+import queue
+
+from telegram import Update
+
+import bot
+from conftest import Harness, json_store, reopen, run
+
+
+def test_partition_routing():
+    assert [bot.partition_of(user_id, 3) for user_id in (3, 4, "5")] == [0, 1, 2]
+    assert bot.shard_path("user_data.json", 1, 2) == "user_data.w1.json"
+    assert bot.shard_path("user_data.json", 0, 1) == "user_data.json"
+
+
+def test_update_owner_and_fan_out():
+    h = Harness()
+    admin = int(bot.CONFIG['ADMIN_USER_ID'])
+    start = h.updates.command(42, "/start 7")
+    top = h.updates.command(admin, "/top@test_bot 5")
+    restore = h.updates.command(admin, "/restore user_data_x")
+
+    assert bot.update_owner(start) == 42
+    assert bot.update_owner(h.updates.callback(43, "status")) == 43
+    assert bot.update_owner(h.updates.join_request(44)) == 44
+    assert bot.update_owner({'update_id': 1, 'poll': {}}) is None
+
+    assert bot.is_fan_out(top, admin, bot.CONFIG)
+    assert not bot.is_fan_out(restore, admin, bot.CONFIG)
+    assert not bot.is_fan_out(h.updates.command(42, "/top"), 42, bot.CONFIG)
+
+
+def test_ledger_keeps_unanswered_claims_across_restart():
+    async def scenario():
+        ledger = bot.HandoffLedger("handoffs.json")
+        ledger.claim('11', '10')
+        ledger.claim('13', '10')
+        ledger.claim('15', '20')
+        ledger.acknowledge('11', '10')
+        ledger.release('15', '20')
+        ledger.release('13', '99')   # answer for another referrer - ignored
+        await ledger.persisted()
+
+    run(scenario())
+    ledger = bot.HandoffLedger("handoffs.json")
+    assert ledger.pending() == [('13', '10')]
+    assert ledger.unsettled() == [('11', '10')]
+    assert '11' in ledger and '15' not in ledger
+
+    ledger.settle('11')
+    assert '11' not in bot.HandoffLedger("handoffs.json")
+
+
+class Workers:
+    """Two ReferralBots wired through plain queues - delivery is explicit"""
+
+    def __init__(self):
+        self.workers = [Harness(index, 2) for index in range(2)]
+        self.control = [queue.Queue() for _ in self.workers]
+        for h in self.workers:
+            h.bot.peers = self.control
+
+    def owner(self, user_id):
+        return self.workers[bot.partition_of(user_id, 2)]
+
+    async def start(self):
+        for h in self.workers:
+            await h.start()
+
+    async def stop(self):
+        for h in self.workers:
+            await h.stop()
+
+    async def command(self, user_id, text):
+        await self.owner(user_id).command(user_id, text)
+
+    def drop(self):
+        for q in self.control:
+            while not q.empty():
+                q.get_nowait()
+
+    async def deliver(self):
+        """Run queued hand-offs (and their replies) until every queue is empty"""
+        while any(not q.empty() for q in self.control):
+            for h, q in zip(self.workers, self.control):
+                while not q.empty():
+                    await h.bot.handle_handoff(q.get_nowait())
+
+
+def test_cross_partition_referral():
+    async def scenario():
+        w = Workers()
+        await w.start()
+        try:
+            await w.command(10, "/start")
+            await w.command(12, "/start")
+            await w.command(11, "/start 10")   # worker 1 -> worker 0
+            await w.deliver()
+            sender = w.workers[1].bot
+            acknowledged = dict(sender.handoffs.acknowledged)
+            await sender.handoff_retry_job(None)   # settled onto 11's own record
+            await w.command(11, "/start 12")   # already referred
+            await w.deliver()
+            return (w.owner(10).referral_count(10), w.owner(12).referral_count(12), acknowledged,
+                    len(sender.handoffs), sender.store.referred_by('11'), w.owner(10).bot.store.referred_by('11'))
+        finally:
+            await w.stop()
+
+    assert run(scenario()) == (1, 0, {'11': '10'}, 0, '10', '10')
+
+
+def test_rejected_hand_off_releases_claim():
+    async def scenario():
+        w = Workers()
+        await w.start()
+        try:
+            await w.command(15, "/start 20")   # 20 never registered on worker 0
+            await w.deliver()
+            ledger = w.workers[1].bot.handoffs
+            return '15' in ledger, ledger.pending()
+        finally:
+            await w.stop()
+
+    assert run(scenario()) == (False, [])
+
+
+def test_lost_hand_off_is_resent_once_credited():
+    async def scenario():
+        w = Workers()
+        await w.start()
+        try:
+            await w.command(10, "/start")
+            await w.command(13, "/start 10")
+            w.drop()                           # worker 0 stopped before reading it
+            sender = w.workers[1].bot
+            assert sender.handoffs.pending() == [('13', '10')]
+
+            # Retry job twice - the duplicate copy must not credit twice
+            await sender.handoff_retry_job(None)
+            await sender.handoff_retry_job(None)
+            await w.deliver()
+            return w.owner(10).referral_count(10), sender.handoffs.pending()
+        finally:
+            await w.stop()
+
+    assert run(scenario()) == (1, [])
+
+
+def test_remote_referrer_survives_restart():
+    store = json_store()
+    store.create_user('11', "user11", "User11")
+    assert store.mark_referred('11', '10')
+    assert not store.mark_referred('12', '10')   # no record yet
+    store = reopen(store)
+    assert store.referred_by('11') == '10'
+    store.create_user('12', "user12", "User12")
+    assert not store.add_referral('12', '11', 1)
+    assert run(store.compact())
+    store = reopen(store)
+    assert store.referred_by('11') == '10'
+    store.remove('11')
+    assert store.referred_by('11') is None
+    store.close()
+
+    store = bot.SqliteUserStore("user_data.db", "backups")
+    store.load()
+    store.create_user('11', "user11", "User11")
+    assert store.mark_referred('11', '10')
+    assert not store.mark_referred('12', '10')
+    store.close()
+    store = bot.SqliteUserStore("user_data.db", "backups")
+    store.load()
+    assert store.referred_by('11') == '10'
+    store.close()
+
+
+def test_poll_confirms_last_offset_on_stop():
+    class PollingBot:
+        def __init__(self, stop_event, factory):
+            self.stop_event = stop_event
+            self.factory = factory
+            self.offsets = []
+
+        async def delete_webhook(self):
+            pass
+
+        async def get_updates(self, offset=None, **kwargs):
+            self.offsets.append(offset)
+            if self.stop_event.is_set():
+                return []
+            self.stop_event.set()
+            return [Update.de_json(self.factory.command(42, "/start"), None),
+                    Update.de_json(self.factory.command(43, "/start"), None)]
+
+    async def scenario():
+        dispatcher = bot.UpdateDispatcher(dict(bot.CONFIG, WORKERS=2))
+        routed = []
+
+        async def route(raw):
+            routed.append(raw['update_id'])
+        dispatcher.route = route
+
+        stop_event = asyncio.Event()
+        polling = PollingBot(stop_event, Harness().updates)
+        await dispatcher.poll(polling, stop_event)
+        return routed, polling.offsets
+
+    assert run(scenario()) == ([1, 2], [None, 3])
@@ -0,0 +1,42 @@
+"""Typed records: replaying a journal the snapshot already contains changes nothing"""
+
+import shutil
+
+import pytest
+
+import bot
+from conftest import assert_seeded, json_store, run, seed_referrals
+
+
+def crash_after_snapshot(fmt):
+    """Compaction wrote the snapshot but died before removing journal.1"""
+    store = json_store(fmt)
+    seed_referrals(store)
+    shutil.copy(store.journal_file, "journal.saved")
+    assert run(store.compact())
+    store.close()
+    shutil.copy("journal.saved", store.journal_file + ".1")
+
+
+@pytest.mark.parametrize('fmt', ['ndjson', 'json'])
+def test_replayed_journal_does_not_double_count(fmt):
+    crash_after_snapshot(fmt)
+
+    store = json_store(fmt)
+    assert_seeded(store)
+    store.close()
+
+
+@pytest.mark.parametrize('fmt', ['ndjson', 'json'])
+def test_replayed_journal_does_not_double_count_async_load(fmt):
+    crash_after_snapshot(fmt)
+
+    async def load():
+        store = bot.JsonUserStore("user_data.json", "backups", snapshot_format=fmt)
+        await store.load_async()
+        await store.wait_ready()
+        return store
+
+    store = run(load())
+    assert_seeded(store)
+    store.close()
@@ -0,0 +1,61 @@
+"""One referrer per referred user - store level and through /start"""
+
+import pytest
+
+import bot
+from conftest import Harness, assert_seeded, json_store, reopen, run, seed_referrals
+
+
+@pytest.mark.parametrize('fmt', ['ndjson', 'json'])
+def test_json_store_credits_once(fmt):
+    store = json_store(fmt)
+    seed_referrals(store)
+    store.create_user('5', "user5", "User5")
+
+    # Same referrer again, or a different one - the first referral stands
+    assert not store.add_referral('1', '2', 1)
+    assert not store.add_referral('5', '2', 1)
+    assert store.get('1')['referral_count'] == 2
+    assert store.get('5')['referral_count'] == 0
+
+    store = reopen(store, fmt)
+    assert not store.add_referral('5', '3', 1)
+    assert_seeded(store, users=4)
+    store.close()
+
+
+def test_sqlite_store_credits_once():
+    store = bot.SqliteUserStore("user_data.db", "backups")
+    store.load()
+    seed_referrals(store)
+    store.create_user('5', "user5", "User5")
+
+    assert not store.add_referral('1', '2', 1)
+    assert not store.add_referral('5', '2', 1)
+    store.close()
+
+    store = bot.SqliteUserStore("user_data.db", "backups")
+    store.load()
+    assert_seeded(store, users=4)
+    assert store.get('5')['referral_count'] == 0
+    store.close()
+
+
+def test_start_links_credit_once():
+    async def scenario():
+        h = Harness()
+        await h.start()
+        try:
+            await h.command(100, "/start")
+            await h.command(101, "/start")
+            await h.command(200, "/start 100")
+            await h.command(200, "/start 100")   # same link again
+            await h.command(200, "/start 101")   # someone else's link
+            await h.command(100, "/start 100")   # own link
+            await h.command(300, "/start 999")   # unknown referrer
+            await h.command(301, "/start abc")
+            return h.referral_count(100), h.referral_count(101), h.bot.store.referred_by('200'), len(h.bot.store)
+        finally:
+            await h.stop()
+
+    assert run(scenario()) == (1, 0, '100', 5)
@@ -0,0 +1,65 @@
+"""Snapshot formats - both write, both read back, the header decides"""
+
+import threading
+
+import pytest
+
+import bot
+from conftest import assert_seeded, json_store, reopen, run, seed_referrals
+
+
+@pytest.mark.parametrize('fmt', ['ndjson', 'json'])
+@pytest.mark.parametrize('compress', [False, True])
+def test_snapshot_round_trip(fmt, compress):
+    store = json_store(fmt)
+    seed_referrals(store)
+    store.mark_approved('1')
+    path = "snapshot.gz" if compress else "snapshot"
+    bot.write_file_atomic(path, bot.snapshot_chunks(store.users, fmt), compress)
+
+    assert bot.snapshot_format(path) == fmt
+    users = bot.read_snapshot(path)
+    assert sorted(users) == [1, 2, 3]
+    assert users[1].to_dict() == store.users[1].to_dict()
+    assert users[1].to_dict()['is_approved']
+    store.close()
+
+
+def test_ndjson_chunks_bound_rows(monkeypatch):
+    monkeypatch.setattr(bot, 'SNAPSHOT_CHUNK_ROWS', 2)
+    users = {user_id: bot.UserRecord(f"u{user_id}", None, 1) for user_id in range(5)}
+    chunks = list(bot.snapshot_chunks(users, 'ndjson'))
+
+    # Header + 3 chunks of at most 2 rows
+    assert len(chunks) == 4
+    assert all(chunk.count(b"\n") <= 2 for chunk in chunks[1:])
+
+
+def test_frozen_ids_skip_removed_users():
+    users = {user_id: bot.UserRecord(None, None, 1) for user_id in range(3)}
+    ids = list(users)
+    del users[1]
+    rows = b"".join(bot.snapshot_chunks(users, 'ndjson', ids=ids)).splitlines()[1:]
+    assert [row.split(b",")[0] for row in rows] == [b"[0", b"[2"]
+
+
+def test_compaction_io_runs_off_the_loop():
+    store = json_store()
+    seed_referrals(store)
+    store.create_user('4', "user4", "User4")
+    threads = []
+
+    def recording(method):
+        def wrapper(*args):
+            threads.append((method.__name__, threading.current_thread() is threading.main_thread()))
+            return method(*args)
+        return wrapper
+
+    store._write_journal = recording(store._write_journal)
+    store._rotate_journal = recording(store._rotate_journal)
+    assert run(store.compact())
+    assert threads == [('_write_journal', False), ('_rotate_journal', False)]
+
+    store = reopen(store)
+    assert_seeded(store, users=4)
+    store.close()
@@ -0,0 +1,39 @@
+"""SQLite store - upserts and off-loop maintenance"""
+
+import os
+
+import bot
+from conftest import assert_seeded, run, seed_referrals
+
+
+def open_store():
+    store = bot.SqliteUserStore("user_data.db", "backups")
+    store.load()
+    return store
+
+
+def test_create_user_keeps_existing_record():
+    store = open_store()
+    seed_referrals(store)
+
+    store.create_user('1', "again", "Again")
+    assert store.get('1')['username'] == "user1"
+    assert_seeded(store)
+    store.close()
+
+
+def test_compact_and_restore():
+    store = open_store()
+    seed_referrals(store)
+    os.makedirs("backups")
+    run(store.write_backup("backups/snap.db"))
+
+    store.create_user('4', "user4", "User4")
+    store.flush()
+    assert run(store.compact())
+    assert os.path.getsize("user_data.db-wal") == 0
+
+    run(store.restore_backup("backups/snap.db"))
+    assert '4' not in store
+    assert_seeded(store)
+    store.close()
@@ -0,0 +1,116 @@
+"""Single-flight status views - coalescing, debounce window, invalidation"""
+
+import asyncio
+
+import pytest
+from telegram import Update
+
+import bot
+from conftest import Harness, run
+
+
+def test_concurrent_callers_share_one_computation():
+    views = bot.SingleFlight(window=60)
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "view"
+
+    async def scenario():
+        first = await asyncio.gather(*(views.run('1', compute) for _ in range(3)))
+        again = await views.run('1', compute)
+        views.forget('1')
+        fresh = await views.run('1', compute)
+        return first, again, fresh
+
+    first, again, fresh = run(scenario())
+    assert first == [("view", False), ("view", True), ("view", True)]
+    assert again == ("view", True)
+    assert fresh == ("view", False)
+    assert len(calls) == 2
+    assert (views.computed, views.coalesced) == (2, 3)
+
+
+def test_missing_and_failed_results_are_not_kept():
+    views = bot.SingleFlight(window=60)
+
+    async def missing():
+        return None
+
+    async def broken():
+        raise ValueError("boom")
+
+    async def scenario():
+        assert await views.run('1', missing) == (None, False)
+        assert await views.run('1', missing) == (None, False)
+        with pytest.raises(ValueError):
+            await views.run('2', broken)
+        assert not views.debounced('2')
+
+    run(scenario())
+    assert views.computed == 3
+    assert not views.results and not views.inflight
+
+
+def test_window_expiry_and_size_bound(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(bot.time, 'monotonic', lambda: now[0])
+    views = bot.SingleFlight(window=2, max_size=2)
+
+    async def compute():
+        return "view"
+
+    async def scenario():
+        for key in ('1', '2', '3'):
+            await views.run(key, compute)
+
+    run(scenario())
+    assert list(views.results) == ['2', '3']
+    assert views.debounced('3')
+    now[0] += 3
+    assert not views.debounced('3')
+    assert '3' not in views.results
+
+
+def test_cancelled_caller_does_not_cancel_shared_computation():
+    views = bot.SingleFlight(window=60)
+    release = None
+
+    async def compute():
+        await release.wait()
+        return "view"
+
+    async def scenario():
+        nonlocal release
+        release = asyncio.Event()
+        first = asyncio.ensure_future(views.run('1', compute))
+        second = asyncio.ensure_future(views.run('1', compute))
+        await asyncio.sleep(0)
+        first.cancel()
+        release.set()
+        return await second
+
+    assert run(scenario()) == ("view", True)
+    assert views.fresh('1') == "view"
+
+
+def test_repeated_status_taps_build_one_view():
+    async def scenario():
+        h = Harness()
+        await h.start()
+        try:
+            await h.command(100, "/start")
+            taps = [Update.de_json(h.updates.callback(100, "status"), h.application.bot) for _ in range(3)]
+            await asyncio.gather(*(h.application.process_update(tap) for tap in taps))
+            views = h.bot.status_views
+            first = (views.computed, views.coalesced)
+            # A credited referral makes the referrer's cached view stale
+            await h.command(200, "/start 100")
+            await h.application.process_update(Update.de_json(h.updates.callback(100, "status"), h.application.bot))
+            return first, (views.computed, views.coalesced)
+        finally:
+            await h.stop()
+
+    assert run(scenario()) == ((1, 2), (2, 2))
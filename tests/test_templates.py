@@ -0,0 +1,56 @@
+"""Template escaping - config values and user input never act as placeholders"""
+
+import json
+from urllib.parse import parse_qs, urlsplit
+
+import bot
+
+
+def templates(locales_file=None, **overrides):
+    return bot.MessageTemplates(dict(bot.CONFIG, **overrides), locales_file)
+
+
+def test_channel_link_braces_survive_both_passes():
+    link = "https://t.me/+ab{cd}ef{0}"
+    locale = templates(MOVIE_CHANNEL_LINK=link).default
+
+    assert link in locale.completed
+    assert locale.join_button.url == link
+
+
+def test_user_fields_are_not_formatted_again():
+    locale = templates().default
+    text = locale.render('welcome', name="{points} {0} {required}", points=7, referrals=1, link="t.me/x")
+
+    assert "{points} {0} {required}" in text
+    assert "Points: 7" in text
+
+
+def test_placeholders_baked_in_once():
+    locale = templates(REQUIRED_REFERRALS=4).default
+    text = locale.render('points_received', referrals=1, points=1, remaining=3)
+
+    assert "Referrals: 1/4" in text
+    assert "{required}" not in locale.texts['points_received']
+
+
+def test_share_url_is_encoded():
+    t = templates()
+    locale = t.default
+    url = t.share_button('123', locale).url
+    query = parse_qs(urlsplit(url).query)
+
+    assert query['url'] == [t.referral_link('123')]
+    assert query['text'] == [locale.texts['share_text']]
+    assert "?start=123" not in url
+
+
+def test_locale_file_falls_back_to_english(tmp_path):
+    path = tmp_path / "locales.json"
+    path.write_text(json.dumps({'hi': {'share_text': "{ज़रूर} जुड़ें"}}), encoding='utf-8')
+    t = templates(str(path))
+
+    hindi = t.locale('hi-IN')
+    assert hindi.texts['share_text'] == "{ज़रूर} जुड़ें"
+    assert hindi.texts['help'] == t.locale('en').texts['help']
+    assert t.locale('xx') is t.default
@@ -0,0 +1,50 @@
+"""Warm-up - online before the snapshot is decoded, ready once it is"""
+
+import asyncio
+
+import bot
+from conftest import Harness, assert_seeded, json_store, run, seed_referrals
+
+
+def seeded_snapshot():
+    store = json_store()
+    seed_referrals(store)
+    assert run(store.compact())
+    store.close()
+
+
+def test_duplicate_referral_during_warm_up_changes_nothing():
+    seeded_snapshot()
+
+    async def scenario():
+        store = bot.JsonUserStore("user_data.json", "backups")
+        loading = asyncio.create_task(store.load_async())
+        await store.online_event.wait()
+        assert not store.ready
+        # referrers isn't built yet - the referrer's own record rejects it
+        credited = store.add_referral('1', '2', 1)
+        await loading
+        return store, credited
+
+    store, credited = run(scenario())
+    assert not credited
+    assert store.stats.total_referrals == 2
+    assert_seeded(store)
+    store.close()
+
+
+def test_updates_during_warm_up_are_served_once_loaded():
+    seeded_snapshot()
+
+    async def scenario():
+        h = Harness()
+        await h.application.initialize()
+        await h.bot.post_init(h.application)
+        try:
+            # Not awaiting the store - the group -1 gate holds these back
+            await asyncio.gather(h.command(4, "/start 1"), h.command(2, "/start 3"))
+            return h.bot.store.ready, h.referral_count(1), h.referral_count(3), h.bot.store.referred_by('2')
+        finally:
+            await h.stop()
+
+    assert run(scenario()) == (True, 3, 0, '1')
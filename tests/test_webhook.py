@@ -0,0 +1,88 @@
+"""Webhook endpoint - secret check and the stdlib HTTP server"""
+
+import asyncio
+import json
+
+import bot
+from conftest import Harness, run
+
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+
+
+def test_secret_check():
+    config = dict(bot.CONFIG, WEBHOOK_SECRET="s3cret")
+    assert bot.check_webhook_request(config, 'POST', {SECRET_HEADER: "s3cret"}) is None
+    assert bot.check_webhook_request(config, 'POST', {SECRET_HEADER: "wrong"})[0] == 403
+    assert bot.check_webhook_request(config, 'POST', {})[0] == 403
+    assert bot.check_webhook_request(config, 'GET', {SECRET_HEADER: "s3cret"})[0] == 405
+
+    open_config = dict(bot.CONFIG, WEBHOOK_SECRET="")
+    assert bot.check_webhook_request(open_config, 'POST', {}) is None
+
+
+def test_webhook_queues_only_verified_updates(monkeypatch):
+    monkeypatch.setitem(bot.CONFIG, 'WEBHOOK_SECRET', "s3cret")
+
+    async def scenario():
+        h = Harness()
+        await h.start()
+        await h.application.start()
+        try:
+            body = json.dumps(h.updates.command(42, "/start")).encode('utf-8')
+            forged = await h.bot.handle_webhook('POST', {SECRET_HEADER: "nope"}, body)
+            bad = await h.bot.handle_webhook('POST', {SECRET_HEADER: "s3cret"}, b"{oops")
+            queued = h.application.update_queue.qsize()
+            ok = await h.bot.handle_webhook('POST', {SECRET_HEADER: "s3cret"}, body)
+            return forged[0], bad[0], ok[0], queued
+        finally:
+            await h.application.stop()
+            await h.stop()
+
+    assert run(scenario()) == (403, 400, 200, 0)
+
+
+async def request(reader, writer, method, path, body=b"", close=False):
+    head = f"{method} {path} HTTP/1.1\r\nHost: x\r\nContent-Length: {len(body)}\r\n"
+    if close:
+        head += "Connection: close\r\n"
+    writer.write(head.encode('latin-1') + b"\r\n" + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while (line := await reader.readline()) != b"\r\n":
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.lower()] = value.strip()
+    return status, await reader.readexactly(int(headers['content-length']))
+
+
+def test_http_server_keep_alive_limits_and_timeouts():
+    async def echo(method, headers, body):
+        return 200, "text/plain", body
+
+    async def scenario():
+        server = bot.HttpServer("127.0.0.1", 0, {'/hook': echo}, header_timeout=0.2, idle_timeout=0.2)
+        server.MAX_BODY = 16
+        await server.start()
+        port = server.server.sockets[0].getsockname()[1]
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            results = [
+                await request(reader, writer, 'POST', "/hook", b"one"),
+                await request(reader, writer, 'POST', "/hook?x=1", b"two"),
+                await request(reader, writer, 'POST', "/other"),
+            ]
+            # Idle past idle_timeout - the server hangs up
+            idle_closed = await asyncio.wait_for(reader.read(), 2) == b""
+            writer.close()
+
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            results.append(await request(reader, writer, 'POST', "/hook", b"x" * 17))
+            too_large_closed = await asyncio.wait_for(reader.read(), 2) == b""
+            writer.close()
+            return results, idle_closed, too_large_closed
+        finally:
+            await server.stop(1)
+
+    results, idle_closed, too_large_closed = run(scenario())
+    assert results == [(200, b"one"), (200, b"two"), (404, b"not found"), (413, b"too large")]
+    assert idle_closed and too_large_closed